@@ -0,0 +1,381 @@
+'''
+Reproducible benchmark of MiggyDB. Generates deterministic synthetic tables with a TPC-H like schema (customer,
+orders and lineitem) at a scale factor, with uniform or zipf skewed foreign keys, runs a fixed workload on them
+(queries parsed by DatabaseCLI, all run through utils), and writes the latency, throughput, peak memory and bytes
+spilled to disk of every step to JSON so that runs can be compared across commits:
+
+    python -m src.benchmark --scale 0.1 --distribution skewed --output benchmark.json
+    python -m src.benchmark --scale 0.1 --distribution skewed --baseline benchmark.json
+'''
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from . import utils
+from .cli import DatabaseCLI
+from .config import DATA_PATH, TEMP_DB_PATH
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# Synthetic data
+
+ROWS_PER_SCALE = {'customer': 150_000, 'orders': 1_500_000, 'lineitem': 6_000_000} # rows of each table at scale factor 1
+PARTS_PER_SCALE = 200_000 # distinct part keys of lineitem at scale factor 1
+SUPPLIERS_PER_SCALE = 10_000 # distinct supplier keys of lineitem at scale factor 1
+GENERATE_CHUNK_ROWS = 1_000_000 # rows generated and written to csv at a time
+
+N_NATIONS = 25
+SEGMENTS = ['AUTOMOBILE', 'BUILDING', 'FURNITURE', 'HOUSEHOLD', 'MACHINERY']
+ORDER_STATUSES = ['F', 'O', 'P']
+PRIORITIES = ['1-URGENT', '2-HIGH', '3-MEDIUM', '4-NOT SPECIFIED', '5-LOW']
+RETURN_FLAGS = ['A', 'N', 'R']
+SHIP_MODES = ['AIR', 'FOB', 'MAIL', 'RAIL', 'REG AIR', 'SHIP', 'TRUCK']
+
+def table_sizes(scale):
+    '''Number of rows of each table at scale factor scale'''
+    return {table: max(1, int(rows * scale)) for table, rows in ROWS_PER_SCALE.items()}
+
+def key_sampler(rng, n_keys, distribution='uniform', skew=1.1):
+    '''Function drawing size keys from 1 to n_keys, uniformly or (distribution 'skewed') with zipf probabilities 1 / rank ** skew'''
+    if distribution == 'uniform':
+        return lambda size: rng.integers(1, n_keys + 1, size)
+    if distribution != 'skewed':
+        raise ValueError(f'Unknown key distribution {distribution}, expected uniform or skewed')
+    weights = 1.0 / np.arange(1, n_keys + 1) ** skew
+    cdf = np.cumsum(weights / weights.sum())
+    keys = rng.permutation(n_keys) + 1
+    return lambda size: keys[np.minimum(np.searchsorted(cdf, rng.random(size)), n_keys - 1)]
+
+def money(rng, low, high, size):
+    '''size random amounts between low and high, in dollars rounded to cents'''
+    return np.round(rng.uniform(low, high, size), 2)
+
+def generate_customer(rng, start, n_rows, sizes, sample):
+    '''Rows start + 1 to start + n_rows of the customer table'''
+    keys = np.arange(start + 1, start + n_rows + 1)
+    return pa.table({
+        'custkey': keys,
+        'name': [f'Customer#{key:09d}' for key in keys],
+        'nationkey': rng.integers(0, N_NATIONS, n_rows),
+        'acctbal': money(rng, -999.99, 9999.99, n_rows),
+        'mktsegment': rng.choice(SEGMENTS, n_rows),
+    })
+
+def generate_orders(rng, start, n_rows, sizes, sample):
+    '''Rows start + 1 to start + n_rows of the orders table, placed by customers drawn by sample'''
+    return pa.table({
+        'orderkey': np.arange(start + 1, start + n_rows + 1),
+        'custkey': sample['custkey'](n_rows),
+        'orderstatus': rng.choice(ORDER_STATUSES, n_rows),
+        'totalprice': money(rng, 850.0, 550000.0, n_rows),
+        'orderyear': rng.integers(1992, 1999, n_rows),
+        'orderpriority': rng.choice(PRIORITIES, n_rows),
+    })
+
+def generate_lineitem(rng, start, n_rows, sizes, sample):
+    '''Rows start + 1 to start + n_rows of the lineitem table, with the lines of an order stored together like in TPC-H'''
+    return pa.table({
+        'orderkey': sample['orderkey'][start:start + n_rows],
+        'partkey': sample['partkey'](n_rows),
+        'suppkey': rng.integers(1, sizes['suppliers'] + 1, n_rows),
+        'linenumber': rng.integers(1, 8, n_rows),
+        'quantity': rng.integers(1, 51, n_rows),
+        'extendedprice': money(rng, 900.0, 105000.0, n_rows),
+        'discount': rng.integers(0, 11, n_rows) / 100,
+        'returnflag': rng.choice(RETURN_FLAGS, n_rows),
+        'shipmode': rng.choice(SHIP_MODES, n_rows),
+    })
+
+GENERATORS = {'customer': generate_customer, 'orders': generate_orders, 'lineitem': generate_lineitem}
+
+def generate_tables(path, scale=0.01, distribution='uniform', skew=1.1, seed=42):
+    '''Writes the csv files of the synthetic tables at scale factor scale into path. Returns {table name: (csv path, rows)}'''
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    sizes = table_sizes(scale)
+    sizes['parts'] = max(1, int(PARTS_PER_SCALE * scale))
+    sizes['suppliers'] = max(1, int(SUPPLIERS_PER_SCALE * scale))
+    tables = {}
+    for i, (table_name, generate) in enumerate(GENERATORS.items()):
+        rng = np.random.default_rng([seed, i])
+        sample = {
+            'custkey': key_sampler(rng, sizes['customer'], distribution, skew),
+            'partkey': key_sampler(rng, sizes['parts'], distribution, skew),
+        }
+        if table_name == 'lineitem':
+            sample['orderkey'] = np.sort(key_sampler(rng, sizes['orders'], distribution, skew)(sizes['lineitem']))
+        csv_path, writer = path / f'{table_name}.csv', None
+        for start in range(0, sizes[table_name], GENERATE_CHUNK_ROWS):
+            data = generate(rng, start, min(GENERATE_CHUNK_ROWS, sizes[table_name] - start), sizes, sample)
+            writer = writer or pa_csv.CSVWriter(csv_path, data.schema)
+            writer.write_table(data)
+        writer.close()
+        tables[table_name] = (csv_path, sizes[table_name])
+    return tables
+
+# Measurements
+
+def reset_peak_rss():
+    '''Resets the peak resident set size of the process to its current size, where the OS allows it (Linux). Returns whether it did'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss():
+    '''Most bytes of memory the process has held since it started or since reset_peak_rss, None where unknown'''
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # kilobytes on Linux, bytes on macOS
+
+def latency_summary(latencies):
+    '''min, mean, percentiles and max of a list of latencies in seconds'''
+    latencies = np.array(latencies)
+    summary = {'min': latencies.min(), 'mean': latencies.mean()}
+    for q in [50, 90, 95, 99]:
+        summary[f'p{q}'] = np.percentile(latencies, q)
+    summary['max'] = latencies.max()
+    return {key: float(value) for key, value in summary.items()}
+
+def git_commit():
+    '''Commit the source tree is checked out at (with a + if it has uncommitted changes), None outside of git'''
+    repo = Path(__file__).resolve().parent.parent
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo, capture_output=True, text=True, check=True)
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo,
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.stdout.strip() + ('+' if status.stdout.strip() else '')
+
+# Workload
+
+def run_step(name, operations, rows):
+    '''Runs operations (functions returning the bytes they spilled or None) as the benchmark step name. Returns its measurements'''
+    latencies, spilled = [], []
+    reset, peak_before = reset_peak_rss(), peak_rss()
+    for operation in operations:
+        start = time.perf_counter()
+        spilled.append(operation())
+        latencies.append(time.perf_counter() - start)
+    spilled = [n_bytes for n_bytes in spilled if n_bytes is not None]
+    peak = peak_rss()
+    if not reset and (peak is None or peak_before is None or peak <= peak_before):
+        peak = None # the step did not raise the peak of the process, and its own peak is not known
+    latency = latency_summary(latencies)
+    result = {
+        'step': name,
+        'operations': len(latencies),
+        'rows': rows,
+        'latency': latency,
+        'ops_per_sec': 1 / latency['mean'] if latency['mean'] else None,
+        'rows_per_sec': rows / latency['mean'] if latency['mean'] else None,
+        'spilled_bytes': sum(spilled) if spilled else None,
+        'peak_rss': peak,
+    }
+    print(f'{name}: p50 {latency["p50"]:.4f}s p99 {latency["p99"]:.4f}s over {len(latencies)} operations', file=sys.stderr)
+    return result
+
+def consume(partitions):
+    '''Reads all the partitions of a query'''
+    for _ in partitions:
+        pass
+
+def parse_query(cli, query):
+    '''Keyword arguments of utils.plan_query for query as typed into DatabaseCLI. Raises ValueError if it rejects the query'''
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        parsed = cli.parse_query(query)
+    if parsed is None:
+        raise ValueError(f'{query}: {output.getvalue().strip()}')
+    return parsed
+
+def run_query(database, query):
+    '''Runs query (keyword arguments of utils.plan_query) to the end. Returns the bytes its operators spilled to disk'''
+    query_path, memory = Path(TEMP_DB_PATH / f'benchmark_{time.time_ns()}'), utils.MemoryManager()
+    try:
+        consume(utils.execute_plan(utils.plan_query(database, **query), query_path, memory=memory))
+    finally:
+        shutil.rmtree(query_path, ignore_errors=True)
+    return memory.spilled
+
+def workload(cli, database, tables, repeat, rng):
+    '''The fixed workload: yields (step name, operations, rows per operation) of ingests, queries and writes'''
+    rows = {table_name: n_rows for table_name, (_, n_rows) in tables.items()}
+    def ingest(csv_path, table_name):
+        utils.create_table_from_csv(path=csv_path, database=database, table_name=table_name)
+        cli.tables.append(table_name)
+    for table_name, (csv_path, n_rows) in tables.items():
+        yield f'ingest_{table_name}', [lambda csv_path=csv_path, table_name=table_name: ingest(csv_path, table_name)], n_rows
+
+    queries = {
+        'filter': ('from lineitem filter (quantity gt 45)', rows['lineitem']),
+        'filter_point': (f'from orders filter (orderkey eq {rows["orders"] // 2})', rows['orders']),
+        'projection': ('gimme orderkey, extendedprice, discount from lineitem', rows['lineitem']),
+        'join': ('from customer + orders by custkey', rows['customer'] + rows['orders']),
+        'join_large': ('gimme orderkey_x, totalprice, extendedprice from orders + lineitem by orderkey',
+                       rows['orders'] + rows['lineitem']),
+        'group_agg': ('from lineitem group returnflag, shipmode agg sum(extendedprice), average(discount), count(orderkey)',
+                      rows['lineitem']),
+        'group_agg_high_cardinality': ('from orders group custkey agg sum(totalprice), max(orderyear)', rows['orders']),
+        'sort': ('from orders sort totalprice', rows['orders']),
+        'limit': ('from lineitem skip 100 trunc 10', rows['lineitem']),
+        'top_n': ('from lineitem sort rev extendedprice trunc 10', rows['lineitem']),
+    }
+    for name, (query, n_rows) in queries.items():
+        query = parse_query(cli, query)
+        yield name, [lambda query=query: run_query(database, query) for _ in range(repeat)], n_rows
+
+    spill_path = Path(TEMP_DB_PATH / 'benchmark_join')
+    def sort_merge_join():
+        spill_path.mkdir(parents=True, exist_ok=True)
+        memory = utils.MemoryManager()
+        try:
+            consume(utils.join_tables(database, 'orders', 'lineitem', 'orderkey', spill_path, algorithm='sort_merge',
+                                      memory=memory))
+        finally:
+            shutil.rmtree(spill_path, ignore_errors=True)
+        return memory.spilled
+    yield 'join_sort_merge', [sort_merge_join] * repeat, rows['orders'] + rows['lineitem']
+
+    batch, next_key = 10, rows['orders'] + 1
+    inserts = []
+    for i in range(repeat):
+        keys = np.arange(next_key + i * batch, next_key + (i + 1) * batch)
+        values = [keys, rng.integers(1, rows['customer'] + 1, batch), ['O'] * batch, [1000.0] * batch, [1998] * batch,
+                  ['5-LOW'] * batch]
+        inserts.append(lambda values=values: utils.insert_into(database, 'orders', values))
+    yield 'insert', inserts, batch
+
+    def amend(key):
+        utils.modify(database, 'orders', [('orderkey', '=', key)], 'orderpriority', '1-URGENT')
+    def remove(key):
+        utils.drop_rows(database, 'lineitem', [('orderkey', '=', key)])
+    keys = [int(key) for key in rng.integers(1, rows['orders'] + 1, repeat)]
+    yield 'amend', [lambda key=key: amend(key) for key in keys], 1
+    yield 'remove', [lambda key=key: remove(key) for key in keys], 1
+
+def run_benchmark(scale=0.01, distribution='uniform', skew=1.1, seed=42, repeat=5, database='miggydb_benchmark',
+                  data_path=None, memory_budget=None, keep=False):
+    '''Generates the synthetic tables and runs the workload on them in the new database database. Returns the results'''
+    if (DATA_PATH / database).exists():
+        raise ValueError(f'Database {database} already exists, obliterate it or benchmark into another database')
+    generated = data_path is None
+    data_path = Path(tempfile.mkdtemp(prefix='miggydb_benchmark_') if generated else data_path)
+    results = {
+        'commit': git_commit(),
+        'started': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'scale': scale, 'distribution': distribution, 'skew': skew, 'seed': seed, 'repeat': repeat,
+            'memory_budget': memory_budget or utils.MEMORY_BUDGET, 'query_workers': utils.QUERY_WORKERS,
+        },
+    }
+    settings = {name: getattr(utils, name) for name in ['RESULT_CACHE', 'MEMORY_BUDGET', 'QUERY_MEMORY_BUDGET']}
+    utils.RESULT_CACHE = False
+    if memory_budget is not None:
+        utils.MEMORY_BUDGET = utils.QUERY_MEMORY_BUDGET = memory_budget
+    cli = None
+    try:
+        start = time.perf_counter()
+        tables = generate_tables(data_path, scale, distribution, skew, seed)
+        results['generate_seconds'] = time.perf_counter() - start
+        results['tables'] = {table_name: n_rows for table_name, (_, n_rows) in tables.items()}
+        with contextlib.redirect_stdout(io.StringIO()):
+            cli = DatabaseCLI()
+        utils.create_database(database)
+        cli.current_db, cli.tables = database, []
+        rng = np.random.default_rng([seed, len(GENERATORS)])
+        start = time.perf_counter()
+        results['steps'] = [run_step(*step) for step in workload(cli, database, tables, repeat, rng)]
+        results['seconds'] = time.perf_counter() - start
+        peaks = [step['peak_rss'] for step in results['steps'] if step['peak_rss'] is not None]
+        results['peak_rss'] = max(peaks) if peaks else None
+    finally:
+        for name, value in settings.items():
+            setattr(utils, name, value)
+        if cli is not None and cli.compactor is not None:
+            cli.compactor.set()
+        if not keep:
+            if (DATA_PATH / database).exists():
+                utils.drop_database(database)
+            if generated:
+                shutil.rmtree(data_path, ignore_errors=True)
+    return results
+
+def compare(results, baseline):
+    '''Data frame of the median latency of every step of results and of baseline, and how many times slower it got'''
+    baseline = {step['step']: step['latency']['p50'] for step in baseline['steps']}
+    return pl.DataFrame({
+        'step': [step['step'] for step in results['steps']],
+        'baseline_p50': [baseline.get(step['step']) for step in results['steps']],
+        'p50': [step['latency']['p50'] for step in results['steps']],
+    }, schema={'step': pl.Utf8, 'baseline_p50': pl.Float64, 'p50': pl.Float64}).with_columns(
+        (pl.col('p50') / pl.col('baseline_p50')).round(3).alias('ratio')
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src.benchmark', description='Reproducible benchmark of MiggyDB')
+    parser.add_argument('--scale', type=float, default=0.01, help='scale factor, 1 is 6 million lineitem rows')
+    parser.add_argument('--distribution', choices=['uniform', 'skewed'], default='uniform', help='distribution of the foreign keys')
+    parser.add_argument('--skew', type=float, default=1.1, help='zipf exponent of skewed keys')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the generated data')
+    parser.add_argument('--repeat', type=int, default=5, help='times every query, insert, amend and remove is run')
+    parser.add_argument('--memory-budget', type=int, default=None, help='bytes an operator may hold before spilling')
+    parser.add_argument('--database', default='miggydb_benchmark', help='database the benchmark creates and removes')
+    parser.add_argument('--data-path', default=None, help='directory to write the generated csv files into')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark database and generated files')
+    parser.add_argument('--output', default='benchmark.json', help='json file to write the results to')
+    parser.add_argument('--baseline', default=None, help='json results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    try:
+        results = run_benchmark(scale=args.scale, distribution=args.distribution, skew=args.skew, seed=args.seed,
+                                repeat=args.repeat, database=args.database, data_path=args.data_path,
+                                memory_budget=args.memory_budget, keep=args.keep)
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return 1
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results of commit {results["commit"]} written to {args.output}')
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        print(f'Compared with commit {baseline.get("commit")}')
+        if baseline.get('config') != results['config']:
+            print(f'Warning: the baseline ran with another configuration {baseline.get("config")}')
+        with pl.Config(tbl_rows=len(results['steps'])):
+            print(compare(results, baseline))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
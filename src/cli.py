@@ -2,16 +2,17 @@ from cmd2 import Cmd
 import os
 from pathlib import Path
 import polars as pl
-import pyarrow.parquet as pq
+import pyarrow as pa
 import pyarrow.csv as csv
 import re
 import ast
+import glob
 import shutil
 import datetime
 import time
 
 from . import utils
-from .config import DATA_PATH, TEMP_DB_PATH
+from .config import DATA_PATH, TEMP_DB_PATH, AUTO_COMPACT
 
 
 class DatabaseCLI(Cmd):
@@ -23,22 +24,78 @@ class DatabaseCLI(Cmd):
             Path.mkdir(DATA_PATH)
         if not (DATA_PATH / 'temp').exists():
             Path.mkdir(DATA_PATH / 'temp')
-        self.dbs = [dir.stem for dir in list(DATA_PATH.iterdir())]
+        self.dbs = utils.list_databases()
         self.current_db = None
         self.tables = None
+        self.compactor = utils.start_background_compactor() if AUTO_COMPACT else None
 
     def do_new(self, arg):
         '''argument parser for creating a new database or new table'''
         args = arg.split()
         # create new database if 'db' or 'database' in the input string
         if args[0] in ['db', 'database']:
-            if Path(DATA_PATH / args[1]).exists():
+            if args[1] in self.dbs or Path(DATA_PATH / args[1]).exists():
                 print(f'Database {args[1]} already exists.')
             else:
-                Path.mkdir(DATA_PATH / args[1])
+                utils.create_database(args[1])
                 self.dbs.append(args[1])
                 if (DATA_PATH / args[1]).exists():
                     print(f'Database {args[1]} successfully created!')
+        # create new index if 'index' in the input string: new index on <table>(<column>)
+        elif args[0] == 'index':
+            if self.current_db is None:
+                print(f'Database not set. Please specify a database for the new index.')
+                return
+            match = re.fullmatch(r'index\s+on\s+(\w+)\s*\(\s*(\w+)\s*\)', arg.strip())
+            if match is None:
+                print('Invalid input. Please use: new index on <table>(<column>)')
+            elif match.group(1) not in self.tables:
+                print(f'Error: {match.group(1)} not found')
+            else:
+                try:
+                    utils.create_index(database=self.current_db, table_name=match.group(1), col=match.group(2))
+                    print(f'Index on {match.group(1)}({match.group(2)}) successfully created.')
+                except Exception as e:
+                    print(f'An error occurred: {e}')
+        # create new bloom filter if 'bloom' in the input string: new bloom filter on <table>(<column>)
+        elif args[0] == 'bloom':
+            if self.current_db is None:
+                print(f'Database not set. Please specify a database for the new bloom filter.')
+                return
+            match = re.fullmatch(r'bloom\s+filter\s+on\s+(\w+)\s*\(\s*(\w+)\s*\)', arg.strip())
+            if match is None:
+                print('Invalid input. Please use: new bloom filter on <table>(<column>)')
+            elif match.group(1) not in self.tables:
+                print(f'Error: {match.group(1)} not found')
+            else:
+                try:
+                    utils.create_bloom_filter(database=self.current_db, table_name=match.group(1), col=match.group(2))
+                    print(f'Bloom filter on {match.group(1)}({match.group(2)}) successfully created.')
+                except Exception as e:
+                    print(f'An error occurred: {e}')
+        # create new materialized view if 'view' in the input string: new view <name> as (query ...)
+        elif args[0] == 'view':
+            if self.current_db is None:
+                print(f'Database not set. Please specify a database for the new view.')
+                return
+            match = re.fullmatch(r'view\s+(\w+)\s+as\s+\(\s*query\s+(.+)\)', arg.strip())
+            if match is None:
+                print('Invalid input. Please use: new view <name> as (query ...)')
+            elif match.group(1) in self.tables:
+                print(f'Table {match.group(1)} already exists.')
+            else:
+                query = self.parse_query(match.group(2))
+                if query is None:
+                    return
+                query_path = Path(TEMP_DB_PATH / ('view_' + datetime.datetime.now().strftime("%y%m%d_%H%M%S")))
+                try:
+                    mode = utils.create_view(database=self.current_db, view_name=match.group(1), query=query, query_path=query_path)
+                    self.tables.append(match.group(1))
+                    print(f'View {match.group(1)} successfully created ({"recomputed" if mode == "recompute" else "updated incrementally"} on insert).')
+                except Exception as e:
+                    print(f'An error occurred: {e}')
+                finally:
+                    shutil.rmtree(query_path, ignore_errors=True)
         # create new table in 'table' in the input string
         elif args[0] == 'table':
             if self.current_db is None:
@@ -46,38 +103,9 @@ class DatabaseCLI(Cmd):
             elif args[1] in self.tables:
                 print(f'Table {args[2]} already exists.')
             else:
-                # handle parsing entire csv file into MiggyDB table
-                if args[1] == 'from' and args[2] == 'csv':
-                    try:
-                        utils.create_table_from_csv(
-                            path=ast.literal_eval(args[3]),
-                            database=self.current_db,
-                            table_name=args[-1] if len(args) == 5 else None
-                        )
-                        if len(args) == 5:
-                            self.tables.append(args[-1])
-                            print(f'Table {args[-1]} successfully created')
-                        else:
-                            self.tables.append(Path(args[3]).stem)
-                            print(f'Table {Path(args[3]).stem} successfully created')
-                    except Exception as e:
-                        print(f'An error occurred: {e}')
-                # handle parsing JSON file into MiggyDB table
-                elif args[1] == 'from' and args[2] == 'json':
-                    try:
-                        utils.create_table_from_json(
-                            path=ast.literal_eval(args[3]),
-                            database=self.current_db,
-                            table_name=args[-1] if len(args) == 5 else None
-                        )
-                        if len(args) == 5:
-                            self.tables.append(args[-1])
-                            print(f'Table {args[-1]} successfully created')
-                        else:
-                            self.tables.append(Path(args[3]).stem)
-                            print(f'Table {Path(args[3]).stem} successfully created')
-                    except Exception as e:
-                        print(f'An error occurred: {e}')
+                # handle parsing csv or JSON file(s) into MiggyDB table
+                if args[1] == 'from' and args[2] in ['csv', 'json']:
+                    self.load_files(args)
                 # manual creation of new table
                 else:
                     if len(args) < 3:
@@ -95,6 +123,47 @@ class DatabaseCLI(Cmd):
         else:
             print('Unrecognized command.')
 
+    def load_files(self, args):
+        '''
+        create a new table from a csv or JSON file
+        new table from csv '/path/to/file.csv' <optional table name>
+        a glob pattern loads all matching files in parallel, and requires a table name
+        new table from csv '/path/to/*.csv' <table name>
+        '''
+        file_format = args[2]
+        try:
+            path = ast.literal_eval(args[3])
+            table_name = args[-1] if len(args) == 5 else None
+            if glob.has_magic(path):
+                if table_name is None:
+                    print('Please specify a table name when loading multiple files.')
+                    return
+                stats = utils.create_table_from_files(
+                    paths=glob.glob(path),
+                    database=self.current_db,
+                    table_name=table_name,
+                    file_format=file_format
+                )
+            elif file_format == 'csv':
+                stats = utils.create_table_from_csv(path=path, database=self.current_db, table_name=table_name)
+            else:
+                stats = utils.create_table_from_json(path=path, database=self.current_db, table_name=table_name)
+            if table_name is None:
+                table_name = Path(path).stem
+            self.tables.append(table_name)
+            print(f'Table {table_name} successfully created')
+            self.print_ingest_stats(stats)
+        except Exception as e:
+            print(f'An error occurred: {e}')
+
+    def print_ingest_stats(self, stats):
+        '''print row and byte throughput of a file ingest'''
+        print(
+            f'{stats["rows"]} rows ({stats["bytes"] / 1024 / 1024:.2f} MB) loaded into {stats["partitions"]} partitions '
+            f'in {stats["seconds"]:.4f} seconds: {stats["rows_per_sec"]:,.0f} rows/sec, '
+            f'{stats["bytes_per_sec"] / 1024 / 1024:.2f} MB/sec'
+        )
+
     def do_show(self, arg):
         '''argument parser for viewing existing databases and tables'''
         if arg in ['dbs', 'databases']:
@@ -106,6 +175,11 @@ class DatabaseCLI(Cmd):
                 print(*self.tables, sep='\n')
             else:
                 print(f'Database not set. Please set database to use to view existing tables.')
+        elif arg == 'cache':
+            stats = utils.result_cache.statistics()
+            print(f'Result cache: {stats["hits"]} hits ({stats["memory_hits"]} from memory, {stats["disk_hits"]} from disk), {stats["misses"]} misses')
+            print(f'{stats["memory_results"]} results in memory ({stats["memory_bytes"] / 1024 / 1024:.2f} MB), '
+                  f'{stats["disk_results"]} results on disk ({stats["disk_bytes"] / 1024 / 1024:.2f} MB)')
             
     def do_use(self, arg):
         '''
@@ -118,9 +192,9 @@ class DatabaseCLI(Cmd):
             db_name = args[1]
             db_path = DATA_PATH / db_name
 
-            if os.path.exists(db_path):
+            if db_name in self.dbs:
                 self.current_db = db_path.stem
-                self.tables = [dir.stem for dir in list(db_path.iterdir())]
+                self.tables = utils.list_tables(self.current_db)
                 print(f'Using database: {self.current_db}')
             else:
                 print(f'Database {db_name} not found')
@@ -162,7 +236,7 @@ class DatabaseCLI(Cmd):
         args = arg.split()
         if args[0] in ['db', 'database']:
             try:
-                shutil.rmtree(DATA_PATH / args[1])
+                utils.drop_database(args[1])
                 self.dbs.remove(args[1])
                 if not (DATA_PATH / args[1]).exists():
                     print(f'Database {args[1]} successfully removed')
@@ -176,7 +250,7 @@ class DatabaseCLI(Cmd):
                 return
             else:
                 try:
-                    shutil.rmtree(DATA_PATH / self.current_db / args[1])
+                    utils.drop_table(database=self.current_db, table_name=args[1])
                     self.tables.remove(args[1])
                     if not (DATA_PATH / self.current_db / args[1]).exists():
                         print(f'Table {args[1]} successfully removed from {self.current_db}')
@@ -185,6 +259,27 @@ class DatabaseCLI(Cmd):
         else:
             print('Unrecognized command')
 
+    def do_compact(self, arg):
+        '''
+        argument parser to compact the partitions of a table
+        `compact table <table name>`
+        '''
+        args = arg.split()
+        if self.current_db is None:
+            print('Database not set. Please set a database before compacting a table')
+            return
+        if len(args) == 2 and args[0] == 'table':
+            if args[1] not in self.tables:
+                print(f'Error: {args[1]} not found')
+                return
+            try:
+                n_files, n_partitions = utils.compact_table(database=self.current_db, table_name=args[1])
+                print(f'Table {args[1]} compacted from {n_files} files into {n_partitions} partitions')
+            except Exception as e:
+                print(f'An exception occurred: {e}')
+        else:
+            print('Unrecognized command')
+
     def do_remove(self, arg):
         '''
         argument parser to remove rows from table given filter condition
@@ -203,29 +298,14 @@ class DatabaseCLI(Cmd):
                 query_dict[key] = ''
             else:
                 query_dict[key] += item.strip()
-        filter_str = query_dict['filter']
-        # replace and negate comparison operators with ', <op>',
-        filter_str = filter_str.replace(' gte', "', '<',")\
-            .replace(' eq', "', '!=',")\
-            .replace(' in', "', 'not in',")\
-            .replace(' nin', "', 'in',")\
-            .replace(' lte', "', '>',")\
-            .replace(' lt', "', '>=',")\
-            .replace(' gt', "', '<=',")\
-            .replace(' ne', "', '=',")
-        # replace all instance of '(' followed by letter to "'" separated
-        filter_str = re.sub(r'\((\w)', r"('\1", filter_str)
-        if isinstance(ast.literal_eval(filter_str)[0], str):
-            filters = [ast.literal_eval(filter_str)]
-        else:
-            filters = list(ast.literal_eval(filter_str))
+        filters = self.parse_filters(query_dict)
         try:
-            utils.drop_rows(
+            n_removed = utils.drop_rows(
                 database=self.current_db,
                 table_name=query_dict['from'],
                 filters=filters
             )
-            print('Rows successfully removed')
+            print(f'{n_removed} rows successfully removed')
         except Exception as e:
             print(f'An exception ocurred: {e}')
 
@@ -324,29 +404,35 @@ class DatabaseCLI(Cmd):
             return list(ast.literal_eval(filter_str))
     
     def parse_group_agg(self, query_dict):
-        '''parse the grouping and aggregation portion of query'''
-        group_col = query_dict['group'] if 'group' in query_dict.keys() else None
+        '''
+        parse the grouping and aggregation portion of query
+        group <column>, <column> agg <function>(<column>), <function>(<column>)
+        returns the list of grouping columns and a list of (function, column) aggregates
+        '''
+        group_cols = [col.strip() for col in query_dict['group'].split(',')] if 'group' in query_dict.keys() else []
         if 'agg' in query_dict.keys():
-            agg_vals = re.findall(r'([a-zA-Z]+)\((.*)\)', query_dict['agg'])[0]
-            agg_col = agg_vals[1]
-            agg_func = agg_vals[0]
+            aggs = re.findall(r'([a-zA-Z_]+)\(([^)]*)\)', query_dict['agg'])
+            aggs = [(func, col.strip()) for func, col in aggs]
         else:
-            agg_col, agg_func = None, None
-        return group_col, agg_col, agg_func
+            aggs = []
+        return group_cols, aggs
     
     def parse_sort(self, query_dict):
         '''
         parse the sort column of query
         supports only 1 column
-        support sorting ascending and descending
+        support sorting ascending and descending, with null values last (default) or first
+        sort <column> / sort rev <column> / sort <column> nulls first
         '''
         if 'sort' not in query_dict.keys():
-            return None, False
+            return None, False, False
+        sort_str = query_dict['sort']
+        nulls_first = 'nulls first' in sort_str
+        sort_str = sort_str.replace('nulls first', '').replace('nulls last', '').strip()
+        if ('rev' or 'reverse') in sort_str:
+            return sort_str.replace('reverse', '').replace('rev', '').strip(), True, nulls_first
         else:
-            if ('rev' or 'reverse') in query_dict['sort']:
-                return query_dict['sort'].replace('reverse', '').replace('rev', '').strip(), True
-            else:
-                return query_dict['sort'], False
+            return sort_str, False, nulls_first
         
     
     def parse_projection(self, query_dict):
@@ -365,17 +451,15 @@ class DatabaseCLI(Cmd):
                     new_col_names.append(s[0])
             return [selected_cols, new_col_names]
             
-    def do_query(self, arg):
+    def parse_query(self, arg):
         '''
-        function to parse query arguments and execute query logic
+        parse and check the arguments of a query
+        returns the keyword arguments of utils.execute_query / utils.plan_query, or None if the query is invalid
         '''
-        start_time = time.time()
-        if self.current_db is None:
-            print('No database selected. Please use the "use" command to select a database')
-            return
         # list of query keywords to parse from input argument string
         keywords = [
             'gimme',
+            'distinct',
             'from',
             'filter',
             'group',
@@ -385,7 +469,8 @@ class DatabaseCLI(Cmd):
             'trunc',
             'skip'
         ]
-        pattern = r'({})'.format('|'.join(map(re.escape, keywords)))
+        # whole words only, so that e.g. count_distinct(x) is not split
+        pattern = r'\b({})\b'.format('|'.join(map(re.escape, keywords)))
         result = list(filter(None, re.split(pattern, arg)))
         # construct dictionary to hold all query arguments
         query_dict, key = {}, None
@@ -397,9 +482,9 @@ class DatabaseCLI(Cmd):
                 query_dict[key] += item.strip()
         table_name, join_table_name, join_col = self.parse_from_join(query_dict)
         filters = self.parse_filters(query_dict)
-        group_col, agg_col, agg_func = self.parse_group_agg(query_dict)
+        group_cols, aggs = self.parse_group_agg(query_dict)
         group_filter = self.parse_filters(query_dict, group=True)
-        sort_col, reverse = self.parse_sort(query_dict)
+        sort_col, reverse, nulls_first = self.parse_sort(query_dict)
         columns = self.parse_projection(query_dict)
 
         offset = ast.literal_eval(query_dict['skip']) if 'skip' in query_dict.keys() else None
@@ -413,106 +498,159 @@ class DatabaseCLI(Cmd):
             print(f'Error: {join_table_name} not found')
             return
 
-        valid_agg_funcs = ['sum', 'min', 'max', 'count', 'average']
-        if agg_func is not None and agg_func not in valid_agg_funcs:
-            print(f'Error: {agg_func} is not a valid aggregate function. Valid aggregate functions are: {valid_agg_funcs}')
-            return
+        valid_agg_funcs = ['sum', 'min', 'max', 'count', 'average', 'count_distinct', 'approx_count_distinct']
+        for agg_func, _ in aggs:
+            if agg_func not in valid_agg_funcs:
+                print(f'Error: {agg_func} is not a valid aggregate function. Valid aggregate functions are: {valid_agg_funcs}')
+                return
         
-        if group_col and agg_col and agg_func:
+        if len(aggs):
+            output_cols = group_cols + [utils.agg_name(agg_func, agg_col) for agg_func, agg_col in aggs]
             if len(group_filter):
-                if group_filter[0][0] not in [group_col, f'{agg_func}({agg_col})']:
+                if group_filter[0][0] not in output_cols:
                     print('Group filter must be applied to grouping column or aggregate column.')
                     return
             if len(columns):
                 for col in columns[0]:
-                    if col not in [group_col, f'{agg_func}({agg_col})']:
+                    if col not in output_cols:
                         print('Error: columns in projection must either be the grouping column or the aggregated column')
                         return
                 if sort_col is not None and sort_col not in columns[1]:
                     print('Error: if sort column is given an alias, must pass the alias to the sort clause')
                     return
+        return dict(
+            table_name=table_name,
+            join_table_name=join_table_name,
+            join_col=join_col,
+            filters=filters,
+            group_cols=group_cols,
+            aggs=aggs,
+            columns=columns,
+            distinct='distinct' in query_dict.keys(),
+            group_filter=group_filter,
+            sort_col=sort_col,
+            reverse=reverse,
+            nulls_first=nulls_first,
+            limit=limit,
+            offset=offset
+        )
+
+    def do_query(self, arg):
+        '''
+        function to parse query arguments and execute query logic
+        '''
+        start_time = time.time()
+        if self.current_db is None:
+            print('No database selected. Please use the "use" command to select a database')
+            return
+        query = self.parse_query(arg)
+        if query is None:
+            return
         # query execution
         try:
             # generate random query id for every query
             query_id = 'query_' + datetime.datetime.now().strftime("%y%m%d_%H%M%S") 
             query_path = Path(TEMP_DB_PATH / query_id)
 
-            result_dataset = utils.execute_query(
-                database=self.current_db,
-                table_name=table_name,
-                query_path=query_path,
-                query_id=query_id,
-                join_table_name=join_table_name,
-                join_col=join_col,
-                filters=filters,
-                group_col=group_col,
-                columns=columns,
-                agg_col=agg_col,
-                agg_func=agg_func,
-                group_filter=group_filter,
-                sort_col=sort_col,
-                reverse=reverse
-            )
-            n_rows = result_dataset.count_rows()
-            n_cols = len(result_dataset.schema.names)
-            # if no limit/offset return head of first partition and tail of last partition, as much as can be read into memory
-            if offset is None and limit is None:
-                print(f'{n_rows} rows\t{n_cols} columns')
-                # if dataset is only 1 file, read first partition
-                if len(result_dataset.files) == 1:
-                    print(pl.read_parquet(result_dataset.files[0]))
-                else:
-                    tail_nrows = pq.ParquetFile(result_dataset.files[-1]).metadata.num_rows
-                    data_tail = pl.read_parquet(result_dataset.files[-1]).tail(-tail_nrows//2)
-
-                    head_nrows = pq.ParquetFile(result_dataset.files[0]).metadata.num_rows
-                    data_head = pl.read_parquet(result_dataset.files[0], n_rows=head_nrows)
-
-                    print(pl.concat([data_head, data_tail]))
-            else:
-                if offset is None:
-                    offset = 0
-                if limit is None:
-                    limit = result_dataset.count_rows()
-                files_dict = {}
-                cumulative_sum = 0
-                for i, file in enumerate(result_dataset.files):
-                    previous_sum = files_dict.get(result_dataset.files[i-1], (0, 0))[1] + 1 if i > 0 else 0
-                    cumulative_sum += pq.ParquetFile(file).metadata.num_rows
-                    files_dict[file] = (previous_sum, cumulative_sum)
-
-                filtered_files = list(files_dict.keys())
-                for file in files_dict.keys():
-                    if offset and files_dict[file][1] <= offset:
-                        filtered_files.remove(file)
-                    if limit and files_dict[file][0] >= offset + limit and file in filtered_files:
-                        filtered_files.remove(file)
-
-                files_dict = {key: val for key, val in files_dict.items() if key in filtered_files}
-
-                print(f'{offset + limit} rows\t{n_cols} columns')
-                if len(files_dict) == 1:
-                    path = sorted(files_dict.keys(), key=lambda x: int(Path(x).stem.split('_')[-1]))[0]
-                    data = pl.read_parquet(path).tail(-(offset - files_dict[path][1])).head(limit)
-                    print(data)
-                else:
-                    head_path = sorted(files_dict.keys(), key=lambda x: int(Path(x).stem.split('_')[-1]))[0]
-                    tail_path = sorted(files_dict.keys(), key=lambda x: int(Path(x).stem.split('_')[-1]))[-1]
-
-                    # first read in from tail: the first (offset + length) - files_dict[tail_path][0] number of rows
-                    # then take the difference between head_nrows and n_rows read from tail_nrows and read in head
-                    tail_nrows = (offset + limit) - files_dict[tail_path][0]
-                    head_nrows = pq.ParquetFile(head_path).metadata.num_rows - tail_nrows
-
-                    data = pl.read_parquet(head_path, n_rows=head_nrows)
-                    data = data.extend(pl.read_parquet(tail_path, n_rows=tail_nrows))
-                    print(data)
+            partitions = utils.execute_query(database=self.current_db, query_path=query_path, **query)
+            self.print_result(partitions, windowed=query['limit'] is not None or query['offset'] is not None)
         finally:
             shutil.rmtree(query_path, ignore_errors=True)
             end_time = time.time()
             elapsed_time = end_time - start_time
             print(f'Elapsed time: {elapsed_time:.4f} seconds')
 
+    def do_explain(self, arg):
+        '''
+        print the plan of a query without running it: its operators with their estimated rows, bytes and memory
+        `explain query <query>`
+        or run the query and print what each operator took: time, rows in and out, bytes read and spilled, files pruned
+        `explain analyze query <query>`
+        '''
+        if self.current_db is None:
+            print('No database selected. Please use the "use" command to select a database')
+            return
+        analyze = arg.startswith('analyze ')
+        if analyze:
+            arg = arg[len('analyze '):]
+        if not arg.startswith('query '):
+            print('Unrecognized command')
+            return
+        query = self.parse_query(arg[len('query '):])
+        if query is None:
+            return
+        query_id = 'query_' + datetime.datetime.now().strftime("%y%m%d_%H%M%S")
+        query_path = Path(TEMP_DB_PATH / query_id)
+        try:
+            plan = utils.plan_query(database=self.current_db, **query)
+            if not analyze:
+                print(utils.format_plan(plan))
+                return
+            # the query runs through the plan, not the result cache, so that every operator is measured
+            profile = utils.QueryProfile(plan)
+            n_rows = sum(data.num_rows for data, _ in utils.execute_plan(plan, query_path, profile=profile))
+            print(f'{n_rows} rows')
+            print(utils.format_plan(plan, profile))
+        except Exception as e:
+            print(f'An error occurred: {e}')
+        finally:
+            shutil.rmtree(query_path, ignore_errors=True)
+
+    def do_analyze(self, arg):
+        '''
+        collect the statistics of a table used to plan queries
+        `analyze table <table name>`
+        '''
+        args = arg.split()
+        if self.current_db is None:
+            print('Database not set. Please set a database before analyzing a table')
+            return
+        if len(args) == 2 and args[0] == 'table':
+            if args[1] not in self.tables:
+                print(f'Error: {args[1]} not found')
+                return
+            try:
+                stats = utils.analyze_table(database=self.current_db, table_name=args[1])
+                print(f'Table {args[1]} analyzed: {stats["rows"]} rows')
+                print(pl.DataFrame({
+                    'column': list(stats['columns']),
+                    'distinct': [col['distinct'] for col in stats['columns'].values()],
+                    'min': [str(col['min']) for col in stats['columns'].values()],
+                    'max': [str(col['max']) for col in stats['columns'].values()],
+                    'null_fraction': [col['null_fraction'] for col in stats['columns'].values()]
+                }))
+            except Exception as e:
+                print(f'An error occurred: {e}')
+        else:
+            print('Unrecognized command')
+
+    def print_result(self, partitions, windowed=False):
+        '''
+        print the result partitions of a query as they stream from the query pipeline
+        without limit/offset: the row count, then the head of the first partition and tail of the last partition
+        with limit/offset (windowed): all rows, the query pipeline only returns the rows in the requested range
+        '''
+        if not windowed:
+            first, last, n_rows = None, None, 0
+            for data, _ in partitions:
+                if first is None:
+                    first = data
+                else:
+                    last = data
+                n_rows += data.num_rows
+            print(f'{n_rows} rows\t{first.num_columns} columns')
+            # if result is only 1 partition, print first partition
+            if last is None:
+                print(pl.from_arrow(first))
+            else:
+                data_tail = pl.from_arrow(last).tail(-last.num_rows//2)
+                data_head = pl.from_arrow(first)
+                print(pl.concat([data_head, data_tail]))
+        else:
+            data = pl.from_arrow(pa.concat_tables(data for data, _ in partitions))
+            print(f'{data.height} rows\t{data.width} columns')
+            print(data)
+
     def do_copy(self, arg):
         """
         Usage: copy (query ...) to 'output.csv'
@@ -522,73 +660,38 @@ class DatabaseCLI(Cmd):
             print('No database selected. Please use the "use" command to select a database')
             return
 
-        query_pattern = re.compile(r'\((.*)\)')
-        query_str = query_pattern.search(arg).group(1).strip()
-        query_str = query_str.replace('query ', '')
-        output_pattern = re.compile(r"to '([^']+\.csv)'")
-        output_path = Path(output_pattern.search(arg).group(1))
-
-        keywords = [
-            'gimme',
-            'from',
-            'filter',
-            'group',
-            'agg',
-            'grpfilt',
-            'sort',
-            'trunc',
-            'skip'
-        ]
-        pattern = r'({})'.format('|'.join(map(re.escape, keywords)))
-        result = list(filter(None, re.split(pattern, query_str)))
-        query_dict, key = {}, None
-        for item in result:
-            if item in keywords:
-                key = item
-                query_dict[key] = ''
-            else:
-                query_dict[key] += item.strip()
-        table_name, join_table_name, join_col = self.parse_from_join(query_dict)
-        filters = self.parse_filters(query_dict)
-        group_col, agg_col, agg_func = self.parse_group_agg(query_dict)
-        sort_col, reverse = self.parse_sort(query_dict)
-        columns = self.parse_projection(query_dict)
+        match = re.fullmatch(r"\(\s*query\s+(.+)\)\s+to\s+'([^']+\.csv)'", arg.strip())
+        if match is None:
+            print("Invalid input. Please use: copy (query ...) to 'output.csv'")
+            return
+        output_path = Path(match.group(2))
+        if output_path.exists():
+            print(f'File {output_path} already exists.')
+            return
+        query = self.parse_query(match.group(1))
+        if query is None:
+            return
+        query_id = 'query_' + datetime.datetime.now().strftime("%y%m%d_%H%M%S")
+        query_path = Path(TEMP_DB_PATH / query_id)
         try:
-            query_id = 'query_' + datetime.datetime.now().strftime("%y%m%d_%H%M%S") 
-            query_path = Path(TEMP_DB_PATH / query_id)
-
-            result_dataset = utils.execute_query(
-                database=self.current_db,
-                table_name=table_name,
-                query_path=query_path,
-                query_id=query_id,
-                join_table_name=join_table_name,
-                join_col=join_col,
-                filters=filters,
-                group_col=group_col,
-                columns=columns,
-                agg_col=agg_col,
-                agg_func=agg_func,
-                sort_col=sort_col,
-                reverse=reverse
-            )
-            if not output_path.exists():
-                output_path.touch()
-            else:
-                print(f'File {output_path} already exists.')
-                return
-            with csv.CSVWriter(output_path, result_dataset.schema) as writer:
-                for file in result_dataset.files:
-                        table = pq.read_table(file)
-                        writer.write_table(table)
+            partitions = utils.execute_query(database=self.current_db, query_path=query_path, **query)
+            writer = None
+            for table, _ in partitions:
+                if writer is None:
+                    writer = csv.CSVWriter(output_path, table.schema)
+                writer.write_table(table)
+            writer.close()
+        except Exception as e:
+            output_path.unlink(missing_ok=True)
+            print(f'An error occurred: {e}')
         finally:
             shutil.rmtree(query_path, ignore_errors=True)
 
-
-
     def do_exit(self, arg):
         """Exit the CLI."""
         temp_dir = DATA_PATH / 'temp'
+        if self.compactor is not None:
+            self.compactor.set()
         try:
             # Clear the contents of the directory
             for filename in temp_dir.glob('*'):
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 from sys import platform
 
@@ -5,4 +6,28 @@ home = Path.home()
 DATA_PATH = Path(home / 'miggydb')
 TEMP_DB_PATH = Path(DATA_PATH / 'temp')
 
-MAX_PARTITION_SIZE = 100 * 1024 * 1024
\ No newline at end of file
+MAX_PARTITION_SIZE = 100 * 1024 * 1024
+INGEST_BLOCK_SIZE = 16 * 1024 * 1024 # bytes of input parsed per batch when ingesting files
+INGEST_WORKERS = os.cpu_count() or 1 # worker processes used to ingest multiple files in parallel
+DELTA_MERGE_THRESHOLD = 64 # number of insert delta files after which they are folded into the base partitions
+
+AUTO_COMPACT = False # compact fragmented tables in a background thread
+COMPACT_INTERVAL = 300 # seconds between background compaction passes
+COMPACT_MIN_FILES = 4 # number of surplus partition and delta files that makes a table worth compacting
+
+MEMORY_BUDGET = 100 * 1024 * 1024 # bytes an operator may hold in memory before it spills to disk
+SPILL_PARTITIONS = 16 # number of hash partitions an operator spills to once it exceeds MEMORY_BUDGET
+QUERY_MEMORY_BUDGET = MEMORY_BUDGET # bytes all operators of a query may hold in memory together
+
+DISTINCT_SKETCH_SIZE = 1024 # number of smallest value hashes analyze keeps per column to estimate its distinct values
+HYPERLOGLOG_PRECISION = 12 # approx_count_distinct keeps 2 ** HYPERLOGLOG_PRECISION registers per group, for about 1.6% error (at least 12)
+QUERY_WORKERS = os.cpu_count() or 1 # worker threads queries and amends process partitions on, 1 processes them in the calling thread
+
+RESULT_CACHE = True # reuse the results of repeated queries on tables that have not changed since
+RESULT_CACHE_PATH = Path(DATA_PATH / '_cache')
+RESULT_CACHE_MEMORY_SIZE = 64 * 1024 * 1024 # bytes of query results cached in memory, least recently used ones move to disk
+RESULT_CACHE_DISK_SIZE = 1024 * 1024 * 1024 # bytes of query results cached on disk, least recently used ones are removed
+
+INDEX_JOIN_MAX_KEYS = 10000 # largest estimated number of rows on the small side of a join that is looked up in an index of the other side
+BLOOM_FALSE_POSITIVE_RATE = 0.01 # share of lookups of absent values a bloom filter lets through
+RUNTIME_JOIN_FILTERS = True # filter the scan of the second side of a join by the keys of the side read first
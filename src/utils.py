@@ -2,16 +2,28 @@ import pyarrow as pa
 import pyarrow.parquet as pq
 import pyarrow.dataset as ds
 import pyarrow.compute as pc
-import csv
+import pyarrow.csv as pa_csv
+import pyarrow.json as pa_json
 import json
+import ast
 import os
-from subprocess import check_output
-import subprocess
+import io
+import codecs
+import re
+import itertools
+import contextlib
+import heapq
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque, OrderedDict
+import hashlib
 from pathlib import Path
-import ast
 import shutil
+import tempfile
+import time
 
 import polars as pl
+import numpy as np
 import math
 
 from .config import *
@@ -26,65 +38,458 @@ def dataset_sort_key(path):
     '''sorting key for pyarrow.dataset data files'''
     return int(Path(path).stem.split('_')[-1])
 
-def wc(path):
-    '''word count utility for JSON ingesting'''
-    return int(check_output(['wc', '-l', path]).split()[0])
+TABLE_LOCKS = {}
+TABLE_LOCKS_GUARD = threading.Lock()
+
+def table_lock(database, table_name):
+    '''Reentrant lock held by the writes of a table and by reads while they snapshot its files, so the compactor never swaps files in use'''
+    with TABLE_LOCKS_GUARD:
+        return TABLE_LOCKS.setdefault((database, table_name), threading.RLock())
+
+def parallel_map(func, items, workers=None):
+    '''Applies func to the items of an iterable on worker threads (QUERY_WORKERS by default), yielding the results in order'''
+    workers = workers or QUERY_WORKERS
+    if workers <= 1:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while len(pending):
+            yield pending.popleft().result()
+
+def write_json_atomic(path, data):
+    '''Writes data as JSON to a temporary file next to path and renames it over path, so readers see either the old or the new file'''
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+# Catalog and table manifests
+
+MANIFEST_NAME = '_manifest.json'
+DELTA_LOG_NAME = '_delta_log.jsonl'
+CATALOG_NAME = '_catalog.json'
+CATALOG_LOCK = threading.RLock()
+
+def read_catalog(database=None):
+    '''Names in the catalog of DATA_PATH (the databases) or of a database (its tables), built from the directory listing if missing'''
+    path = DATA_PATH / database if database is not None else DATA_PATH
+    with CATALOG_LOCK:
+        if (path / CATALOG_NAME).exists():
+            with open(path / CATALOG_NAME) as file:
+                return json.load(file)
+        names = sorted(
+            entry.name for entry in path.iterdir()
+            if entry.is_dir() and entry != TEMP_DB_PATH and not entry.name.startswith(('.', '_'))
+        )
+        write_json_atomic(path / CATALOG_NAME, names)
+        return names
+
+def update_catalog(database=None, add=None, remove=None):
+    '''Adds a name to or removes a name from the catalog of DATA_PATH or of a database'''
+    path = DATA_PATH / database if database is not None else DATA_PATH
+    with CATALOG_LOCK:
+        names = [name for name in read_catalog(database) if name != remove]
+        if add is not None and add not in names:
+            names.append(add)
+        write_json_atomic(path / CATALOG_NAME, names)
+
+def list_databases():
+    '''Names of the databases, read from the catalog'''
+    return read_catalog()
+
+def list_tables(database):
+    '''Names of the tables of a database, read from its catalog'''
+    return read_catalog(database)
+
+def create_database(database):
+    '''Creates a database directory and adds it to the catalog'''
+    Path.mkdir(DATA_PATH / database)
+    update_catalog(add=database)
+
+def drop_database(database):
+    '''Removes a database and all of its tables, and the cached results of queries on them'''
+    shutil.rmtree(DATA_PATH / database)
+    update_catalog(remove=database)
+    result_cache.invalidate(database)
+
+def drop_table(database, table_name):
+    '''Removes a table, its manifest and the cached results of queries on it, and a view from the manifests of the tables it reads'''
+    manifest = read_manifest(database, table_name)
+    for source in manifest.get('view', {}).get('sources', []):
+        with table_lock(database, source):
+            if (DATA_PATH / database / source / MANIFEST_NAME).exists():
+                source_manifest = read_manifest(database, source)
+                source_manifest['views'] = [view for view in source_manifest.get('views', []) if view != table_name]
+                write_manifest(DATA_PATH / database / source, source_manifest)
+    with table_lock(database, table_name):
+        shutil.rmtree(DATA_PATH / database / table_name)
+        update_catalog(database, remove=table_name)
+        result_cache.invalidate(database, table_name)
+
+def json_statistics(stats):
+    '''Partition statistics with the min/max values JSON can not hold (dates, decimals, bytes) replaced by None'''
+    def safe(value):
+        return value if isinstance(value, (bool, int, float, str)) else None
+    return {col: [safe(col_min), safe(col_max), null_count] for col, (col_min, col_max, null_count) in stats.items()}
+
+def file_entry(path, deleted=0):
+    '''Manifest entry of a partition or delta file, from its parquet footer and size on disk'''
+    path = Path(path)
+    return {
+        'file': path.name,
+        'rows': pq.ParquetFile(path).metadata.num_rows,
+        'bytes': os.path.getsize(path),
+        'deleted': deleted,
+        'stats': json_statistics(partition_statistics(path))
+    }
+
+def build_manifest(table_path, version=0):
+    '''Builds the manifest of the partition files under table_path from their footers, in partition number order'''
+    table_path = Path(table_path)
+    partitions = sorted(table_path.glob('*.parquet'), key=dataset_sort_key)
+    if not len(partitions):
+        raise FileNotFoundError(f'Table {table_path.name} not found')
+    deltas = sorted((table_path / '_delta').glob('*.parquet'), key=dataset_sort_key)
+
+    def deleted(partition):
+        path = deletion_vector_path(partition)
+        return pq.ParquetFile(path).metadata.num_rows if path.exists() else 0
+
+    return {
+        'version': version,
+        'schema': pq.read_schema(partitions[0]).serialize().to_pybytes().hex(),
+        'partitions': [file_entry(partition, deleted(partition)) for partition in partitions],
+        'deltas': [file_entry(delta) for delta in deltas],
+        'next_partition': dataset_sort_key(partitions[-1]) + 1,
+        'next_delta': dataset_sort_key(deltas[-1]) + 1 if len(deltas) else 0
+    }
+
+def write_manifest(table_path, manifest):
+    '''Atomically replaces the manifest of a table, bumping its version, once its indexes are up to date'''
+    sync_indexes(table_path, manifest)
+    sync_bloom_filters(table_path, manifest)
+    manifest['version'] += 1
+    write_json_atomic(Path(table_path) / MANIFEST_NAME, manifest)
+    (Path(table_path) / DELTA_LOG_NAME).unlink(missing_ok=True)
+    remove_unlisted_indexes(table_path, manifest)
+
+def append_delta_log(table_path, manifest, entry):
+    '''Records a new delta file of a table in its delta log and in manifest, instead of rewriting the manifest'''
+    manifest['deltas'].append(entry)
+    manifest['next_delta'] += 1
+    manifest['version'] += 1
+    path = Path(table_path) / DELTA_LOG_NAME
+    torn = False
+    if path.exists() and path.stat().st_size:
+        with open(path, 'rb') as file:
+            file.seek(-1, os.SEEK_END)
+            torn = file.read(1) != b'\n'
+    with open(path, 'a') as file:
+        file.write(('\n' if torn else '') + json.dumps({'version': manifest['version'], 'delta': entry}) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+def apply_delta_log(table_path, manifest):
+    '''Adds the delta files recorded in the delta log of a table after its manifest was written to the manifest'''
+    path = Path(table_path) / DELTA_LOG_NAME
+    if not path.exists():
+        return manifest
+    with open(path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError: # a line cut short by a crash, its delta file was never recorded
+                continue
+            if record['version'] > manifest['version']:
+                manifest['deltas'].append(record['delta'])
+                manifest['next_delta'] = max(manifest['next_delta'], dataset_sort_key(record['delta']['file']) + 1)
+                manifest['version'] = record['version']
+    return manifest
+
+def read_manifest(database, table_name):
+    '''Manifest of a table: schema, partition and delta files with their row counts and statistics, and version'''
+    table_path = DATA_PATH / database / table_name
+    with table_lock(database, table_name):
+        if not (table_path / MANIFEST_NAME).exists():
+            write_manifest(table_path, build_manifest(table_path))
+        with open(table_path / MANIFEST_NAME) as file:
+            return apply_delta_log(table_path, json.load(file))
+
+def manifest_schema(manifest):
+    '''pyarrow schema of a table from its manifest'''
+    return pa.ipc.read_schema(pa.py_buffer(bytes.fromhex(manifest['schema'])))
+
+def manifest_row_count(manifest):
+    '''Number of live rows of a table from its manifest: partition rows not deleted, plus delta rows'''
+    return sum(entry['rows'] - entry['deleted'] for entry in manifest['partitions']) + sum(entry['rows'] for entry in manifest['deltas'])
+
+def manifest_bytes(manifest):
+    '''On-disk size of the partition and delta files of a table from its manifest'''
+    return sum(entry['bytes'] for entry in manifest['partitions'] + manifest['deltas'])
+
+def register_table(database, table_name, view=None):
+    '''Writes the manifest of a newly created table (or of a view, with its definition) and adds it to the catalog of its database'''
+    table_path = DATA_PATH / database / table_name
+    manifest = build_manifest(table_path)
+    manifest['created'] = time.time_ns()
+    if view is not None:
+        manifest['view'] = view
+    write_manifest(table_path, manifest)
+    update_catalog(database, add=table_name)
 
 # Create
 
-def create_table_from_csv(path, database, table_name=None):
-    '''Create a new table in the database system from input csv file. Processes it in 100 MB chunks'''
+def write_partitions(batches, table_path, table_name, schema, start=0):
+    '''Writes batches to <table_name>_<n>.parquet files from n = start, rolling over at MAX_PARTITION_SIZE. Returns (partitions, rows)'''
+    n, n_rows = start, 0
+    sink, writer = None, None
+    try:
+        for batch in batches:
+            if writer is None:
+                sink = pa.OSFile(str(Path(table_path) / f'{table_name}_{n}.parquet'), 'wb')
+                writer = pq.ParquetWriter(sink, schema)
+            writer.write(batch)
+            n_rows += batch.num_rows
+            if sink.tell() >= MAX_PARTITION_SIZE:
+                writer.close()
+                sink.close()
+                writer = None
+                n += 1
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            sink.close()
+        raise
+    if writer is not None:
+        writer.close()
+        sink.close()
+        n += 1
+    elif n == start:
+        pq.write_table(schema.empty_table(), Path(table_path) / f'{table_name}_{n}.parquet')
+        n += 1
+    return n - start, n_rows
+
+@contextlib.contextmanager
+def ingest_table_path(database, table_name):
+    '''Directory of a table about to be created by an ingest, removed again if the ingest fails'''
+    table_path = Path(DATA_PATH / database / table_name)
+    if table_path.exists():
+        raise ValueError(f'Table {table_name} already exists')
+    Path.mkdir(table_path)
+    try:
+        yield table_path
+    except BaseException:
+        shutil.rmtree(table_path, ignore_errors=True)
+        raise
+
+def ingest_stats(n_rows, n_bytes, n_partitions, start_time):
+    '''Throughput statistics of a file ingest'''
+    elapsed = max(time.time() - start_time, 1e-9)
+    return {
+        'rows': n_rows,
+        'bytes': n_bytes,
+        'partitions': n_partitions,
+        'seconds': elapsed,
+        'rows_per_sec': n_rows / elapsed,
+        'bytes_per_sec': n_bytes / elapsed
+    }
+
+def ingest_csv(path, table_path, table_name, schema=None):
+    '''Streams a csv file into partitions under table_path in one pass, widening drifting column types. Returns (partitions, rows)'''
+    explicit = dict(zip(schema.names, schema.types)) if isinstance(schema, pa.Schema) else dict(schema or {})
+    column_types = dict(explicit)
+    while True:
+        reader = pa_csv.open_csv(
+            path,
+            read_options=pa_csv.ReadOptions(block_size=INGEST_BLOCK_SIZE),
+            convert_options=pa_csv.ConvertOptions(column_types=column_types)
+        )
+        nulls = [field.name for field in reader.schema if pa.types.is_null(field.type) and field.name not in explicit]
+        if len(nulls):
+            column_types.update({name: pa.string() for name in nulls})
+            continue
+        try:
+            return write_partitions(reader, table_path, table_name, reader.schema)
+        except pa.ArrowInvalid as e:
+            match = re.match(r'In CSV column #(\d+):.* CSV conversion error', str(e))
+            field = reader.schema.field(int(match.group(1))) if match is not None else None
+            if field is None or field.name in explicit:
+                raise
+            wider = pa.float64() if pa.types.is_integer(field.type) else pa.string()
+            column_types[field.name] = merge_schemas(pa.schema([field]), pa.schema([pa.field(field.name, wider)])).field(0).type
+            for partition in Path(table_path).glob(f'{table_name}_*.parquet'):
+                partition.unlink()
+
+def create_table_from_csv(path, database, table_name=None, schema=None):
+    '''Create a new table in the database system from input csv file in a single streaming pass. Returns ingest statistics'''
+    start_time = time.time()
     if table_name is None:
         table_name = os.path.splitext(os.path.basename(path))[0]
-    table_path = Path(DATA_PATH / database / table_name)
-    if not table_path.exists():
-        Path.mkdir(table_path)
+    with ingest_table_path(database, table_name) as table_path:
+        n_partitions, n_rows = ingest_csv(path, table_path, table_name, schema=schema)
+        register_table(database, table_name)
+    return ingest_stats(n_rows, os.path.getsize(path), n_partitions, start_time)
 
-    total_rows = wc(path)
-    n_partitions = math.ceil(os.path.getsize(path) / MAX_PARTITION_SIZE) ## TODO verify this makes 100 MB chunks
-    n_rows = int(total_rows / n_partitions)
+def merge_schemas(schema, other):
+    '''Merges two schemas field by field, promoting types where pyarrow can and falling back to str otherwise'''
+    if schema is None:
+        return other
+    fields = {field.name: field for field in schema}
+    for field in other:
+        if field.name not in fields:
+            fields[field.name] = field
+        elif not fields[field.name].type.equals(field.type):
+            try:
+                fields[field.name] = pa.unify_schemas(
+                    [pa.schema([fields[field.name]]), pa.schema([field])], promote_options='permissive'
+                ).field(0)
+            except (pa.ArrowTypeError, pa.ArrowInvalid):
+                fields[field.name] = pa.field(field.name, pa.string())
+    return pa.schema(list(fields.values()))
 
-    for i in range(0, n_partitions):
-        skip_rows_after_header = n_rows * i
-        data = pl.read_csv(path, n_rows=n_rows, skip_rows_after_header=skip_rows_after_header)
-        name = f'{table_name}_{str(i)}.parquet'
-        data.write_parquet(os.path.join(table_path, name))
+def conform_to_schema(data, schema):
+    '''Casts a table or record batch to schema, filling columns it does not have with nulls'''
+    columns = [
+        data.column(field.name).cast(field.type) if field.name in data.schema.names else pa.nulls(data.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
 
-def create_table_from_json(path, database, table_name=None):
-    '''Create a new table in the database system from input json file'''
-    # check if JSON file is newline-delimited:
-    if wc(path) == 0:
+def unify_partitions(table_path, schema):
+    '''Rewrites the partitions under table_path whose schema differs from schema. Partitions that already match are left as is'''
+    for partition in sorted(Path(table_path).glob('*.parquet'), key=dataset_sort_key):
+        if not pq.read_schema(partition).equals(schema):
+            pq.write_table(conform_to_schema(pq.read_table(partition), schema), partition)
+
+def read_json_blocks(path):
+    '''Streams a newline-delimited JSON file or a JSON array, one pyarrow table per INGEST_BLOCK_SIZE bytes'''
+    with open(path, 'rb') as file:
+        head = file.read(1024).lstrip()
+        file.seek(0)
+        if head.startswith(b'['):
+            yield from read_json_array_blocks(file)
+            return
+        while True:
+            block = file.read(INGEST_BLOCK_SIZE)
+            if not block:
+                break
+            block += file.readline() # complete the last record of the block
+            if not block.strip():
+                continue
+            yield pa_json.read_json(io.BytesIO(block), read_options=pa_json.ReadOptions(block_size=len(block) + 1))
+
+def read_json_array_blocks(file):
+    '''Incrementally decodes the records of a top-level JSON array without loading the whole file. Used by read_json_blocks'''
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    separators = re.compile(r'[\s,]*')
+    buffer = decode(file.read(INGEST_BLOCK_SIZE))
+    pos = buffer.index('[') + 1
+    records, n_bytes, eof = [], 0, False
+    while True:
+        pos = separators.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            break
         try:
-            subprocess.run(f'cat {path} | jq -c \'.[]\' > {path}', shell=True, check=True) # overwrite file with newline-delimited file
-        except subprocess.CalledProcessError as e:
-            print(f'Command failed with exit code: {e.returncode}')
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = file.read(INGEST_BLOCK_SIZE)
+            eof = not chunk
+            buffer = buffer[pos:] + decode(chunk, final=eof)
+            pos = 0
+            continue
+        records.append(record)
+        n_bytes += end - pos
+        pos = end
+        if n_bytes >= INGEST_BLOCK_SIZE:
+            yield pa.Table.from_batches([pa.RecordBatch.from_struct_array(pa.array(records))])
+            records, n_bytes = [], 0
+    if records:
+        yield pa.Table.from_batches([pa.RecordBatch.from_struct_array(pa.array(records))])
+
+def ingest_json(path, table_path, table_name):
+    '''Streams a JSON file into partitions under table_path, merging the schema across all records. Returns (partitions, rows)'''
+    def merged_blocks():
+        schema = None
+        for block in read_json_blocks(path):
+            schema = merge_schemas(schema, block.schema)
+            yield schema, block
+
+    n_partitions, n_rows, schema = 0, 0, None
+    for schema, blocks in itertools.groupby(merged_blocks(), key=lambda x: x[0]):
+        n, rows = write_partitions(
+            (conform_to_schema(block, schema) for _, block in blocks), table_path, table_name, schema, start=n_partitions
+        )
+        n_partitions += n
+        n_rows += rows
+    if schema is None:
+        raise ValueError(f'{path} does not contain any JSON records')
+    unify_partitions(table_path, schema)
+    return n_partitions, n_rows
+
+def create_table_from_json(path, database, table_name=None):
+    '''Create a new table in the database system from input json file in a single streaming pass. Returns ingest statistics'''
+    start_time = time.time()
     if table_name is None:
         table_name = os.path.splitext(os.path.basename(path))[0]
-    table_path = Path(DATA_PATH / database / table_name)
-    if not table_path.exists():
-        Path.mkdir(table_path)
+    with ingest_table_path(database, table_name) as table_path:
+        n_partitions, n_rows = ingest_json(path, table_path, table_name)
+        register_table(database, table_name)
+    return ingest_stats(n_rows, os.path.getsize(path), n_partitions, start_time)
 
-    # first write to csv, as JSON is much larger than csv due to repeated headers for each line
-    output_csv_path = table_path / 'output.csv'
-    if not output_csv_path.exists():
-        Path.touch(output_csv_path)
-    
-    with open(output_csv_path, 'w', newline='') as csv_file:
-        csv_writer = csv.writer(csv_file)
-        with open(path, 'r') as json_file:
-            for line in json_file:
-                json_data = json.loads(line)
-                if json_data and not csv_writer:
-                    csv_writer.writerow(json_data.keys())
-                csv_writer.writerow([json_data.get(key, '') for key in json_data.keys()])
-
-
-    create_table_from_csv(
-        path=output_csv_path,
-        database=database,
-        table_name=table_name
-    )
-    os.remove(output_csv_path)
+def ingest_shard(file_format, path, shard_path, table_name):
+    '''Process pool worker for create_table_from_files: ingests one file into its own shard directory'''
+    Path.mkdir(shard_path)
+    if file_format == 'csv':
+        return ingest_csv(path, shard_path, table_name)
+    return ingest_json(path, shard_path, table_name)
+
+def create_table_from_files(paths, database, table_name, file_format='csv', workers=None):
+    '''Create a new table from many csv or JSON files (shards), ingested in parallel by workers processes. Returns ingest statistics'''
+    start_time = time.time()
+    workers = workers or INGEST_WORKERS
+    paths = sorted(paths)
+    if not len(paths):
+        raise ValueError('No input files found')
+    with ingest_table_path(database, table_name) as table_path:
+        shard_paths = [table_path / f'_shard_{i}' for i in range(len(paths))]
+        try:
+            if len(paths) == 1 or workers <= 1:
+                results = list(map(ingest_shard, itertools.repeat(file_format), paths, shard_paths, itertools.repeat(table_name)))
+            else:
+                with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+                    results = list(executor.map(
+                        ingest_shard, itertools.repeat(file_format), paths, shard_paths, itertools.repeat(table_name)
+                    ))
+            # unify schema and renumber shard partitions into the table directory
+            partitions = [
+                partition
+                for shard_path in shard_paths
+                for partition in sorted(shard_path.glob('*.parquet'), key=dataset_sort_key)
+            ]
+            schema = None
+            for partition in partitions:
+                schema = merge_schemas(schema, pq.read_schema(partition))
+            for n, partition in enumerate(partitions):
+                if not pq.read_schema(partition).equals(schema):
+                    pq.write_table(conform_to_schema(pq.read_table(partition), schema), partition)
+                os.replace(partition, table_path / f'{table_name}_{n}.parquet')
+        finally:
+            for shard_path in shard_paths:
+                shutil.rmtree(shard_path, ignore_errors=True)
+        register_table(database, table_name)
+
+    n_rows = sum(rows for _, rows in results)
+    n_bytes = sum(os.path.getsize(path) for path in paths)
+    return ingest_stats(n_rows, n_bytes, len(partitions), start_time)
 
 def infer_datatypes(type):
     '''Returns Polars datatype for creating table schema'''
@@ -115,12 +520,23 @@ def create_table_from_cli(database, table_name, schema, primary_key=None, partit
     data = pl.DataFrame([], schema=schema)
     partition = '_' + str(partition)
     data.write_parquet(os.path.join(table_path, table_name + partition + '.parquet'))
+    register_table(database, table_name)
+
+def table_partitions(database, table_name, manifest=None):
+    '''Paths of the base partitions of a table, in the partition order recorded in its manifest'''
+    manifest = manifest or read_manifest(database, table_name)
+    return [DATA_PATH / database / table_name / entry['file'] for entry in manifest['partitions']]
+
+def delta_files(database, table_name, manifest=None):
+    '''Paths of the delta files of a table written by insert_into, in insertion order'''
+    manifest = manifest or read_manifest(database, table_name)
+    return [DATA_PATH / database / table_name / '_delta' / entry['file'] for entry in manifest['deltas']]
 
-def check_latest_data_partition_size(database, table_name) -> (bool, Path):
-    '''Checks most recent parquet file partition size.'''
-    partitions = sorted(ds.dataset(DATA_PATH / database / table_name, format='parquet').files, key=lambda x: int(x.split('_')[-1].split('.')[0]))
-    latest_partition = pl.read_parquet(partitions[-1])
-    return latest_partition.estimated_size() <= MAX_PARTITION_SIZE, partitions[-1]
+def check_latest_data_partition_size(database, table_name, manifest=None) -> (bool, Path):
+    '''Checks the size of the most recent parquet file partition recorded in the manifest, without touching the file.'''
+    manifest = manifest or read_manifest(database, table_name)
+    latest_partition = table_partitions(database, table_name, manifest)[-1]
+    return manifest['partitions'][-1]['bytes'] < MAX_PARTITION_SIZE, latest_partition
 
 def insert_into(database, table_name, values, columns=None):
     '''
@@ -128,412 +544,2047 @@ def insert_into(database, table_name, values, columns=None):
     and values should be a list of values or a list of iterables. Iterables contain COLUMN values [[1, 1], [2, 2], ['x', 'y']]
     should result in: {'a': [1, 1], 'b': [2, 2], 'c': ['x', 'y']}
 
-    Checks most recent parquet file partition size. If it is less than 100 MB, append to the end of the file. Otherwise,
-    create a new partition file (If this is the nth partition, the name is: data_n.parquet) and add to that.
+    Rows are written to a new delta file under <table>/_delta instead of rewriting the latest partition (see append_rows)
     '''
-    latest_partition_available, latest_partition_path = check_latest_data_partition_size(database=database, table_name=table_name)
-    if not columns:
-        columns = list(pl.read_parquet_schema(latest_partition_path).keys())
-    if latest_partition_available:
-        data = pl.read_parquet(latest_partition_path)
-        new_data = pl.DataFrame({col: val for col, val in zip(columns, values)})
-        data.extend(new_data)
-        data.write_parquet(latest_partition_path)
+    with table_lock(database, table_name):
+        manifest = read_manifest(database, table_name)
+        check_not_view(manifest, table_name)
+        schema = manifest_schema(manifest)
+        if not columns:
+            columns = schema.names
+        data = pl.DataFrame({col: val for col, val in zip(columns, values)}).to_arrow()
+        append_rows(database, table_name, conform_to_schema(data, schema))
+
+def append_rows(database, table_name, data):
+    '''Appends a pyarrow table with the schema of a table to it as a new delta file, then refreshes the views that read it'''
+    with table_lock(database, table_name):
+        manifest = read_manifest(database, table_name)
+        delta_path = DATA_PATH / database / table_name / '_delta'
+        if not delta_path.exists():
+            Path.mkdir(delta_path)
+        path = delta_path / f'{table_name}_{manifest["next_delta"]}.parquet'
+        pq.write_table(data, path)
+        append_delta_log(DATA_PATH / database / table_name, manifest, file_entry(path))
+
+        if len(manifest['deltas']) >= DELTA_MERGE_THRESHOLD:
+            merge_deltas(database, table_name)
+        refresh_views(database, table_name, manifest, inserted=data)
+
+def merge_deltas(database, table_name):
+    '''Folds the delta files of a table into its base partitions, written to partition numbers the table never used'''
+    with table_lock(database, table_name):
+        manifest = read_manifest(database, table_name)
+        if not len(manifest['deltas']):
+            return
+        table_path = DATA_PATH / database / table_name
+        deltas = delta_files(database, table_name, manifest)
+        latest_partition_available, latest_partition = check_latest_data_partition_size(database, table_name, manifest)
+        sources = ([latest_partition] if latest_partition_available else []) + deltas
+        schema = manifest_schema(manifest)
+
+        def batches():
+            for source in sources:
+                yield conform_to_schema(read_partition(source), schema)
+
+        start = manifest['next_partition']
+        n_partitions, _ = write_partitions(batches(), table_path, table_name, schema, start=start)
+        entries = [file_entry(table_path / f'{table_name}_{n}.parquet') for n in range(start, start + n_partitions)]
+        if latest_partition_available:
+            manifest['partitions'].pop()
+        manifest['partitions'] += entries
+        manifest['deltas'] = []
+        manifest['next_partition'] = start + n_partitions
+        write_manifest(table_path, manifest)
+
+        if latest_partition_available:
+            os.remove(latest_partition)
+            remove_deletion_vector(latest_partition)
+        for delta in deltas:
+            os.remove(delta)
+
+# Partition statistics and deletion vectors
+
+def row_group_statistics(row_group):
+    '''Per-column statistics of one row group from the parquet footer: {column: (min, max, null count)}'''
+    stats = {}
+    for j in range(row_group.num_columns):
+        column = row_group.column(j)
+        col_stats = column.statistics
+        if col_stats is None:
+            stats[column.path_in_schema] = (None, None, None)
+        elif not col_stats.has_min_max:
+            stats[column.path_in_schema] = (None, None, col_stats.null_count)
+        else:
+            stats[column.path_in_schema] = (col_stats.min, col_stats.max, col_stats.null_count)
+    return stats
+
+def partition_statistics(path):
+    '''Per-column statistics of a parquet file from its footer: {column: (min, max, null count)}'''
+    metadata = pq.ParquetFile(path).metadata
+    stats = {}
+    for i in range(metadata.num_row_groups):
+        for name, (col_min, col_max, col_nulls) in row_group_statistics(metadata.row_group(i)).items():
+            if name not in stats:
+                stats[name] = (col_min, col_max, col_nulls)
+                continue
+            current_min, current_max, null_count = stats[name]
+            if current_min is None or col_min is None or col_nulls is None or null_count is None:
+                stats[name] = (None, None, None)
+                continue
+            try:
+                stats[name] = (min(current_min, col_min), max(current_max, col_max), null_count + col_nulls)
+            except TypeError:
+                stats[name] = (None, None, None)
+    return stats
+
+def filter_columns(filters):
+    '''Names of the columns referenced by filters (pyarrow.parquet filters format)'''
+    return {predicate[0] for predicate in itertools.chain.from_iterable(
+        [filters] if isinstance(filters[0], tuple) else filters
+    )}
+
+def predicate_may_match(stats, predicate):
+    '''Whether any row summarized by stats ({column: (min, max, null count)}) could satisfy predicate (column, op, value)'''
+    col, op, val = predicate
+    col_min, col_max = stats.get(col, (None, None, None))[:2]
+    if col_min is None or col_max is None:
+        return True
+    try:
+        if op in ['=', '==']:
+            return col_min <= val <= col_max
+        elif op == '!=':
+            return not (col_min == col_max == val)
+        elif op == '<':
+            return col_min < val
+        elif op == '<=':
+            return col_min <= val
+        elif op == '>':
+            return col_max > val
+        elif op == '>=':
+            return col_max >= val
+        elif op == 'in':
+            return any(col_min <= x <= col_max for x in val)
+        elif op == 'not in':
+            return not (col_min == col_max and col_min in val)
+    except TypeError:
+        pass
+    return True
+
+def statistics_may_match(stats, filters):
+    '''Whether any row summarized by stats could satisfy filters (pyarrow.parquet filters format)'''
+    if not len(filters):
+        return True
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+    return any(all(predicate_may_match(stats, predicate) for predicate in conjunction) for conjunction in filters)
+
+def deletion_vector_path(partition):
+    '''Deletion vectors of a partition file are kept at <directory>/_deleted/<partition file name>'''
+    partition = Path(partition)
+    return partition.parent / '_deleted' / partition.name
+
+def read_deletion_vector(partition):
+    '''Sorted positions of the deleted rows of a partition, or None if no row of it was deleted'''
+    path = deletion_vector_path(partition)
+    if not path.exists():
+        return None
+    return pq.read_table(path).column('row').combine_chunks()
+
+def write_deletion_vector(partition, positions):
+    '''Persists the positions of the deleted rows of a partition'''
+    path = deletion_vector_path(partition)
+    if not path.parent.exists():
+        Path.mkdir(path.parent)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    pq.write_table(pa.table({'row': pa.array(positions, pa.uint32())}), tmp_path)
+    os.replace(tmp_path, path)
+
+def remove_deletion_vector(partition):
+    '''Drops the deletion vector of a partition after the partition was rewritten without its deleted rows'''
+    deletion_vector_path(partition).unlink(missing_ok=True)
+
+def apply_deletion_vector(data, deleted, positions=None):
+    '''Removes the rows at the positions in deleted from data, whose rows are at positions (all rows if None) of its partition'''
+    if deleted is None or not len(deleted):
+        return data
+    if positions is None:
+        positions = pl.int_range(0, data.num_rows, eager=True, dtype=pl.UInt32)
+    return data.filter(positions.is_in(pl.from_arrow(deleted)).not_().to_arrow())
+
+def read_partition(partition, columns=None, filters=None, positions=None):
+    '''Reads a partition file with its deletion vector applied, only columns, the row groups filters may match and positions'''
+    file = pq.ParquetFile(partition)
+    metadata = file.metadata
+    read_columns = columns
+    if columns is not None and filters:
+        read_columns = list(columns) + sorted(filter_columns(filters) - set(columns))
+    starts = [0] + list(itertools.accumulate(metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)))
+    if positions is not None:
+        positions = pl.from_arrow(positions) if isinstance(positions, (pa.Array, pa.ChunkedArray)) else pl.Series(positions)
+    row_groups = [
+        i for i in range(metadata.num_row_groups)
+        if (not filters or statistics_may_match(row_group_statistics(metadata.row_group(i)), filters))
+        and (positions is None or positions.search_sorted(starts[i]) < positions.search_sorted(starts[i + 1]))
+    ]
+    if not len(row_groups):
+        schema = file.schema_arrow
+        return schema.empty_table().select(columns) if columns is not None else schema.empty_table()
+    data = file.read_row_groups(row_groups, columns=read_columns)
+
+    deleted = read_deletion_vector(partition)
+    read_positions = None
+    if positions is not None or (deleted is not None and len(row_groups) < metadata.num_row_groups):
+        read_positions = pl.concat([
+            pl.int_range(starts[i], starts[i + 1], eager=True, dtype=pl.UInt32) for i in row_groups
+        ])
+    if positions is not None:
+        keep = read_positions.is_in(positions.cast(pl.UInt32))
+        data, read_positions = data.filter(keep.to_arrow()), read_positions.filter(keep)
+    data = apply_deletion_vector(data, deleted, read_positions)
+    if filters:
+        data = data.filter(pq.filters_to_expression(filters))
+    return data.select(columns) if columns is not None else data
+
+def matching_positions(data, filters):
+    '''Positions of the rows of a table that satisfy filters (pyarrow.parquet filters format)'''
+    positions = pl.int_range(0, data.num_rows, eager=True, dtype=pl.UInt32).to_arrow()
+    data = data.append_column('__row', positions)
+    return data.filter(pq.filters_to_expression(filters)).column('__row').combine_chunks()
+
+# Secondary indexes
+
+INDEX_DIR = '_index'
+INDEX_OPERATORS = ['=', '==', '<', '<=', '>', '>=', 'in']
+
+def index_path(table_path, col, partition_file):
+    '''The index on col of a partition file is kept at <table>/_index/<col>/<partition file name>'''
+    return Path(table_path) / INDEX_DIR / col / partition_file
+
+def build_index_file(partition, path, col):
+    '''Writes the index of a partition on col: the sorted (key, row position) pairs of its live rows with a key'''
+    keys = pl.from_arrow(pq.read_table(partition, columns=[col]).column(col))
+    index = pl.DataFrame({'key': keys, 'row': pl.int_range(0, len(keys), eager=True, dtype=pl.UInt32)})
+    deleted = read_deletion_vector(partition)
+    if deleted is not None:
+        index = index.filter(pl.col('row').is_in(pl.from_arrow(deleted)).not_())
+    index = index.drop_nulls('key').sort('key')
+    n_deleted = len(deleted) if deleted is not None else 0
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(path).with_name(f'.{Path(path).name}.tmp')
+    pq.write_table(index.to_arrow().replace_schema_metadata({'deleted': str(n_deleted)}), tmp_path)
+    os.replace(tmp_path, path)
+
+def sync_indexes(table_path, manifest):
+    '''Builds the index files of new partitions and rebuilds those of partitions with rows deleted since ('indexed')'''
+    for col in manifest.get('indexes', []):
+        for entry in manifest['partitions']:
+            indexed = entry.setdefault('indexed', {})
+            if indexed.get(col) != entry['deleted']:
+                build_index_file(Path(table_path) / entry['file'], index_path(table_path, col, entry['file']), col)
+                indexed[col] = entry['deleted']
+
+def remove_unlisted_indexes(table_path, manifest):
+    '''Removes the index files, bloom filters and stored sketches (see stored_sketch) of partitions no longer in the manifest of a table'''
+    current = {entry['file'] for entry in manifest['partitions']}
+    for col in manifest.get('indexes', []):
+        for path in (Path(table_path) / INDEX_DIR / col).glob('*.parquet'):
+            if path.name not in current:
+                os.remove(path)
+    for col in manifest.get('bloom_filters', []):
+        for path in (Path(table_path) / BLOOM_DIR / col).iterdir():
+            if path.name not in current:
+                os.remove(path)
+    for path in (Path(table_path) / SKETCH_DIR).glob('*/*.parquet'):
+        if path.name not in current:
+            os.remove(path)
+
+def create_index(database, table_name, col):
+    '''Creates a persistent index on a column of a table, a sorted mapping from key to (partition, row position)'''
+    with table_lock(database, table_name):
+        manifest = read_manifest(database, table_name)
+        schema = manifest_schema(manifest)
+        if col not in schema.names:
+            raise ValueError(f'Column {col} not found in {table_name}')
+        if pa.types.is_nested(schema.field(col).type):
+            raise ValueError(f'Column {col} of type {schema.field(col).type} can not be indexed')
+        if col in manifest.get('indexes', []):
+            raise ValueError(f'Index on {table_name}({col}) already exists')
+        manifest['indexes'] = manifest.get('indexes', []) + [col]
+        write_manifest(DATA_PATH / database / table_name, manifest)
+
+def index_predicates(manifest, filters):
+    '''(indexed column, its predicates) of the equality, range and 'in' predicates of filters an index can answer, or (None, [])'''
+    if not filters or not isinstance(filters[0], tuple):
+        return None, []
+    for col in manifest.get('indexes', []):
+        predicates = [predicate for predicate in filters if predicate[0] == col and predicate[1] in INDEX_OPERATORS]
+        if len(predicates):
+            return col, predicates
+    return None, []
+
+def integer_key_predicate(op, val):
+    '''(op, val) of a predicate with float values on an integer column, in integers. (None, None) if not finite'''
+    if op == 'in':
+        if any(isinstance(value, float) and not math.isfinite(value) for value in val):
+            return None, None
+        return op, [
+            int(value) if isinstance(value, float) else value
+            for value in val if not isinstance(value, float) or value.is_integer()
+        ]
+    if not isinstance(val, float):
+        return op, val
+    if not math.isfinite(val):
+        return None, None
+    if val.is_integer():
+        return op, int(val)
+    if op in ['=', '==']:
+        return 'in', []
+    return ('<=', math.floor(val)) if op in ['<', '<='] else ('>=', math.ceil(val))
+
+def index_lookup(path, predicates):
+    '''Sorted positions of the rows whose key satisfies all of predicates, by binary search in the index file at path'''
+    index = pl.read_parquet(path)
+    keys = index['key']
+    ranges = [(0, len(keys))]
+    for _, op, val in predicates:
+        if keys.dtype in pl.INTEGER_DTYPES:
+            op, val = integer_key_predicate(op, val)
+            if op is None:
+                return None
+        values = pl.Series(list(val) if op == 'in' else [val], dtype=keys.dtype if op == 'in' and not len(val) else None)
+        if values.dtype != keys.dtype:
+            if keys.dtype in pl.INTEGER_DTYPES and values.dtype in pl.INTEGER_DTYPES or \
+                    keys.dtype in pl.FLOAT_DTYPES and values.dtype in pl.NUMERIC_DTYPES:
+                values = values.cast(keys.dtype)
+            else:
+                return None
+        left, right = keys.search_sorted(values, side='left'), keys.search_sorted(values, side='right')
+        if op in ['=', '==', 'in']:
+            matches = list(zip(left, right))
+        elif op == '<':
+            matches = [(0, left[0])]
+        elif op == '<=':
+            matches = [(0, right[0])]
+        elif op == '>':
+            matches = [(right[0], len(keys))]
+        else:
+            matches = [(left[0], len(keys))]
+        ranges = [(max(a, c), min(b, d)) for a, b in ranges for c, d in matches if max(a, c) < min(b, d)]
+    rows = [index['row'].slice(start, end - start) for start, end in ranges]
+    return (pl.concat(rows).unique().sort() if len(rows) else pl.Series('row', [], pl.UInt32)).to_arrow()
+
+def index_positions(table_path, manifest, entry, filters):
+    '''Positions of the rows of a partition (its manifest entry) that may satisfy filters by an index, or None'''
+    col, predicates = index_predicates(manifest, filters)
+    if col is None:
+        return None
+    return index_lookup(index_path(table_path, col, entry['file']), predicates)
+
+# Bloom filters
+
+BLOOM_DIR = '_bloom'
+
+def bloom_filter_path(table_path, col, partition_file):
+    '''The bloom filter on col of a partition file is kept at <table>/_bloom/<col>/<partition file name>'''
+    return Path(table_path) / BLOOM_DIR / col / partition_file
+
+def value_hashes(values):
+    '''64 bit hashes (numpy uint64) of the values of a pyarrow array, equal for equal values of the same type'''
+    return pl.from_arrow(values).hash(seed=0).to_numpy()
+
+def bloom_positions(hashes, n_bits, n_hashes):
+    '''Bit positions of hashes in a bloom filter of n_bits bits and n_hashes hash functions, one row per hash function'''
+    first, second = hashes & np.uint64(0xFFFFFFFF), (hashes >> np.uint64(32)) | np.uint64(1)
+    return np.stack([(first + np.uint64(i) * second) % np.uint64(n_bits) for i in range(n_hashes)])
+
+def build_bloom_filter(partition, path, col):
+    '''Writes the bloom filter of the values of col in a partition: the number of hash functions in a byte, then the bits'''
+    values = pc.unique(pq.read_table(partition, columns=[col]).column(col)).drop_null()
+    n_values = max(len(values), 1)
+    n_bits = max(64, math.ceil(-n_values * math.log(BLOOM_FALSE_POSITIVE_RATE) / math.log(2) ** 2 / 8) * 8)
+    n_hashes = max(1, round(n_bits / n_values * math.log(2)))
+    bits = np.zeros(n_bits, dtype=bool)
+    if len(values):
+        bits[bloom_positions(value_hashes(values), n_bits, n_hashes).ravel()] = True
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(path).with_name(f'.{Path(path).name}.tmp')
+    with open(tmp_path, 'wb') as file:
+        file.write(bytes([n_hashes]) + np.packbits(bits, bitorder='little').tobytes())
+    os.replace(tmp_path, path)
+
+def bloom_bits_set(bits, n_hashes, hashes):
+    '''Per hash, whether all its bits are set in a bloom filter (a little-endian packed uint8 array) of n_hashes hash functions'''
+    positions = bloom_positions(hashes, len(bits) * 8, n_hashes)
+    return ((bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1).all(axis=0).astype(bool)
+
+def bloom_may_contain(path, values=None, hashes=None):
+    '''Whether the bloom filter at path may contain any of values (a pyarrow array) or of their hashes'''
+    hashes = value_hashes(values) if hashes is None else hashes
+    if not len(hashes):
+        return False
+    data = np.fromfile(path, dtype=np.uint8)
+    return bool(bloom_bits_set(data[1:], int(data[0]), hashes).any())
+
+def sync_bloom_filters(table_path, manifest):
+    '''Builds the bloom filters of the bloom filtered columns of a table for the new partitions in its manifest'''
+    for col in manifest.get('bloom_filters', []):
+        for entry in manifest['partitions']:
+            path = bloom_filter_path(table_path, col, entry['file'])
+            if not path.exists():
+                build_bloom_filter(Path(table_path) / entry['file'], path, col)
+
+def create_bloom_filter(database, table_name, col):
+    '''Creates bloom filters on a column of a table, one per partition, used to skip partitions by equality and join keys'''
+    with table_lock(database, table_name):
+        manifest = read_manifest(database, table_name)
+        schema = manifest_schema(manifest)
+        if col not in schema.names:
+            raise ValueError(f'Column {col} not found in {table_name}')
+        if pa.types.is_nested(schema.field(col).type):
+            raise ValueError(f'Column {col} of type {schema.field(col).type} can not have a bloom filter')
+        if col in manifest.get('bloom_filters', []):
+            raise ValueError(f'Bloom filter on {table_name}({col}) already exists')
+        manifest['bloom_filters'] = manifest.get('bloom_filters', []) + [col]
+        write_manifest(DATA_PATH / database / table_name, manifest)
+
+def bloom_values(values, schema, col):
+    '''values as a pyarrow array of the type of col in schema, or None if they can not be converted to it'''
+    try:
+        if isinstance(values, (pa.Array, pa.ChunkedArray)):
+            return values.cast(schema.field(col).type)
+        return pa.array(list(values), type=schema.field(col).type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError, OverflowError):
+        return None
+
+def bloom_may_match(table_path, manifest, schema, entry, filters=None, join_keys=None):
+    '''Whether a partition (its manifest entry) may hold rows matching the equality filters and keys of join_keys by its bloom filters'''
+    columns = manifest.get('bloom_filters', [])
+    if not len(columns):
+        return True
+
+    def may_contain(col, values):
+        values = bloom_values(values, schema, col)
+        return values is None or bloom_may_contain(bloom_filter_path(table_path, col, entry['file']), values)
+
+    if join_keys is not None and join_keys.col in columns and join_keys.hashes is not None:
+        if not bloom_may_contain(bloom_filter_path(table_path, join_keys.col, entry['file']), hashes=join_keys.hashes):
+            return False
+    if not filters:
+        return True
+    conjunctions = [filters] if isinstance(filters[0], tuple) else filters
+    return any(
+        all(
+            may_contain(col, [val] if op in ['=', '=='] else val)
+            for col, op, val in conjunction if col in columns and op in ['=', '==', 'in']
+        )
+        for conjunction in conjunctions
+    )
+
+class KeyCollector:
+    '''Runtime join filter: the join keys of the side of a join read first, to prune and filter the scan of the other side'''
+    def __init__(self, col, key_type, memory=None):
+        self.col, self.key_type = col, key_type
+        self.memory = memory or MemoryManager().reserve('join_keys')
+        self.ready, self.enabled = False, True
+        self.n_keys, self.min, self.max = 0, None, None
+        self.hashes = None # sorted distinct key hashes, or None once they are folded into the bloom filter
+        self.bits, self.n_hashes = None, 0 # bloom filter bits (little-endian packed) and number of hash functions
+
+    def collect(self, partitions):
+        '''Passes an iterable of (partition, name) through, collecting its keys'''
+        hashes = []
+        for data, name in partitions:
+            if self.enabled:
+                try:
+                    keys = pc.unique(data.column(self.col).cast(self.key_type)).drop_null()
+                except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                    self.enabled = False
+            if self.enabled and len(keys):
+                lowest, highest = pc.min_max(keys).values()
+                self.min = lowest.as_py() if self.min is None else min(self.min, lowest.as_py())
+                self.max = highest.as_py() if self.max is None else max(self.max, highest.as_py())
+                if self.bits is None:
+                    hashes.append(value_hashes(keys))
+                    if not self.memory.grow(hashes[-1].nbytes):
+                        hashes = [np.unique(np.concatenate(hashes))]
+                        self.memory.free()
+                        if not self.memory.grow(hashes[0].nbytes):
+                            self.to_bloom(hashes[0])
+                            hashes = []
+                else:
+                    self.add_to_bloom(value_hashes(keys))
+            yield data, name
+        if self.enabled:
+            if self.bits is None:
+                self.hashes = np.unique(np.concatenate(hashes)) if len(hashes) else np.array([], dtype=np.uint64)
+                self.n_keys = len(self.hashes)
+            self.ready = True
+
+    def to_bloom(self, hashes):
+        '''Folds the collected hashes into a bloom filter sized for four times as many keys'''
+        n_keys = len(hashes) * 4
+        n_bytes = min(math.ceil(-n_keys * math.log(BLOOM_FALSE_POSITIVE_RATE) / math.log(2) ** 2 / 8), self.memory.limit())
+        n_bytes = max(n_bytes, 8)
+        self.memory.grow(n_bytes)
+        self.n_hashes = max(1, round(n_bytes * 8 / n_keys * math.log(2)))
+        self.bits = np.zeros(n_bytes, dtype=np.uint8)
+        self.add_to_bloom(hashes)
+
+    def add_to_bloom(self, hashes):
+        positions = bloom_positions(hashes, len(self.bits) * 8, self.n_hashes).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        self.n_keys += len(hashes)
+
+    def filters(self, filters):
+        '''filters (pyarrow.parquet filters format, or None) restricted to the min/max of the collected keys'''
+        if not self.ready or self.min is None:
+            return filters
+        bounds = [(self.col, '>=', self.min), (self.col, '<=', self.max)]
+        if not filters:
+            return bounds
+        return filters + bounds if isinstance(filters[0], tuple) else [conjunction + bounds for conjunction in filters]
+
+    def filter(self, data):
+        '''The rows of a partition whose key may be one of the collected keys'''
+        if not self.ready or not data.num_rows:
+            return data
+        keys = data.column(self.col).cast(self.key_type)
+        hashes = value_hashes(keys)
+        if self.bits is None:
+            match = np.isin(hashes, self.hashes, assume_unique=False)
+        else:
+            match = bloom_bits_set(self.bits, self.n_hashes, hashes)
+        return data.filter(pc.and_(pc.is_valid(keys), pa.array(match)))
+
+# Table statistics
+
+def distinct_sketch(column, k=DISTINCT_SKETCH_SIZE):
+    '''k minimum values sketch of the distinct non-null values of a column: its k smallest distinct 64 bit hashes, sorted'''
+    if pa.types.is_nested(column.type):
+        hashes = pl.Series('hash', list({
+            int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), 'little')
+            for value in column.drop_null().to_pylist()
+        }), dtype=pl.UInt64).sort()
     else:
-        schema = pl.read_parquet_schema(latest_partition_path)
-        data = pl.DataFrame({col: val for col, val in zip(columns, values)}, schema=schema)
-        n = int(latest_partition_path.split('_')[-1].split('.')[0]) + 1
-        name = f'{table_name}_{n}.parquet'
-        data.write_parquet(DATA_PATH / database / table_name / name)
+        hashes = pl.from_arrow(column.drop_null()).hash(seed=0).unique().sort()
+    return hashes.head(k).to_list()
+
+def merge_distinct_sketches(sketch, other, k=DISTINCT_SKETCH_SIZE):
+    '''k minimum values sketch of the union of the values summarized by two sketches'''
+    return sorted(set(sketch) | set(other))[:k]
 
+def estimate_distinct(sketch, k=DISTINCT_SKETCH_SIZE):
+    '''Estimated number of distinct values summarized by a sketch, exact when there are fewer than k'''
+    if len(sketch) < k:
+        return len(sketch)
+    return round((k - 1) * 2 ** 64 / (sketch[k - 1] + 1))
+
+def analyze_table(database, table_name):
+    '''Collects the row count and per column distinct values, min, max and null fraction into the manifest. Returns them'''
+    with table_lock(database, table_name):
+        n_rows, columns = 0, {}
+        for data, _ in read_table(database=database, table_name=table_name):
+            n_rows += data.num_rows
+            for name in data.column_names:
+                column = data.column(name)
+                if pa.types.is_nested(column.type):
+                    col_min, col_max = None, None
+                else:
+                    col_min, col_max = pc.min_max(column).values()
+                    col_min, col_max = col_min.as_py(), col_max.as_py()
+                if name not in columns:
+                    columns[name] = [col_min, col_max, 0, []]
+                stats = columns[name]
+                try:
+                    stats[0] = col_min if stats[0] is None else stats[0] if col_min is None else min(stats[0], col_min)
+                    stats[1] = col_max if stats[1] is None else stats[1] if col_max is None else max(stats[1], col_max)
+                except TypeError:
+                    stats[0], stats[1] = None, None
+                stats[2] += column.null_count
+                stats[3] = merge_distinct_sketches(stats[3], distinct_sketch(column))
+
+        safe = json_statistics({name: stats[:3] for name, stats in columns.items()})
+        manifest = read_manifest(database, table_name)
+        manifest['statistics'] = {
+            'version': manifest['version'] + 1,
+            'rows': n_rows,
+            'columns': {
+                name: {
+                    'distinct': estimate_distinct(stats[3]),
+                    'min': safe[name][0],
+                    'max': safe[name][1],
+                    'null_fraction': stats[2] / n_rows if n_rows else 0
+                }
+                for name, stats in columns.items()
+            }
+        }
+        write_manifest(DATA_PATH / database / table_name, manifest)
+        return manifest['statistics']
+
+def manifest_distinct_bound(manifest, col):
+    '''Upper bound of the distinct values of an integer column from the min/max statistics in its manifest, or None'''
+    bound, lows, highs = 0, [], []
+    for entry in manifest['partitions'] + manifest['deltas']:
+        col_min, col_max, null_count = entry['stats'].get(col, [None, None, None])
+        n_values = entry['rows'] - (null_count or 0)
+        if n_values <= 0:
+            continue
+        if col_min is None or col_max is None:
+            return None
+        if col_min == col_max:
+            bound += 1
+        elif isinstance(col_min, int) and isinstance(col_max, int):
+            bound += min(n_values, col_max - col_min + 1)
+        else:
+            return None
+        lows.append(col_min)
+        highs.append(col_max)
+    if all(isinstance(value, int) for value in lows + highs) and len(lows):
+        bound = min(bound, max(highs) - min(lows) + 1)
+    return bound
+
+def column_statistics(manifest):
+    '''Statistics collected by analyze_table for each column of a table, empty if it was never analyzed'''
+    return manifest.get('statistics', {}).get('columns', {})
+
+def predicate_selectivity(stats, predicate):
+    '''Estimated fraction of rows that satisfy predicate (column, op, value) given the analyze_table statistics of its column'''
+    col, op, val = predicate
+    defaults = {'=': 0.1, '==': 0.1, '!=': 0.9, '<': 1 / 3, '<=': 1 / 3, '>': 1 / 3, '>=': 1 / 3}
+    if stats is None:
+        if op in ['in', 'not in']:
+            selectivity = min(1, 0.1 * len(val))
+            return selectivity if op == 'in' else 1 - selectivity
+        return defaults.get(op, 1)
+    distinct, col_min, col_max = max(stats['distinct'], 1), stats['min'], stats['max']
+    try:
+        if op in ['=', '==']:
+            in_range = col_min is None or col_max is None or col_min <= val <= col_max
+            selectivity = 1 / distinct if in_range else 0
+        elif op == '!=':
+            selectivity = 1 - 1 / distinct
+        elif op == 'in':
+            selectivity = min(1, len(val) / distinct)
+        elif op == 'not in':
+            selectivity = max(0, 1 - len(val) / distinct)
+        elif isinstance(col_min, (int, float)) and isinstance(col_max, (int, float)) and isinstance(val, (int, float)):
+            below = 1 if val > col_max else 0 if val < col_min else (val - col_min) / (col_max - col_min) if col_max > col_min else 0.5
+            selectivity = below if op in ['<', '<='] else 1 - below
+        else:
+            selectivity = defaults.get(op, 1)
+    except TypeError:
+        selectivity = defaults.get(op, 1)
+    return selectivity * (1 - stats['null_fraction'])
+
+def filter_selectivity(stats, filters):
+    '''Estimated fraction of rows that satisfy filters, given the analyze_table statistics of the filtered columns'''
+    if not len(filters):
+        return 1
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+    no_match = 1
+    for conjunction in filters:
+        no_match *= 1 - math.prod(predicate_selectivity(stats.get(predicate[0]), predicate) for predicate in conjunction)
+    return 1 - no_match
+
+# Memory management
+
+class MemoryManager:
+    '''Memory accounting of one query: operators reserve what they hold, up to operator_budget each and query_budget together'''
+    def __init__(self, query_budget=None, operator_budget=None):
+        self.query_budget = QUERY_MEMORY_BUDGET if query_budget is None else query_budget
+        self.operator_budget = MEMORY_BUDGET if operator_budget is None else operator_budget
+        self.lock = threading.Lock()
+        self.reserved, self.peak, self.arrow_peak = 0, 0, pa.total_allocated_bytes()
+        self.spilled = 0
+
+    def reserve(self, operator):
+        '''A new, empty reservation for an operator'''
+        return MemoryReservation(self, operator)
+
+class MemoryReservation:
+    '''Bytes held by one operator of a query, accounted by its MemoryManager'''
+    def __init__(self, manager, operator):
+        self.manager, self.operator = manager, operator
+        self.size, self.peak = 0, 0
+
+    def limit(self):
+        '''Bytes this reservation may grow to, given what the other operators of the query hold'''
+        with self.manager.lock:
+            return max(min(self.manager.operator_budget, self.manager.query_budget - self.manager.reserved + self.size), 0)
+
+    def grow(self, n_bytes):
+        '''Reserves n_bytes more (releases them if negative). Returns False, reserving nothing, past the operator or query budget'''
+        manager = self.manager
+        with manager.lock:
+            if n_bytes > 0 and (self.size + n_bytes > manager.operator_budget or manager.reserved + n_bytes > manager.query_budget):
+                return False
+            self.size += n_bytes
+            manager.reserved += n_bytes
+            self.peak, manager.peak = max(self.peak, self.size), max(manager.peak, manager.reserved)
+            manager.arrow_peak = max(manager.arrow_peak, pa.total_allocated_bytes())
+            return True
+
+    def free(self):
+        '''Releases all the bytes of the reservation'''
+        self.grow(-self.size)
+
+    def spill(self, path):
+        '''Adds the size of a file the operator just spilled to path to the bytes spilled by the query'''
+        n_bytes = os.path.getsize(path)
+        with self.manager.lock:
+            self.manager.spilled += n_bytes
+
+# Query profiling
+
+class QueryProfile:
+    '''Measurements of the operators of a plan run by execute_plan, for explain analyze'''
+    def __init__(self, plan):
+        self.plan, self.memory = plan, MemoryManager()
+        self.totals = [{'wall': 0.0, 'cpu': 0.0, 'read': 0, 'written': 0, 'rows': 0, 'bytes': 0} for _ in plan]
+        self.stats = [{} for _ in plan]
+        self.io_overhead = 0 # bytes the measurements have read from /proc/self/io
+
+    def io(self):
+        '''(bytes read, bytes written) by the process so far, from /proc/self/io ((0, 0) where it does not exist)'''
+        try:
+            with open('/proc/self/io', 'rb') as file:
+                text = file.read()
+        except OSError:
+            return 0, 0
+        counters = dict(line.split(b': ') for line in text.splitlines())
+        read = int(counters[b'rchar']) - self.io_overhead # rchar does not count this read yet
+        self.io_overhead += len(text)
+        return read, int(counters[b'wchar'])
+
+    def operator(self, i, partitions):
+        '''Yields the (partition, name) of operator i of the plan, measuring each'''
+        totals, partitions = self.totals[i], iter(partitions)
+        while True:
+            wall, cpu, (read, written) = time.perf_counter(), time.process_time(), self.io()
+            try:
+                data, name = next(partitions)
+            except StopIteration:
+                return
+            finally:
+                new_read, new_written = self.io()
+                totals['wall'] += time.perf_counter() - wall
+                totals['cpu'] += time.process_time() - cpu
+                totals['read'] += new_read - read
+                totals['written'] += new_written - written
+            totals['rows'] += data.num_rows
+            totals['bytes'] += data.nbytes
+            yield data, name
+
+    def actuals(self, i):
+        '''Measurements of operator i alone, the difference of its totals with those of the operator before it'''
+        totals = dict(self.totals[i])
+        if i > 0:
+            for key in ['wall', 'cpu', 'read', 'written']:
+                totals[key] -= self.totals[i - 1][key]
+        stats = self.stats[i]
+        totals['rows_in'] = self.totals[i - 1]['rows'] if i > 0 else stats.get('rows_read', 0)
+        totals['files'], totals['files_read'] = stats.get('files', 0), stats.get('files_read', 0)
+        return totals
 
 # Read
 
-def execute_query(database: str, table_name: str, query_path: Path, query_id: str,
+def execute_query(database: str, table_name: str, query_path: Path,
                   join_table_name: str = None, join_col: str = None, # FROM/JOIN
                   filters: list = [],  # WHERE
-                  group_col: str = None, agg_col: str = None, agg_func: str = None, # GROUP BY
+                  group_cols: list = [], aggs: list = [], # GROUP BY, aggs are (function, column)
                   group_filter: list = [], # HAVING
                   columns: [list] = [], # SELECT (projection)
                   distinct: bool = None, 
-                  sort_col: str = None, reverse: bool = False,
+                  sort_col: str = None, reverse: bool = False, nulls_first: bool = False,
                   limit: bool = None, offset: bool = None):
-    '''Master query execution function'''
-    step = 0
-
-    if not query_path.exists():
-        Path.mkdir(TEMP_DB_PATH / query_id)
+    '''Master query execution function, answered from the result cache when RESULT_CACHE holds its result'''
+    query = dict(
+        table_name=table_name, join_table_name=join_table_name, join_col=join_col, filters=filters,
+        group_cols=group_cols, aggs=aggs, group_filter=group_filter, columns=columns, distinct=bool(distinct),
+        sort_col=sort_col, reverse=reverse, nulls_first=nulls_first, limit=limit, offset=offset
+    )
+    if RESULT_CACHE:
+        tables = [table_name] + ([join_table_name] if join_table_name else [])
+        key = result_cache_key(database, query, tables)
+        cached = result_cache.get(key)
+        if cached is not None:
+            return iter(cached)
+    partitions = execute_plan(plan_query(database, **query), query_path)
+    if RESULT_CACHE:
+        partitions = result_cache.collect(key, partitions, [(database, table) for table in tables])
+    return partitions
 
-    step_dir = f'step_{step}'
-    
-    current_step_path = Path(query_path / step_dir)
-    if not current_step_path.exists():
-        Path.mkdir(current_step_path)
+def plan_query(database, table_name, join_table_name=None, join_col=None, filters=[], group_cols=[], aggs=[],
+               group_filter=[], columns=[], distinct=False, sort_col=None, reverse=False, nulls_first=False, limit=None,
+               offset=None, memory_budget=None):
+    '''Plans a query as the list of its operators in execution order, with estimates of their rows, bytes and memory'''
+    memory_budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    filters, group_filter = list(filters), list(group_filter)
+    if len(aggs) and len(group_filter) and isinstance(group_filter[0], tuple) and (not len(filters) or isinstance(filters[0], tuple)):
+        filters += [predicate for predicate in group_filter if predicate[0] in group_cols]
+        group_filter = [predicate for predicate in group_filter if predicate[0] not in group_cols]
 
+    window_in_scan = not join_table_name and not len(aggs) and not len(group_filter) and not distinct and not sort_col
     if not join_table_name and not join_col: # both should be None if join is true
-        for partition, name in read_table(database=database, table_name=table_name):
-            pq.write_table(table=partition, where=(current_step_path / name).with_suffix('.parquet'))
-    else: # should execute if select is false
-        # partial sort
-        Path.mkdir(current_step_path / 'r')
-        Path.mkdir(current_step_path / 's')
-        for partition, name in partial_sort(prev_step_path=Path(DATA_PATH / database / table_name), sort_col=join_col):
-            pq.write_table(table=partition, where=(current_step_path / 'r' / name).with_suffix('.parquet'))
-        for partition, name in partial_sort(prev_step_path=Path(DATA_PATH / database / join_table_name), sort_col=join_col):
-            pq.write_table(table=partition, where=(current_step_path / 's' / name).with_suffix('.parquet'))
-
-        # merge join
-        output_file_path = current_step_path / 'output.txt'
-        line_count = 0
-        # write algorithm outputs to single txt file
-        with open(output_file_path, 'w') as file:
-            for data in sort_merge_join((current_step_path / 'r'), (current_step_path / 's'), join_col):
-                for tuple_data in data:
-                    file.write(str(tuple_data).rstrip() + "\n")
-                    line_count += 1
-        # convert txt file back to partitioned parquet files
-        n_partitions = math.ceil(os.path.getsize(output_file_path) / MAX_PARTITION_SIZE)
-        partition_counter = 0
-        schema_r = [name + '_x' if name == join_col else name for name in ds.dataset(current_step_path / 'r').schema.names]
-        schema_s = [name + '_y' if name == join_col else name for name in ds.dataset(current_step_path / 's').schema.names]
-        schema = schema_r + schema_s
-        with open(output_file_path, 'r') as file:
-            lines = []
-            for line in file:
-                lines.append(ast.literal_eval(line.rstrip()))
-                if len(lines) > line_count // n_partitions:
-                    name = f'{table_name}_{join_table_name}_{partition_counter}.parquet'
-                    pl.DataFrame(lines, schema=schema).write_parquet(file=(current_step_path / name))
-                    partition_counter += 1
-                    lines = []
-            if lines:
-                name = f'{table_name}_{join_table_name}_{partition_counter}.parquet'
-                pl.DataFrame(lines, schema=schema).write_parquet(file=(current_step_path / name))
-        # clean up directories
-        shutil.rmtree(current_step_path / 'r')
-        shutil.rmtree(current_step_path / 's')
-        os.remove(output_file_path)
+        plan = [plan_scan(
+            database, table_name, columns=scan_columns(group_cols, aggs, columns), filters=filters,
+            limit=limit if window_in_scan else None, offset=offset if window_in_scan else None
+        )]
+    else:
+        plan = [plan_join(database, table_name, join_table_name, join_col, filters, memory_budget)]
 
-    if len(filters):
-        prev_step_path = current_step_path
-        step += 1
-        step_dir = f'step_{step}'
-        current_step_path = Path(query_path / step_dir)
-        if not current_step_path.exists():
-            Path.mkdir(current_step_path)
-        for partition, name in filter_rows(prev_step_path=prev_step_path, filters=filters):
-            pq.write_table(table=partition, where=(current_step_path / name).with_suffix('.parquet'))
-    
-    if group_col and agg_col and agg_func:
-        prev_step_path = current_step_path
-        step += 1
-        step_dir = f'step_{step}'
-        current_step_path = Path(query_path / step_dir)
-        if not current_step_path.exists():
-            Path.mkdir(current_step_path)
-        # partial sort
-        partial_sort_path = Path(current_step_path / 'partial_sorted')
-        if not partial_sort_path.exists():
-            Path.mkdir(partial_sort_path)
-
-        for partition, name in partial_sort(prev_step_path=prev_step_path, sort_col=group_col):
-            pq.write_table(table=partition, where=(current_step_path / 'partial_sorted' / name).with_suffix('.parquet'))
-
-        output_file_path = Path(current_step_path / 'output').with_suffix('.txt')
-        if not output_file_path.exists():
-            Path.touch(output_file_path)
-        line_count = 0
-        with open(output_file_path, 'w') as file:
-            for data in group_by(prev_step_path=partial_sort_path, group_col=group_col, agg_col=agg_col, agg_func=agg_func):
-                file.write(str(data).rstrip() + '\n')
-                line_count += 1
-        # convert txt file back to partitioned parquet files
-        n_partitions = math.ceil(os.path.getsize(output_file_path) / MAX_PARTITION_SIZE)
-        partition_counter = 0
-        schema = [group_col, f'{agg_func}({agg_col})']
-        with open(output_file_path, 'r') as file:
-            lines = []
-            for line in file:
-                lines.append(ast.literal_eval(line.rstrip()))
-                if len(lines) > line_count // n_partitions:
-                    name = f'{table_name}_{partition_counter}.parquet'
-                    pl.DataFrame(lines, schema=schema).write_parquet(file=(current_step_path / name))
-            if lines:
-                name = f'{table_name}_{partition_counter}.parquet'
-                pl.DataFrame(lines, schema=schema).write_parquet(file=(current_step_path / name))
-        # clean up partial sorted data
-        shutil.rmtree(current_step_path / 'partial_sorted')
-        os.remove(output_file_path)
+    def add(operator, rows, width, memory=0, spill=False, **arguments):
+        row_bytes = plan[-1]['bytes'] / plan[-1]['rows'] * width / plan[-1]['width'] if plan[-1]['rows'] else 0
+        plan.append({
+            'operator': operator, **arguments, 'rows': round(rows), 'bytes': round(rows * row_bytes),
+            'width': width, 'memory': round(memory), 'spill': spill, 'statistics': plan[-1]['statistics']
+        })
+
+    if len(aggs):
+        stats = plan[-1]['statistics']
+        groups = min(plan[-1]['rows'], math.prod(stats[col]['distinct'] if col in stats else plan[-1]['rows'] for col in group_cols))
+        width = len(group_cols) + len(aggs)
+        group_bytes = groups * plan[-1]['bytes'] / plan[-1]['rows'] * width / plan[-1]['width'] if plan[-1]['rows'] else 0
+        # approx_count_distinct of whole columns merges the sketches stored per partition instead of reading the rows
+        sketches = plan[-1]['operator'] == 'scan' and not len(filters) and not len(group_cols) and \
+            all(func == 'approx_count_distinct' for func, _ in aggs)
+        add('aggregate', groups, width, min(group_bytes, memory_budget), group_bytes > memory_budget, table=table_name,
+            group_cols=group_cols, aggs=aggs, sketches=sketches)
 
     if len(group_filter):
-        prev_step_path = current_step_path
-        step += 1
-        step_dir = f'step_{step}'
-        current_step_path = Path(query_path / step_dir)
-        if not current_step_path.exists():
-            Path.mkdir(current_step_path)
-        for partition, name in filter_rows(prev_step_path=prev_step_path, filters=group_filter):
-            pq.write_table(table=partition, where=(current_step_path / name).with_suffix('.parquet'))
+        add('filter', plan[-1]['rows'] * filter_selectivity(plan[-1]['statistics'], group_filter), plan[-1]['width'], filters=group_filter)
 
     if len(columns):
         selected_cols = columns[0]
         new_col_names = columns[1] if len(columns[1]) else columns[0] # TODO set to selected_cols if no new names provided
+        add('projection', plan[-1]['rows'], len(selected_cols), selected_cols=selected_cols, new_col_names=new_col_names)
 
-        prev_step_path = current_step_path
-        step += 1
-        step_dir = f'step_{step}'
-        current_step_path = Path(query_path / step_dir)
-        if not current_step_path.exists():
-            Path.mkdir(current_step_path)
-        for partition, name in projection(prev_step_path, selected_cols, new_col_names):
-            pq.write_table(table=partition, where=(current_step_path / name).with_suffix('.parquet'))
-
-    if sort_col:
-        prev_step_path = current_step_path
-        step += 1
-        step_dir = f'step_{step}'
-        current_step_path = Path(query_path / step_dir)
-        if not current_step_path.exists():
-            Path.mkdir(current_step_path)
-        # partial sort
-
-        partial_sort_path = Path(current_step_path / 'partial_sorted')
-        if not partial_sort_path.exists():
-            Path.mkdir(partial_sort_path)
-
-        for partition, name in partial_sort(prev_step_path=prev_step_path, sort_col=sort_col, reverse=reverse):
-            pq.write_table(table=partition, where=(current_step_path / 'partial_sorted' / name).with_suffix('.parquet'))
-        # merge phase
-        for chunk, name in merge_sorted_runs(prev_step_path=partial_sort_path, sort_col=sort_col):
-            pq.write_table(table=chunk, where=(current_step_path / name).with_suffix('.parquet'))
-        shutil.rmtree(partial_sort_path)
-
-    
-    # print data set
-    result_dataset = ds.dataset(current_step_path, format='parquet')
-    return result_dataset
-
-def read_table(database, table_name):
-    '''Reads specified table to temporary database'''
-    dataset = ds.dataset(DATA_PATH / database / table_name, format='parquet')
-    for partition in sorted(dataset.files, key=dataset_sort_key):
-        partition = Path(partition)
-        data = pq.read_table(partition)
-        yield data, partition.stem
-
-def filter_rows(prev_step_path, filters):
-    '''
-    Reads intermediate query results from prev_query_path and performs filtering on data partitions.
-    Yields filtered data partitions and partition name
-    '''
-    dataset = ds.dataset(prev_step_path, format='parquet')
-    for partition in sorted(dataset.files, key=dataset_sort_key):
-        partition = Path(partition)
-        data = pq.read_table(partition, filters=filters) # list of tuples e.g. ('acousticness', '<', 1)
-        yield data, partition.stem
+    if distinct:
+        stats = plan[-1]['statistics']
+        cols = columns[0] if len(columns) else group_cols if len(aggs) else list(stats)
+        rows = plan[-1]['rows']
+        if len(cols) == plan[-1]['width'] and all(col in stats for col in cols):
+            rows = min(rows, math.prod(stats[col]['distinct'] for col in cols))
+        distinct_bytes = rows * plan[-1]['bytes'] / plan[-1]['rows'] if plan[-1]['rows'] else 0
+        add('distinct', rows, plan[-1]['width'], min(distinct_bytes, memory_budget), distinct_bytes > memory_budget)
 
-def projection(prev_step_path, selected_cols, new_col_names):
-    '''
-    Reads intermediate query results from prev_query_path and selects only specified columns. Assigns new column names.
-    Yields filtered data partitions and partition name
-    '''
-    dataset = ds.dataset(prev_step_path, format='parquet')
-    for partition in sorted(dataset.files, key=dataset_sort_key):
-        partition = Path(partition)
-        data = pq.read_table(partition, columns=selected_cols) # list of column names
-        data = data.rename_columns(new_col_names)
-        yield data, partition.stem
+    if sort_col and limit is not None:
+        # only the first offset + limit rows of the sorted result are ever shown
+        n = (offset or 0) + limit
+        top_bytes = min(n, plan[-1]['rows']) * plan[-1]['bytes'] / plan[-1]['rows'] if plan[-1]['rows'] else 0
+        add('top_n', min(n, plan[-1]['rows']), plan[-1]['width'], min(top_bytes, memory_budget), top_bytes > memory_budget,
+            sort_col=sort_col, n=n, reverse=reverse, nulls_first=nulls_first)
+    elif sort_col:
+        add('sort', plan[-1]['rows'], plan[-1]['width'], min(plan[-1]['bytes'], memory_budget), plan[-1]['bytes'] > memory_budget,
+            sort_col=sort_col, reverse=reverse, nulls_first=nulls_first)
 
-def group_by(prev_step_path, group_col, agg_col, agg_func):
-    dataset = ds.dataset(prev_step_path, format='parquet')
-    group_idx = dataset.schema.names.index(group_col)
-    agg_idx = dataset.schema.names.index(agg_col)
-    n_buffers = len(dataset.files) + 1 # add 1 for output buffer
-    out_buffer_len = dataset.count_rows() // len(dataset.files)
-
-    # create iterators of each of the files
-    chunk_iterators = {}
-    for partition in dataset.files:
-        pf = pq.ParquetFile(partition)
-        num_rows = pf.metadata.num_rows
-        chunk_iterators[Path(partition).stem] = pf.iter_batches(batch_size=num_rows // n_buffers)
-    out_partition_names = list(chunk_iterators.keys())
-    # store chunks of iterators in dictionary
-    chunks = {
-        name: next(chunk_iterator, False) for name, chunk_iterator in chunk_iterators.items()
+    if (limit is not None or offset) and not window_in_scan:
+        rows = max(plan[-1]['rows'] - (offset or 0), 0)
+        add('limit', min(rows, limit) if limit is not None else rows, plan[-1]['width'], limit=limit, offset=offset)
+    return plan
+
+def plan_scan(database, table_name, columns=None, filters=[], limit=None, offset=None):
+    '''Scan operator of a query plan, with the live rows of the files the manifest statistics may match scaled by filters'''
+    manifest = read_manifest(database, table_name)
+    schema = manifest_schema(manifest)
+    width = len(columns) if columns is not None else len(schema)
+    n_rows = manifest_row_count(manifest)
+    stats = column_statistics(manifest)
+    entries = manifest['partitions'] + manifest['deltas']
+    rows = n_rows
+    if len(filters):
+        may_match = sum(entry['rows'] - entry['deleted'] for entry in entries if statistics_may_match(entry['stats'], filters))
+        rows = min(may_match, n_rows * filter_selectivity(stats, filters))
+    if offset or limit is not None:
+        rows = max(rows - (offset or 0), 0)
+        rows = min(rows, limit) if limit is not None else rows
+    stored_rows = sum(entry['rows'] for entry in entries) # deleted rows still take up space in the files
+    row_bytes = manifest_bytes(manifest) / stored_rows * width / len(schema) if stored_rows else 0
+    return {
+        'operator': 'scan', 'database': database, 'table': table_name, 'columns': columns, 'filters': filters,
+        'index': index_predicates(manifest, filters)[0],
+        'limit': limit, 'offset': offset, 'rows': round(rows), 'bytes': round(rows * row_bytes), 'width': width,
+        'memory': round(max((entry['bytes'] for entry in entries), default=0) * width / len(schema)), 'spill': False,
+        'statistics': {col: col_stats for col, col_stats in stats.items() if columns is None or col in columns}
     }
-    # create tuple iterators for individual rows 
-    row_iterators = {
-        name: iter([tuple(t.values()) for t in chunk.to_pylist()]) for name, chunk in chunks.items()
+
+def plan_join(database, table_name, join_table_name, join_col, filters=[], memory_budget=None):
+    '''Join operator of a query plan, with the scans of both tables as its inputs'''
+    memory_budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    left_manifest, right_manifest = read_manifest(database, table_name), read_manifest(database, join_table_name)
+    left_schema, right_schema = manifest_schema(left_manifest), manifest_schema(right_manifest)
+    schema, _ = join_schema(left_schema, right_schema, join_col)
+    left_names, right_names = schema.names[:len(left_schema)], schema.names[len(left_schema):]
+    left_filters, right_filters, filters = split_join_filters(filters, left_names, right_names, left_schema, right_schema)
+    left = plan_scan(database, table_name, filters=left_filters)
+    right = plan_scan(database, join_table_name, filters=right_filters)
+
+    algorithm, build_left = choose_join_algorithm(left['rows'], right['rows'], left['bytes'], right['bytes'], memory_budget)
+    if algorithm == 'sort_merge' and not left_schema.field(join_col).type.equals(right_schema.field(join_col).type):
+        algorithm = 'hash' # casting the keys to a common type could change their sort order
+    probe, probe_manifest = (right, right_manifest) if build_left else (left, left_manifest)
+    if join_col in probe_manifest.get('indexes', []) and (left['rows'] if build_left else right['rows']) <= INDEX_JOIN_MAX_KEYS:
+        # few enough keys on the build side to look them up in the index of the probe side
+        algorithm, probe['index'] = 'index', join_col
+    if algorithm in ['hash', 'index']:
+        build_bytes = left['bytes'] if build_left else right['bytes']
+        memory, spill = min(build_bytes, memory_budget), build_bytes > memory_budget
+    else:
+        memory = min(left['bytes'], memory_budget) + min(right['bytes'], memory_budget)
+        spill = max(left['bytes'], right['bytes']) > memory_budget
+
+    def distinct_keys(side, manifest):
+        distinct = side['statistics'].get(join_col, {}).get('distinct')
+        if distinct is None:
+            distinct = manifest_distinct_bound(manifest, join_col)
+        return min(distinct if distinct is not None else side['rows'], side['rows'])
+
+    left_keys, right_keys = distinct_keys(left, left_manifest), distinct_keys(right, right_manifest)
+    statistics = {
+        **{name: left['statistics'][col] for name, col in zip(left_names, left_schema.names) if col in left['statistics']},
+        **{name: right['statistics'][col] for name, col in zip(right_names, right_schema.names) if col in right['statistics']}
     }
-    # dict of tuples, 1 for each chunk
-    rows = { 
-        name: next(row_iterator, None) for name, row_iterator in row_iterators.items()
+    rows = left['rows'] * right['rows'] / max(left_keys, right_keys, 1) * filter_selectivity(statistics, filters)
+    row_bytes = (left['bytes'] / left['rows'] if left['rows'] else 0) + (right['bytes'] / right['rows'] if right['rows'] else 0)
+    return {
+        'operator': 'join', 'database': database, 'table': table_name, 'join_table': join_table_name,
+        'join_col': join_col, 'algorithm': algorithm, 'build_left': build_left, 'filters': filters,
+        'left': left, 'right': right, 'rows': round(rows), 'bytes': round(rows * row_bytes), 'width': len(schema),
+        'memory': round(memory), 'spill': spill, 'statistics': statistics
     }
 
-    grouped_data = [] # list to hold output buffer 
-    #out_partition_counter = 0
-    while any(chunks.values()):
-        current_agg_val = min(rows.values(), key=lambda x: x[group_idx])[group_idx]
-        vals = [] # list to hold all values to aggregate
-        for name in rows.keys():
-            while rows[name] is not None and rows[name] and rows[name][group_idx] == current_agg_val:
-                vals.append(rows[name][agg_idx])
-                rows[name] = next(row_iterators[name], None)
-                if not rows[name]:
-                    chunks[name] = next(chunk_iterators[name], False)
-                    if chunks[name] != False:
-                        row_iterators[name] = iter([tuple(t.values()) for t in chunks[name].to_pylist()])
-                        rows[name] = next(row_iterators[name], False)
-                    else:
-                        rows[name] = None
-                        break
-        if agg_func == 'sum':
-            yield (current_agg_val, sum(vals))
-        elif agg_func == 'count':
-            yield (current_agg_val, len(vals))
-        elif agg_func == 'average':
-            yield (current_agg_val, sum(vals) / len(vals))
-        elif agg_func == 'min':
-            yield (current_agg_val, min(vals))
-        elif agg_func == 'max':
-            yield (current_agg_val, max(vals))
-
-def partial_sort(prev_step_path, sort_col, reverse: bool = False):
-    '''Sorts each partition of a table sequentially and writes to disk'''
-    dataset = ds.dataset(prev_step_path, format='parquet')
-    sort_idx = dataset.schema.names.index(sort_col)
-
-    for partition in sorted(dataset.files, key=dataset_sort_key):
-        partition = Path(partition)
-        data = pl.read_parquet(partition).rows()
-        data = [row for row in data if row[sort_idx] is not None] # ignore None values when sorting
-        data.sort(key=lambda x: (x[sort_idx] is None, x[sort_idx]), reverse=reverse)
-        data = pl.DataFrame(data, schema=list(pl.read_parquet_schema(partition).keys())).to_arrow()
-        yield data, partition.stem
-
-def merge_sorted_runs(prev_step_path, sort_col, reverse: bool = False):
-    '''Merge phase of external merge sort'''
-    dataset = ds.dataset(prev_step_path, format='parquet')
-    sort_idx = dataset.schema.names.index(sort_col)
-    n_buffers = len(dataset.files) + 1 # add 1 for output buffer
-    out_buffer_len = dataset.count_rows() // len(dataset.files)
-
-    # create iterators of each of the files
-    chunk_iterators = {}
-    for partition in dataset.files:
-        pf = pq.ParquetFile(partition)
-        num_rows = pf.metadata.num_rows
-        chunk_iterators[Path(partition).stem] = pf.iter_batches(batch_size=num_rows // n_buffers)
-    out_partition_names = list(chunk_iterators.keys())
-    # store chunks of iterators in dictionary
-    chunks = {
-        name: next(chunk_iterator, False) for name, chunk_iterator in chunk_iterators.items()
-    }
+def execute_plan(plan, query_path, memory=None, partitions=None, profile=None):
+    '''Runs a plan from plan_query by chaining its operators as generators of (partition, name)'''
+    memory = memory or (profile.memory if profile is not None else MemoryManager())
+    for i, node in enumerate(plan):
+        operator = node['operator']
+        stats = profile.stats[i] if profile is not None else None
+        if operator == 'scan':
+            partitions = read_table(
+                database=node['database'], table_name=node['table'], columns=node['columns'],
+                filters=node['filters'] or None, limit=node['limit'], offset=node['offset'], stats=stats
+            )
+        elif operator == 'join':
+            partitions = join_tables(
+                node['database'], node['table'], node['join_table'], node['join_col'], spill_path=query_path / 'join',
+                left_filters=node['left']['filters'], right_filters=node['right']['filters'], filters=node['filters'],
+                algorithm=node['algorithm'], build_left=node['build_left'], memory=memory, stats=stats
+            )
+        elif operator == 'aggregate' and node.get('sketches') and i == 1:
+            # the scan before it is never read
+            partitions = name_partitions(sketch_aggregate(plan[0]['database'], node['table'], node['aggs']), node['table'])
+        elif operator == 'aggregate':
+            partitions = name_partitions(
+                hash_aggregate(partitions, node['group_cols'], node['aggs'], spill_path=query_path / 'aggregate',
+                               memory=memory.reserve('aggregate')),
+                node['table']
+            )
+        elif operator == 'filter':
+            partitions = filter_rows(partitions, filters=node['filters'])
+        elif operator == 'projection':
+            partitions = projection(partitions, node['selected_cols'], node['new_col_names'])
+        elif operator == 'distinct':
+            partitions = distinct_rows(partitions, spill_path=query_path / 'distinct', memory=memory.reserve('distinct'))
+        elif operator == 'top_n':
+            partitions = top_n(
+                partitions, node['sort_col'], node['n'], reverse=node['reverse'], nulls_first=node['nulls_first'],
+                spill_path=query_path / 'sort', memory=memory.reserve('top_n')
+            )
+        elif operator == 'sort':
+            partitions = sort_partitions(
+                partitions, node['sort_col'], reverse=node['reverse'], nulls_first=node['nulls_first'],
+                spill_path=query_path / 'sort', memory=memory.reserve('sort')
+            )
+        elif operator == 'limit':
+            partitions = limit_rows(partitions, limit=node['limit'], offset=node['offset'])
+        if profile is not None:
+            partitions = profile.operator(i, partitions)
+    return iter(partitions)
 
-    # create tuple iterators for individual rows 
-    row_iterators = {
-        name: iter([tuple(t.values()) for t in chunk.to_pylist()]) for name, chunk in chunks.items()
-    }
+def name_partitions(tables, table_name):
+    '''Pairs each table of an iterable with the partition name <table_name>_<position>'''
+    for n, data in enumerate(tables):
+        yield data, f'{table_name}_{n}'
+
+def format_bytes(n_bytes):
+    '''Human readable size of a number of bytes'''
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n_bytes < 1024 or unit == 'GB':
+            return f'{n_bytes:.0f} {unit}' if unit == 'B' else f'{n_bytes:.2f} {unit}'
+        n_bytes /= 1024
+
+def describe_operator(node):
+    '''One line description of an operator of a query plan'''
+    operator = node['operator']
+    if operator == 'scan':
+        text = f'scan {node["table"]}'
+        text += f' columns {node["columns"]}' if node['columns'] is not None else ''
+        text += f' filter {node["filters"]}' if len(node['filters']) else ''
+        text += f' using index on {node["index"]}' if node['index'] is not None else ''
+        text += f' skip {node["offset"]}' if node['offset'] else ''
+        text += f' trunc {node["limit"]}' if node['limit'] is not None else ''
+    elif operator == 'join':
+        text = f'{node["algorithm"].replace("_", "-")} join on {node["join_col"]}'
+        text += f' (build {node["table"] if node["build_left"] else node["join_table"]})' if node['algorithm'] in ['hash', 'index'] else ''
+        text += f' filter {node["filters"]}' if len(node['filters']) else ''
+    elif operator == 'aggregate':
+        text = f'aggregate {", ".join(f"{func}({col})" for func, col in node["aggs"])}'
+        text += f' group {", ".join(node["group_cols"])}' if len(node['group_cols']) else ''
+        text += ' from stored sketches' if node.get('sketches') else ''
+    elif operator == 'filter':
+        text = f'filter {node["filters"]}'
+    elif operator == 'projection':
+        text = 'projection ' + ', '.join(
+            col if col == name else f'{col}:{name}' for col, name in zip(node['selected_cols'], node['new_col_names'])
+        )
+    elif operator == 'distinct':
+        text = 'distinct'
+    elif operator in ['top_n', 'sort']:
+        text = f'top {node["n"]} ' if operator == 'top_n' else 'sort '
+        text += f'{"rev " if node["reverse"] else ""}{node["sort_col"]}{" nulls first" if node["nulls_first"] else ""}'
+    else:
+        text = f'limit skip {node["offset"] or 0}' + (f' trunc {node["limit"]}' if node['limit'] is not None else '')
+    estimates = f'rows={node["rows"]:,} bytes={format_bytes(node["bytes"])}'
+    if node['memory']:
+        estimates += f' memory={format_bytes(node["memory"])}'
+    if node['spill']:
+        estimates += ' spills'
+    return f'{text}  ({estimates})'
+
+def describe_actuals(profile, i):
+    '''Measurements of operator i of a plan run with profile (see QueryProfile.actuals), as text'''
+    actuals = profile.actuals(i)
+    text = f'time={actuals["wall"] * 1000:,.1f} ms cpu={actuals["cpu"] * 1000:,.1f} ms'
+    text += f' rows={actuals["rows_in"]:,}->{actuals["rows"]:,} bytes={format_bytes(actuals["bytes"])}'
+    text += f' read={format_bytes(actuals["read"])} spilled={format_bytes(actuals["written"])}'
+    if profile.plan[i]['operator'] in ['scan', 'join']:
+        text += f' pruned={actuals["files"] - actuals["files_read"]}/{actuals["files"]} files'
+    return f'[actual {text}]'
+
+def format_plan(plan, profile=None):
+    '''Text of a query plan, one operator per line indented under the operator it feeds, with the measurements of profile'''
+    lines = []
+    for depth, (i, node) in enumerate(reversed(list(enumerate(plan)))):
+        lines.append('  ' * depth + describe_operator(node) + (f'  {describe_actuals(profile, i)}' if profile is not None else ''))
+        if node['operator'] == 'join':
+            lines += ['  ' * (depth + 1) + describe_operator(node[side]) for side in ['left', 'right']]
+    memory = sum(node['memory'] + (node['left']['memory'] + node['right']['memory'] if node['operator'] == 'join' else 0) for node in plan)
+    lines.append(f'Estimated memory: {format_bytes(memory)}')
+    if profile is not None:
+        lines.append(
+            f'Peak memory: {format_bytes(profile.memory.peak)} reserved by operators, '
+            f'{format_bytes(profile.memory.arrow_peak)} allocated by Arrow'
+        )
+        lines.append(f'Total time: {profile.totals[-1]["wall"] * 1000:,.1f} ms (cpu {profile.totals[-1]["cpu"] * 1000:,.1f} ms)')
+    return '\n'.join(lines)
+
+def scan_columns(group_cols, aggs, columns):
+    '''Columns of the scanned table a query without a join needs, or None for all of them'''
+    if len(aggs):
+        return list(dict.fromkeys(group_cols + [col for _, col in aggs]))
+    if len(columns):
+        return list(dict.fromkeys(columns[0]))
+    return None
+
+def split_join_filters(filters, left_names, right_names, left_schema, right_schema):
+    '''(left filters, right filters, remaining filters) of filters on the output columns of a join'''
+    if not len(filters) or not isinstance(filters[0], tuple):
+        return [], [], filters
+    left_columns, right_columns = dict(zip(left_names, left_schema.names)), dict(zip(right_names, right_schema.names))
+    left_filters, right_filters, remaining = [], [], []
+    for col, op, val in filters:
+        if col in left_columns:
+            left_filters.append((left_columns[col], op, val))
+        elif col in right_columns:
+            right_filters.append((right_columns[col], op, val))
+        else:
+            remaining.append((col, op, val))
+    return left_filters, right_filters, remaining
+
+def join_tables(database, table_name, join_table_name, join_col, spill_path, left_filters=None, right_filters=None, filters=[],
+                algorithm='hash', build_left=True, memory=None, stats=None):
+    '''Inner join of two tables on join_col with algorithm ('hash', 'sort_merge' or 'index'). Yields at least one partition'''
+    memory = memory or MemoryManager()
+    left_manifest, right_manifest = read_manifest(database, table_name), read_manifest(database, join_table_name)
+    left_schema, right_schema = manifest_schema(left_manifest), manifest_schema(right_manifest)
+    schema, key_type = join_schema(left_schema, right_schema, join_col)
+    left_key, right_key = f'{join_col}_x', f'{join_col}_y'
+    left_names, right_names = schema.names[:len(left_schema)], schema.names[len(left_schema):]
+
+    # the side read to the end first (the build side of a hash join, the left side of a sort-merge join) collects its
+    # keys, the scan of the other side only yields the rows that may match one of them
+    left_first = build_left or algorithm == 'sort_merge'
+    second_schema = right_schema if left_first else left_schema
+    join_keys = None
+    if RUNTIME_JOIN_FILTERS and algorithm != 'index':
+        join_keys = KeyCollector(join_col, second_schema.field(join_col).type, memory.reserve('join_keys'))
+    stats = stats if stats is not None else {}
+    left = read_table(database=database, table_name=table_name, filters=left_filters or None, join_keys=None if left_first else join_keys, stats=stats)
+    right = read_table(database=database, table_name=join_table_name, filters=right_filters or None, join_keys=join_keys if left_first else None, stats=stats)
+    if join_keys is not None:
+        left, right = (join_keys.collect(left), right) if left_first else (left, join_keys.collect(right))
+    if algorithm == 'index':
+        # read the small side, then read only the rows of the other table with its keys through the index on join_col
+        build_side, build, build_memory = iter(left if build_left else right), [], memory.reserve('index_join')
+        fits = True
+        for partition in build_side:
+            build.append(partition)
+            if not build_memory.grow(partition[0].nbytes):
+                fits = False
+                break
+        build_memory.free()
+        if fits:
+            keys = pc.unique(pa.concat_tables([data for data, _ in build]).column(join_col)).drop_null().to_pylist()
+            probe_table, probe_filters = (join_table_name, right_filters) if build_left else (table_name, left_filters)
+            probe = read_table(database=database, table_name=probe_table, filters=(probe_filters or []) + [(join_col, 'in', keys)], stats=stats)
+            left, right = (build, probe) if build_left else (probe, build)
+        else:
+            # the small side turned out too large to look up its keys: hash join it with all of the other table instead
+            build = itertools.chain(build, build_side)
+            left, right = (build, right) if build_left else (left, build)
+        algorithm = 'hash'
+    if algorithm == 'hash':
+        joined = hash_join(
+            join_side(left, join_col, key_type, left_names), join_side(right, join_col, key_type, right_names),
+            left_key, right_key, spill_path=spill_path, build_left=build_left, memory=memory.reserve('hash_join')
+        )
+    else:
+        # sort both sides externally, then merge them
+        joined = merge_join(
+            join_side(sort_partitions(left, join_col, spill_path=Path(spill_path) / 'r', memory=memory.reserve('sort')), join_col, key_type, left_names),
+            join_side(sort_partitions(right, join_col, spill_path=Path(spill_path) / 's', memory=memory.reserve('sort')), join_col, key_type, right_names),
+            left_key, right_key
+        )
+    joined = ((conform_to_schema(data.to_arrow(), schema), f'{table_name}_{join_table_name}_{n}') for n, data in enumerate(joined))
+    if len(filters):
+        joined = filter_rows(joined, filters)
+    empty = True
+    try:
+        for data, name in joined:
+            empty = False
+            yield data, name
+    finally:
+        if join_keys is not None:
+            join_keys.memory.free()
+    if empty:
+        yield schema.empty_table(), f'{table_name}_{join_table_name}_0'
+
+def scan_candidates(table_path, manifest, schema, filters, limit, offset, join_keys, deltas):
+    '''(position, entry, deltas folded into it, index positions) of the partitions a scan reads, rows to skip in them, whether deltas are folded'''
+    candidates, skip, deltas_folded = [], offset or 0, False
+    exact = not filters and join_keys is None # the manifest row counts are the rows the scan yields
+    n_rows_taken = 0
+    for i, entry in enumerate(manifest['partitions']):
+        if exact and limit is not None and n_rows_taken >= skip + limit:
+            break
+        if filters and not statistics_may_match(entry['stats'], filters):
+            continue
+        positions = index_positions(table_path, manifest, entry, filters)
+        fold_deltas = i == len(manifest['partitions']) - 1 and len(deltas) > 0 and entry['bytes'] < MAX_PARTITION_SIZE
+        if positions is not None and not len(positions) and not fold_deltas:
+            continue
+        if not fold_deltas and not bloom_may_match(table_path, manifest, schema, entry, filters, join_keys):
+            continue
+        deltas_folded = deltas_folded or fold_deltas
+        n_rows = entry['rows'] - entry['deleted']
+        n_rows += sum(delta['rows'] - delta['deleted'] for delta in deltas) if fold_deltas else 0
+        if exact and not len(candidates) and n_rows <= skip:
+            skip -= n_rows # partitions entirely before the offset are skipped by their row counts
+            continue
+        candidates.append((i, entry, fold_deltas, positions))
+        n_rows_taken += n_rows
+    return candidates, skip, deltas_folded
+
+def read_table(database, table_name, columns=None, filters=None, limit=None, offset=None, join_keys=None, stats=None):
+    '''Reads specified table to temporary database, without deleted rows, pruned by columns, filters, limit/offset and join_keys'''
+    stats = stats if stats is not None else {}
+    for key in ['files', 'files_read', 'rows_read']:
+        stats.setdefault(key, 0)
+    if join_keys is not None:
+        # the other side of the join has been read by now: prune by the min/max of its keys like any other filter
+        filters = join_keys.filters(filters)
+
+    def join_keys_filter(data):
+        return join_keys.filter(data) if join_keys is not None else data
+
+    with table_lock(database, table_name):
+        manifest = read_manifest(database, table_name)
+        schema = manifest_schema(manifest)
+        table_path = DATA_PATH / database / table_name
+        stats['files'] += len(manifest['partitions']) + len(manifest['deltas'])
+        deltas = [entry for entry in manifest['deltas'] if not filters or statistics_may_match(entry['stats'], filters)]
+        candidates, skip, deltas_folded = scan_candidates(table_path, manifest, schema, filters, limit, offset, join_keys, deltas)
+        snapshot_path = snapshot_table_files(table_path, [entry for _, entry, _, _ in candidates], deltas)
+
+    def read_deltas():
+        return list(parallel_map(
+            lambda entry: join_keys_filter(read_partition(snapshot_path / '_delta' / entry['file'], columns=columns, filters=filters)),
+            deltas
+        ))
+
+    remaining = limit # rows still to yield (None for all)
+
+    def window(data):
+        nonlocal skip, remaining
+        if skip or remaining is not None:
+            n_rows = data.num_rows
+            data = data.slice(min(skip, n_rows), remaining)
+            skip = max(skip - n_rows, 0)
+            remaining = remaining - data.num_rows if remaining is not None else None
+        return data
+
+    def to_read():
+        for i, entry, fold_deltas, positions in candidates:
+            if remaining == 0:
+                return
+            stats['files_read'] += 1 + (len(deltas) if fold_deltas else 0)
+            stats['rows_read'] += entry['rows'] - entry['deleted']
+            stats['rows_read'] += sum(delta['rows'] - delta['deleted'] for delta in deltas) if fold_deltas else 0
+            yield i, snapshot_path / entry['file'], fold_deltas, positions
+
+    def read(candidate):
+        i, partition, fold_deltas, positions = candidate
+        data = join_keys_filter(read_partition(partition, columns=columns, filters=filters, positions=positions))
+        return i, pa.concat_tables([data] + read_deltas()) if fold_deltas else data
+
+    try:
+        # partitions are read ahead in parallel, unless only a window of the rows is needed
+        workers = 1 if skip or remaining is not None else None
+        empty = True
+        for i, data in parallel_map(read, to_read(), workers=workers):
+            empty = False
+            yield window(data), f'{table_name}_{i}'
+        if len(deltas) and not deltas_folded and remaining != 0:
+            empty = False
+            stats['files_read'] += len(deltas)
+            stats['rows_read'] += sum(entry['rows'] - entry['deleted'] for entry in deltas)
+            yield window(pa.concat_tables(read_deltas())), f'{table_name}_{len(manifest["partitions"])}'
+        if empty:
+            yield (schema.empty_table().select(columns) if columns is not None else schema.empty_table()), f'{table_name}_0'
+    finally:
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+
+def snapshot_table_files(table_path, partitions, deltas):
+    '''Hard links partition and delta files (manifest entries) of a table into a temporary directory, readable after the table lock is released'''
+    TEMP_DB_PATH.mkdir(parents=True, exist_ok=True)
+    snapshot_path = Path(tempfile.mkdtemp(prefix=f'snapshot_{Path(table_path).name}_', dir=TEMP_DB_PATH))
+    try:
+        for directory, entries in [('.', partitions), ('_delta', deltas)]:
+            for entry in entries:
+                path = Path(table_path) / directory / entry['file']
+                files = [path, deletion_vector_path(path)] if entry['deleted'] else [path]
+                for file in files:
+                    link = snapshot_path / file.relative_to(table_path)
+                    link.parent.mkdir(parents=True, exist_ok=True)
+                    os.link(file, link)
+    except BaseException:
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        raise
+    return snapshot_path
+
+def filter_rows(partitions, filters):
+    '''Filters each partition of an iterable of (partition, name) as it streams by (pyarrow.parquet filters format)'''
+    expression = pq.filters_to_expression(filters)
+    yield from parallel_map(lambda partition: (partition[0].filter(expression), partition[1]), partitions)
+
+def limit_rows(partitions, limit=None, offset=None):
+    '''Yields only the rows from offset to offset + limit of an iterable of (partition, name), then stops pulling partitions'''
+    skip, remaining = offset or 0, limit
+    for data, name in partitions:
+        n_rows = data.num_rows
+        data = data.slice(min(skip, n_rows), remaining)
+        skip = max(skip - n_rows, 0)
+        if remaining is not None:
+            remaining -= data.num_rows
+        yield data, name
+        if remaining == 0:
+            return
+
+def projection(partitions, selected_cols, new_col_names):
+    '''
+    Selects only specified columns from each partition of an iterable of (partition, name). Assigns new column names.
+    Yields projected data partitions and partition name
+    '''
+    for data, name in partitions:
+        yield data.select(selected_cols).rename_columns(new_col_names), name
+
+def agg_name(func, col):
+    '''Name of the output column of an aggregate, e.g. sum(x)'''
+    return f'{func}({col})'
+
+def hyperloglog_registers(hashes):
+    '''Polars expression of the sparse HyperLogLog sketch of 64 bit hashes, the sorted codes index * 64 + rank of its registers'''
+    precision = HYPERLOGLOG_PRECISION
+    if precision < 12:
+        raise ValueError(f'HYPERLOGLOG_PRECISION must be at least 12, got {precision}')
+    # polars hashes integers by a single multiplication, so mix the bits (murmur3's finalizer) before splitting them.
+    # Every step is cast back as polars types arithmetic on an empty group as null
+    for multiplier in (0xff51afd7ed558ccd, 0xc4ceb9fe1a85ec53):
+        hashes = (hashes.xor((hashes // 2 ** 33).cast(pl.UInt64)).cast(pl.UInt64) * multiplier).cast(pl.UInt64)
+    hashes = hashes.xor((hashes // 2 ** 33).cast(pl.UInt64)).cast(pl.UInt64)
+    rest = hashes % 2 ** (64 - precision)
+    # 64 - precision - floor(log2(rest)), and 64 - precision + 1 for rest = 0 (exact in float64 as rest < 2 ** 52)
+    rank = 64 - precision - (rest.cast(pl.Float64) + 0.5).log(2).floor()
+    return merge_registers(hashes // 2 ** (64 - precision) * 64 + rank.cast(pl.UInt64))
+
+def merge_registers(codes):
+    '''Polars expression merging register codes (see hyperloglog_registers) into a sketch: the highest rank per register'''
+    codes = codes.drop_nulls().cast(pl.UInt64).unique().sort()
+    return codes.filter((codes // 64).is_last_distinct())
+
+def estimate_registers(sketch):
+    '''Polars expression of the number of distinct values estimated from a list column of HyperLogLog sketches'''
+    m = 2 ** HYPERLOGLOG_PRECISION
+    alpha = 0.7213 / (1 + 1.079 / m)
+    n_registers = sketch.list.lengths().cast(pl.Float64)
+    inverse_sum = sketch.list.eval((-(pl.element() % 64).cast(pl.Float64) * math.log(2)).exp().sum()).list.first()
+    estimate = alpha * m ** 2 / (inverse_sum + (m - n_registers))
+    # linear counting of the empty registers is more accurate for small numbers of values
+    linear = m * (m / (m - n_registers)).log()
+    return pl.when((estimate <= 2.5 * m) & (n_registers < m)).then(linear).otherwise(estimate).round(0).cast(pl.Int64)
+
+SKETCH_DIR = '_sketch'
+
+def sketch_path(table_path, col, partition_file):
+    '''The HyperLogLog sketch of a column of a partition file is kept at <table>/_sketch/<col>/<partition file name>'''
+    return Path(table_path) / SKETCH_DIR / col / partition_file
+
+def file_sketch(path, col):
+    '''Register codes of the HyperLogLog sketch (see hyperloglog_registers) of the non-null values of col in the live rows of a file'''
+    data = pl.from_arrow(read_partition(path, columns=[col]))
+    return data.select(hyperloglog_registers(pl.col(col).drop_nulls().hash(seed=0)).alias('code'))['code']
+
+def stored_sketch(table_path, entry, col):
+    '''Sketch of col of a partition (its manifest entry), kept next to it until rows of the partition are deleted'''
+    path = sketch_path(table_path, col, entry['file'])
+    version = {'deleted': str(entry['deleted']), 'precision': str(HYPERLOGLOG_PRECISION)}
+    if path.exists():
+        sketch = pq.read_table(path)
+        if {key.decode(): value.decode() for key, value in sketch.schema.metadata.items()} == version:
+            return pl.from_arrow(sketch.column('code'))
+    codes = file_sketch(Path(table_path) / entry['file'], col)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    pq.write_table(pa.table({'code': codes.to_arrow()}).replace_schema_metadata(version), tmp_path)
+    os.replace(tmp_path, path)
+    return codes
 
-    # dict of tuples, 1 for each chunk
-    rows = { 
-        name: next(row_iterator, None) for name, row_iterator in row_iterators.items()
-     } 
-    
-    merged_data = [] # list to hold output buffer
-    out_partition_counter = 0
-    while any(chunks.values()):
-        if reverse == False:
-            curr_tuple = min(rows.values(), key=lambda x: x[sort_idx])
+def sketch_aggregate(database, table_name, aggs):
+    '''approx_count_distinct of columns of a whole table from the stored sketches of its partitions. Yields the result'''
+    with table_lock(database, table_name):
+        manifest = read_manifest(database, table_name)
+        table_path = DATA_PATH / database / table_name
+        states = {}
+        for i, (_, col) in enumerate(aggs):
+            sketches = [stored_sketch(table_path, entry, col) for entry in manifest['partitions']]
+            sketches += [file_sketch(path, col) for path in delta_files(database, table_name, manifest)]
+            states[f'__{i}_sketch'] = [pl.concat(sketches)]
+        data = pl.DataFrame(states).select(combine_aggregates(aggs, grouped=False))
+        yield data.select(final_aggregates(aggs)).to_arrow()
+
+def partial_aggregates(aggs, grouped=True, distinct_cols=None):
+    '''Polars expressions computing the partial (decomposable) state of each aggregate over a batch'''
+    def column(col):
+        return pl.col(col) if distinct_cols is None else pl.col(col).filter(pl.col('__copy') == 0)
+
+    exprs = []
+    for i, (func, col) in enumerate(aggs):
+        if func in ['sum', 'average']:
+            exprs.append(column(col).sum().alias(f'__{i}_sum'))
+        if func == 'count':
+            exprs.append(column(col).count().cast(pl.Int64).alias(f'__{i}_count'))
+        if func == 'average':
+            exprs.append(column(col).is_not_null().sum().cast(pl.Int64).alias(f'__{i}_count'))
+        if func in ['min', 'max']:
+            exprs.append(getattr(column(col), func)().alias(f'__{i}_{func}'))
+        if func == 'approx_count_distinct':
+            sketch = hyperloglog_registers(column(col).drop_nulls().hash(seed=0))
+            exprs.append((sketch if grouped else sketch.implode()).alias(f'__{i}_sketch'))
+        if func == 'count_distinct':
+            values = pl.col(col) if distinct_cols is None else pl.col(f'__distinct_{distinct_cols.index(col)}')
+            exprs.append(values.is_not_null().any().cast(pl.Int64).alias(f'__{i}_count_distinct'))
+    return exprs
+
+def combine_aggregates(aggs, grouped=True, count_distinct='sum'):
+    '''Polars expressions merging partial aggregate states'''
+    exprs = []
+    for i, (func, _) in enumerate(aggs):
+        if func in ['sum', 'average']:
+            exprs.append(pl.col(f'__{i}_sum').sum())
+        if func in ['count', 'average']:
+            exprs.append(pl.col(f'__{i}_count').sum())
+        if func in ['min', 'max']:
+            exprs.append(getattr(pl.col(f'__{i}_{func}'), func)())
+        if func == 'approx_count_distinct':
+            sketch = merge_registers(pl.col(f'__{i}_sketch').explode())
+            exprs.append((sketch if grouped else sketch.implode()).alias(f'__{i}_sketch'))
+        if func == 'count_distinct':
+            exprs.append(getattr(pl.col(f'__{i}_count_distinct'), count_distinct)())
+    return exprs
+
+def final_aggregates(aggs):
+    '''Polars expressions turning merged partial states into the aggregate values, named func(col)'''
+    exprs = []
+    for i, (func, col) in enumerate(aggs):
+        if func == 'average':
+            exprs.append((pl.col(f'__{i}_sum') / pl.col(f'__{i}_count')).alias(agg_name(func, col)))
+        elif func == 'approx_count_distinct':
+            exprs.append(estimate_registers(pl.col(f'__{i}_sketch')).alias(agg_name(func, col)))
         else:
-            curr_tuple = max(rows.values(), key=lambda x: x[sort_idx])
-        curr_chunk = list(filter(lambda x: rows[x] == curr_tuple, rows))[0]
-        merged_data.append(curr_tuple)
-        # write to disk if output buffer is full
-        if len(merged_data) > out_buffer_len:
-          yield pl.DataFrame(merged_data, schema=dataset.schema.names).to_arrow(), out_partition_names[out_partition_counter]
-          out_partition_counter += 1
-          merged_data = []
-        rows[curr_chunk] = next(row_iterators[curr_chunk], None)
-        if not rows[curr_chunk]:
-            # update chunks dict, load next chunk
-            chunks[curr_chunk] = next(chunk_iterators[curr_chunk], False)
-            # if still chunks to iterate, load next
-            if chunks[curr_chunk] != False:
-                # update row_iterators dict - create new tuple iterator
-                row_iterators[curr_chunk] = iter([tuple(t.values()) for t in chunks[curr_chunk].to_pylist()])
-                # update rows_dict
-                rows[curr_chunk] = next(row_iterators[curr_chunk], False)
-            # if no more chunks, remove from dict
+            exprs.append(pl.col(f'__{i}_{func}').alias(agg_name(func, col)))
+    return exprs
+
+def aggregate_frame(data, group_cols, exprs):
+    '''Applies aggregate expressions to a polars DataFrame, per group of group_cols or over the whole frame'''
+    if len(group_cols):
+        return data.group_by(group_cols).agg(exprs)
+    return data.select(exprs)
+
+def hash_buckets(data, group_cols, n_buckets, level=0):
+    '''Hash partition number of every row of a polars DataFrame by its group columns, from other hash bits at each level'''
+    # the high bits of the row hash are better mixed than the low bits
+    return (data.select(group_cols).hash_rows(seed=0) // (1 << 40) // n_buckets ** level) % n_buckets
+
+def concat_frames(frames):
+    '''pl.concat of polars DataFrames without the empty ones, which can leave an unsorted column flagged as sorted'''
+    frames = list(frames)
+    return pl.concat([data for data in frames if data.height] or frames[:1])
+
+def aggregate_states(frames, group_cols, batch_exprs, combine_exprs, spill_path, memory):
+    '''Partial aggregate states per group of polars DataFrames, spilled by hash of the group columns when they do not fit'''
+    partials, n_spills = [], 0
+
+    def spill(data):
+        buckets = hash_buckets(data, group_cols, SPILL_PARTITIONS)
+        for bucket in range(SPILL_PARTITIONS):
+            bucket_data = data.filter(buckets == bucket)
+            if not bucket_data.height:
+                continue
+            bucket_path = Path(spill_path) / f'bucket_{bucket}'
+            bucket_path.mkdir(parents=True, exist_ok=True)
+            bucket_data.write_parquet(bucket_path / f'spill_{n_spills}.parquet')
+            memory.spill(bucket_path / f'spill_{n_spills}.parquet')
+
+    try:
+        for data in frames:
+            partials.append(aggregate_frame(data, group_cols, batch_exprs))
+            if not memory.grow(partials[-1].estimated_size()):
+                merged = aggregate_frame(concat_frames(partials), group_cols, combine_exprs)
+                partials = [merged]
+                memory.free()
+                if len(group_cols) and (not memory.grow(merged.estimated_size()) or memory.size > memory.limit() // 2):
+                    spill(merged)
+                    n_spills += 1
+                    partials = []
+                    memory.free()
+
+        if not n_spills:
+            if not len(partials): # no input partitions
+                return
+            yield aggregate_frame(concat_frames(partials), group_cols, combine_exprs)
+            return
+        if len(partials):
+            spill(concat_frames(partials))
+            partials = []
+            memory.free()
+        for bucket in range(SPILL_PARTITIONS):
+            bucket_path = Path(spill_path) / f'bucket_{bucket}'
+            if bucket_path.exists():
+                states = concat_frames(pl.read_parquet(file) for file in sorted(bucket_path.glob('*.parquet')))
+                yield aggregate_frame(states, group_cols, combine_exprs)
+        shutil.rmtree(spill_path)
+    finally:
+        memory.free()
+
+def distinct_value_frames(frames, group_cols, distinct_cols):
+    '''Batches with the values of each counted column in __distinct_<n>, to aggregate per group and value'''
+    for data in frames:
+        copies = []
+        for n in range(len(distinct_cols)):
+            values = [
+                (pl.col(col) if k == n else pl.lit(None, dtype=data[col].dtype)).alias(f'__distinct_{k}')
+                for k, col in enumerate(distinct_cols)
+            ] + [pl.lit(n, dtype=pl.Int64).alias('__copy')]
+            copies.append(data.with_columns(values) if n == 0 else data.select([pl.col(col) for col in group_cols] + values))
+        yield pl.concat(copies, how='diagonal') if len(copies) > 1 else copies[0]
+
+def hash_aggregate(partitions, group_cols, aggs, spill_path, memory=None):
+    '''Hash aggregation over an iterable of (partition, name), spilling by group. Yields the result tables'''
+    memory = memory or MemoryManager().reserve('aggregate')
+    distinct_cols = list(dict.fromkeys(col for func, col in aggs if func == 'count_distinct'))
+    frames = (pl.from_arrow(partition) for partition, _ in partitions)
+    batch_exprs = partial_aggregates(aggs, grouped=bool(len(group_cols)))
+    if len(distinct_cols):
+        value_cols = group_cols + [f'__distinct_{n}' for n in range(len(distinct_cols))]
+        frames = aggregate_states(
+            distinct_value_frames(frames, group_cols, distinct_cols), value_cols,
+            partial_aggregates(aggs, distinct_cols=distinct_cols), combine_aggregates(aggs, count_distinct='max'),
+            Path(spill_path) / 'distinct', memory.manager.reserve('aggregate')
+        )
+        batch_exprs = combine_aggregates(aggs, grouped=bool(len(group_cols)))
+    final_exprs = final_aggregates(aggs)
+    for data in aggregate_states(
+        frames, group_cols, batch_exprs, combine_aggregates(aggs, grouped=bool(len(group_cols))), Path(spill_path) / 'groups', memory
+    ):
+        data = data.select(group_cols + final_exprs)
+        yield (data.sort(group_cols) if len(group_cols) else data).to_arrow()
+
+def distinct_rows(partitions, spill_path, memory=None):
+    '''Distinct rows of an iterable of (partition, name), a hash aggregation on all of their columns'''
+    partitions = iter(partitions)
+    first = next(partitions, None)
+    if first is None: # no input partitions
+        return
+    for n, data in enumerate(hash_aggregate(itertools.chain([first], partitions), first[0].column_names, [], spill_path, memory)):
+        yield data, f'distinct_{n}'
+
+def sort_order(sort_col, reverse=False, nulls_first=False):
+    '''Arguments of pyarrow Table.sort_by for one sort column: (sort keys, null placement)'''
+    return [(sort_col, 'descending' if reverse else 'ascending')], 'at_start' if nulls_first else 'at_end'
+
+def sort_partitions(partitions, sort_col, reverse: bool = False, nulls_first: bool = False, spill_path=None, memory=None):
+    '''Sorts an iterable of (partition, name) on one column, in memory or as an external merge sort'''
+    memory = memory or MemoryManager().reserve('sort')
+    sort_keys, null_placement = sort_order(sort_col, reverse, nulls_first)
+    buffer, n_runs, name = [], 0, 'sorted_0'
+
+    def write_run():
+        nonlocal n_runs
+        Path(spill_path).mkdir(parents=True, exist_ok=True)
+        data = pa.concat_tables(buffer)
+        slice_size = math.ceil(data.num_rows / QUERY_WORKERS) or 1
+        slices = [(n_runs + j, data.slice(offset, slice_size)) for j, offset in enumerate(range(0, data.num_rows, slice_size))]
+
+        def sort_run(run):
+            n, run_data = run
+            pq.write_table(run_data.sort_by(sort_keys, null_placement=null_placement), Path(spill_path) / f'run_{n}.parquet')
+            memory.spill(Path(spill_path) / f'run_{n}.parquet')
+
+        for _ in parallel_map(sort_run, slices):
+            pass
+        n_runs += len(slices)
+
+    try:
+        for data, name in partitions:
+            buffer.append(data)
+            if not memory.grow(data.nbytes):
+                write_run()
+                buffer = []
+                memory.free()
+
+        if not n_runs:
+            yield pa.concat_tables(buffer).sort_by(sort_keys, null_placement=null_placement), name
+            return
+        if len(buffer):
+            write_run()
+            buffer = []
+            memory.free()
+        yield from merge_sorted_runs(spill_path, sort_col=sort_col, reverse=reverse, nulls_first=nulls_first)
+        shutil.rmtree(spill_path, ignore_errors=True)
+    finally:
+        memory.free()
+
+def top_n(partitions, sort_col, n, reverse: bool = False, nulls_first: bool = False, spill_path=None, memory=None):
+    '''First n rows of an iterable of (partition, name) in sort order, in one streaming pass'''
+    memory = memory or MemoryManager().reserve('top_n')
+    sort_keys, null_placement = sort_order(sort_col, reverse, nulls_first)
+    partitions = iter(partitions)
+    top, name = None, 'top_0'
+    try:
+        for data, name in partitions:
+            data = data if top is None else pa.concat_tables([top, data])
+            top = data.take(pc.sort_indices(data, sort_keys=sort_keys, null_placement=null_placement)[:n])
+            if not memory.grow(top.nbytes - memory.size):
+                # rows seen so far outside the top n can never make it into the result
+                memory.free()
+                yield from sort_partitions(
+                    itertools.chain([(top, name)], partitions), sort_col, reverse, nulls_first, spill_path, memory
+                )
+                return
+        yield top, name
+    finally:
+        memory.free()
+
+class DescendingKey:
+    '''Inverts the ordering of a value, so that heapq (a min-heap) pops the largest key first'''
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def merge_key(value, reverse=False, nulls_first=False):
+    '''Heap key of a sort column value, ordered as Table.sort_by orders it with the same direction and null placement'''
+    if value is None:
+        return (0 if nulls_first else 2, None)
+    return (1, DescendingKey(value) if reverse else value)
+
+def merged_prefix_length(column, fence, reverse=False, nulls_first=False):
+    '''Number of leading rows of a sorted column that sort before or equal to fence, i.e. that can be merged now'''
+    null_count = column.null_count
+    if fence is None:
+        return len(column) if not nulls_first else null_count
+    compare = pc.greater_equal if reverse else pc.less_equal
+    n = pc.sum(compare(column, pa.scalar(fence, column.type))).as_py() or 0
+    return n + (null_count if nulls_first else 0)
+
+def merge_sorted_runs(prev_step_path, sort_col, reverse: bool = False, nulls_first: bool = False):
+    '''Merge phase of external merge sort: a k-way merge of the sorted runs under prev_step_path, one batch per run in memory'''
+    dataset = ds.dataset(prev_step_path, format='parquet')
+    schema = dataset.schema
+    files = sorted(dataset.files, key=dataset_sort_key)
+    out_partition_names = [Path(file).stem for file in files]
+    n_buffers = len(files) + 1 # add 1 for output buffer
+    total_rows = sum(pq.ParquetFile(file).metadata.num_rows for file in files)
+    out_buffer_len = max(math.ceil(total_rows / len(files)), 1)
+    sort_keys, null_placement = sort_order(sort_col, reverse, nulls_first)
+
+    # create batch iterators of each of the runs
+    batch_iterators = []
+    for file in files:
+        pf = pq.ParquetFile(file)
+        batch_iterators.append(pf.iter_batches(batch_size=max(pf.metadata.num_rows // n_buffers, 1)))
+
+    buffers = [None] * len(files)
+    heap = []
+
+    def refill(i):
+        for batch in batch_iterators[i]:
+            if batch.num_rows:
+                buffers[i] = pa.Table.from_batches([batch])
+                fence = buffers[i].column(sort_col)[-1].as_py()
+                heapq.heappush(heap, (merge_key(fence, reverse, nulls_first), i, fence))
+                return
+        buffers[i] = None
+
+    for i in range(len(files)):
+        refill(i)
+
+    merged_data, n_merged, out_partition_counter = [], 0, 0 # output buffer
+    while heap:
+        _, i, fence = heapq.heappop(heap)
+        if buffers[i] is not None and buffers[i].num_rows:
+            merged = []
+            for j, buffer in enumerate(buffers):
+                if buffer is None:
+                    continue
+                n = merged_prefix_length(buffer.column(sort_col), fence, reverse, nulls_first)
+                if n:
+                    merged.append(buffer.slice(0, n))
+                    buffers[j] = buffer.slice(n)
+            merged = pa.concat_tables(merged).sort_by(sort_keys, null_placement=null_placement)
+            merged_data.append(merged)
+            n_merged += merged.num_rows
+            # write to disk if output buffer is full
+            while n_merged >= out_buffer_len and out_partition_counter < len(files) - 1:
+                out = pa.concat_tables(merged_data)
+                yield out.slice(0, out_buffer_len), out_partition_names[out_partition_counter]
+                out_partition_counter += 1
+                merged_data, n_merged = [out.slice(out_buffer_len)], out.num_rows - out_buffer_len
+        refill(i)
+
+    yield (pa.concat_tables(merged_data) if merged_data else schema.empty_table()), out_partition_names[out_partition_counter]
+
+def join_schema(left_schema, right_schema, join_col):
+    '''Output schema of joining two tables on join_col, with the join columns suffixed _x and _y'''
+    key_type = merge_schemas(pa.schema([left_schema.field(join_col)]), pa.schema([right_schema.field(join_col)])).field(0).type
+    left_fields = [
+        pa.field(f'{field.name}_x', key_type) if field.name == join_col else field for field in left_schema
+    ]
+    right_fields = [
+        pa.field(f'{field.name}_y', key_type) if field.name == join_col
+        else field.with_name(f'{field.name}_y') if field.name in left_schema.names else field
+        for field in right_schema
+    ]
+    return pa.schema(left_fields + right_fields), key_type
+
+def join_side(partitions, join_col, key_type, names):
+    '''Partitions of one side of a join as polars DataFrames, without null keys, keys cast to key_type and columns renamed'''
+    for partition in partitions:
+        if isinstance(partition, tuple):
+            partition = partition[0]
+        partition = partition.filter(pc.is_valid(partition.column(join_col)))
+        partition = partition.set_column(
+            partition.schema.get_field_index(join_col), join_col, partition.column(join_col).cast(key_type)
+        )
+        yield pl.from_arrow(partition.rename_columns(names), rechunk=False)
+
+def join_frames(left, right, left_key, right_key):
+    '''Inner equi-join of two polars DataFrames, keeping the key columns of both sides'''
+    right = right.with_columns(pl.col(right_key).alias('__key'))
+    return left.join(right, left_on=left_key, right_on='__key', how='inner')
+
+def choose_join_algorithm(left_rows, right_rows, left_bytes, right_bytes, memory_budget=None):
+    '''Picks the join algorithm from the (estimated) rows and bytes of both sides. Returns (algorithm, build_left)'''
+    memory_budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    build_left = left_rows <= right_rows
+    build_bytes = left_bytes if build_left else right_bytes
+    if build_bytes <= memory_budget or min(left_rows, right_rows) * 4 <= max(left_rows, right_rows):
+        return 'hash', build_left
+    return 'sort_merge', build_left
+
+def hash_join(left, right, left_key, right_key, spill_path, build_left=True, memory=None):
+    '''Hash join of two iterables of polars DataFrames, falling back to grace_hash_join if the build side does not fit'''
+    memory = memory or MemoryManager().reserve('hash_join')
+    build_frames, probe_frames = (iter(left), iter(right)) if build_left else (iter(right), iter(left))
+    build = []
+    try:
+        for data in build_frames:
+            build.append(data)
+            if not memory.grow(data.estimated_size()):
+                memory.free()
+                build_frames = itertools.chain(build, build_frames)
+                left, right = (build_frames, probe_frames) if build_left else (probe_frames, build_frames)
+                yield from grace_hash_join(left, right, left_key, right_key, spill_path, build_left, memory)
+                return
+        if not len(build):
+            return
+        build = concat_frames(build)
+        for data in probe_frames:
+            if build_left:
+                yield join_frames(build, data, left_key, right_key)
             else:
-                del rows[curr_chunk]
-
-    yield pl.DataFrame(merged_data, schema=dataset.schema.names).to_arrow(), out_partition_names[out_partition_counter]
-
-def sort_merge_join(r_path, s_path, join_col):
-    '''r_path and s_path should point to sorted directories of sorted partitioned files'''
-    dataset_r = ds.dataset(r_path, format='parquet')
-    join_idx_r = dataset_r.schema.names.index(join_col)
-    dataset_s = ds.dataset(s_path, format='parquet')
-    join_idx_s = dataset_s.schema.names.index(join_col)
-
-    n_buffers = len(dataset_r.files) + len(dataset_s.files) + 1
-
-    chunk_iterators_r, chunk_iterators_s = {}, {}
-    for partition_r, partition_s in zip(dataset_r.files, dataset_s.files):
-        pf_r, pf_s = pq.ParquetFile(partition_r), pq.ParquetFile(partition_s)
-        num_rows_r, num_rows_s = pf_r.metadata.num_rows, pf_s.metadata.num_rows
-        chunk_iterators_r[Path(partition_r).stem] = pf_r.iter_batches(batch_size=num_rows_r // n_buffers)
-        chunk_iterators_s[Path(partition_s).stem] = pf_s.iter_batches(batch_size=num_rows_s // n_buffers)
-    
-    chunks_r = {
-        name: next(chunk_iterator_r, False) for name, chunk_iterator_r in chunk_iterators_r.items()
-    }
-    chunks_s = {
-        name: next(chunk_iterator_s, False) for name, chunk_iterator_s in chunk_iterators_s.items()
-    }
+                yield join_frames(data, build, left_key, right_key)
+    finally:
+        memory.free()
 
-    row_iterator_r = {
-        name: iter([tuple(t.values()) for t in chunk.to_pylist()]) for name, chunk in chunks_r.items()
-    }
-    row_iterator_s = {
-        name: iter([tuple(t.values()) for t in chunk.to_pylist()]) for name, chunk in chunks_s.items()
-    }
+GRACE_MAX_LEVEL = 3 # times a bucket of a grace hash join that does not fit in memory is partitioned again
+
+def grace_hash_join(left, right, left_key, right_key, spill_path, build_left=True, memory=None, level=0):
+    '''Grace hash join: both sides are hash partitioned into buckets under spill_path, joined a pair at a time'''
+    memory = memory or MemoryManager().reserve('hash_join')
+    for side, frames, key in [('left', left, left_key), ('right', right, right_key)]:
+        for n, data in enumerate(frames):
+            buckets = hash_buckets(data, [key], SPILL_PARTITIONS, level)
+            for bucket in range(SPILL_PARTITIONS):
+                bucket_data = data.filter(buckets == bucket)
+                if not bucket_data.height:
+                    continue
+                bucket_path = Path(spill_path) / side / f'bucket_{bucket}'
+                bucket_path.mkdir(parents=True, exist_ok=True)
+                bucket_data.write_parquet(bucket_path / f'spill_{n}.parquet')
+                memory.spill(bucket_path / f'spill_{n}.parquet')
+
+    def bucket_files(path):
+        return sorted(path.glob('*.parquet'), key=dataset_sort_key)
+
+    build_side, probe_side = ('left', 'right') if build_left else ('right', 'left')
+    for bucket in range(SPILL_PARTITIONS):
+        build_path, probe_path = Path(spill_path) / build_side / f'bucket_{bucket}', Path(spill_path) / probe_side / f'bucket_{bucket}'
+        if not build_path.exists() or not probe_path.exists():
+            continue
+        build = concat_frames(pl.read_parquet(file) for file in bucket_files(build_path))
+        size = build.estimated_size()
+        if not memory.grow(size) and size <= memory.limit() * SPILL_PARTITIONS ** (GRACE_MAX_LEVEL - level):
+            del build
+            build_frames = (pl.read_parquet(file) for file in bucket_files(build_path))
+            probe_frames = (pl.read_parquet(file) for file in bucket_files(probe_path))
+            left, right = (build_frames, probe_frames) if build_left else (probe_frames, build_frames)
+            yield from grace_hash_join(
+                left, right, left_key, right_key, Path(spill_path) / f'split_{bucket}', build_left, memory, level + 1
+            )
+            continue
+        for file in bucket_files(probe_path):
+            if build_left:
+                yield join_frames(build, pl.read_parquet(file), left_key, right_key)
+            else:
+                yield join_frames(pl.read_parquet(file), build, left_key, right_key)
+        memory.free()
+    shutil.rmtree(spill_path, ignore_errors=True)
+
+def merge_join(left, right, left_key, right_key):
+    '''Sort-merge join of two iterables of polars DataFrames sorted ascending by their keys'''
+    frames, keys = [iter(left), iter(right)], [left_key, right_key]
+    buffers = [None, None]
+
+    def load(i):
+        '''appends the next non-empty DataFrame of side i to its buffer, returns False when the side is exhausted'''
+        for data in frames[i]:
+            if data.height:
+                buffers[i] = data if buffers[i] is None else pl.concat([buffers[i], data])
+                return True
+        return False
+
+    exhausted = [False, False]
+    while True:
+        for i in range(2):
+            if not exhausted[i] and (buffers[i] is None or not buffers[i].height):
+                exhausted[i] = not load(i)
+        if any(buffer is None or not buffer.height for buffer in buffers):
+            return
+        fence = min(buffers[0][keys[0]][-1], buffers[1][keys[1]][-1])
+        # make sure every row with a key up to fence is buffered on both sides
+        for i in range(2):
+            while not exhausted[i] and buffers[i][keys[i]][-1] <= fence:
+                exhausted[i] = not load(i)
+        ready = [buffers[i].filter(pl.col(keys[i]) <= fence) for i in range(2)]
+        buffers = [buffers[i].slice(ready[i].height) for i in range(2)]
+        yield join_frames(ready[0], ready[1], left_key, right_key)
+
+# Result cache
+
+def normalize_filters(filters):
+    '''filters (pyarrow.parquet filters format) with the predicates of each conjunction, and the conjunctions, in a fixed order'''
+    if not len(filters):
+        return []
+    if isinstance(filters[0], tuple):
+        return sorted(filters, key=repr)
+    return sorted((sorted(conjunction, key=repr) for conjunction in filters), key=repr)
+
+def result_cache_key(database, query, tables):
+    '''Key of the result of a query in the result cache, a hash of the query and of the versions of the tables it reads'''
+    query = {**query, 'filters': normalize_filters(query['filters']), 'group_filter': normalize_filters(query['group_filter'])}
+    versions = []
+    for table_name in tables:
+        manifest = read_manifest(database, table_name)
+        versions.append([database, table_name, manifest.get('created', 0), manifest['version']])
+    return hashlib.sha256(json.dumps([query, versions], sort_keys=True, default=repr).encode()).hexdigest()
+
+class ResultCache:
+    '''Two-level LRU cache of query results, in memory up to memory_size bytes then on disk under path up to disk_size bytes'''
+    def __init__(self, path=None, memory_size=None, disk_size=None):
+        # None stands for RESULT_CACHE_PATH, RESULT_CACHE_MEMORY_SIZE and RESULT_CACHE_DISK_SIZE, read when the cache is used
+        self.path, self.memory_size, self.disk_size = path, memory_size, disk_size
+        self.memory = OrderedDict() # key -> (list of (partition, name), bytes, tables)
+        self.disk, self.disk_path = None, None # key -> (bytes, tables), read from disk_path on first use
+        self.memory_hits, self.disk_hits, self.misses = 0, 0, 0
+        self.lock = threading.RLock()
+
+    def cache_path(self):
+        return Path(self.path if self.path is not None else RESULT_CACHE_PATH)
+
+    def memory_limit(self):
+        return self.memory_size if self.memory_size is not None else RESULT_CACHE_MEMORY_SIZE
+
+    def disk_limit(self):
+        return self.disk_size if self.disk_size is not None else RESULT_CACHE_DISK_SIZE
+
+    def disk_entries(self):
+        '''The results on disk from least to most recently used'''
+        if self.disk is None or self.disk_path != self.cache_path():
+            self.disk, self.disk_path = OrderedDict(), self.cache_path()
+            for path in sorted(self.disk_path.glob('*.parquet'), key=os.path.getmtime):
+                metadata = pq.read_schema(path).metadata or {}
+                tables = [tuple(table) for table in json.loads(metadata.get(b'tables', b'[]'))]
+                self.disk[path.stem] = (os.path.getsize(path), tables)
+        return self.disk
+
+    def get(self, key):
+        '''The cached result of key as a list of (partition, name), or None'''
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key][0]
+            if key in self.disk_entries():
+                _, tables = self.disk.pop(key)
+                path = self.disk_path / f'{key}.parquet'
+                data = pq.read_table(path).replace_schema_metadata(None)
+                os.remove(path)
+                self.disk_hits += 1
+                self.put(key, [(data, 'cached_0')], tables)
+                return self.memory[key][0] if key in self.memory else [(data, 'cached_0')]
+            self.misses += 1
+            return None
+
+    def put(self, key, partitions, tables):
+        '''Caches the result partitions of key, a list of (partition, name), of a query on tables [(database, table)]'''
+        with self.lock:
+            n_bytes = sum(data.nbytes for data, _ in partitions)
+            self.memory[key] = (partitions, n_bytes, tables)
+            self.memory.move_to_end(key)
+            while sum(entry[1] for entry in self.memory.values()) > self.memory_limit():
+                evicted, (evicted_partitions, _, evicted_tables) = self.memory.popitem(last=False)
+                self.spill(evicted, evicted_partitions, evicted_tables)
+
+    def spill(self, key, partitions, tables):
+        '''Moves a result evicted from memory to disk, removing the least recently used results past disk_size'''
+        try:
+            data = pa.concat_tables([data for data, _ in partitions])
+        except pa.ArrowInvalid:
+            return # partitions with different schemas are not kept on disk
+        entries = self.disk_entries()
+        self.disk_path.mkdir(parents=True, exist_ok=True)
+        path = self.disk_path / f'{key}.parquet'
+        pq.write_table(data.replace_schema_metadata({'tables': json.dumps(tables)}), path)
+        entries[key] = (os.path.getsize(path), tables)
+        while sum(n_bytes for n_bytes, _ in entries.values()) > self.disk_limit():
+            evicted, _ = entries.popitem(last=False)
+            os.remove(self.disk_path / f'{evicted}.parquet')
+
+    def collect(self, key, partitions, tables):
+        '''Passes the result partitions of a query through, and caches them if it is read to the end and fits in memory'''
+        collected, n_bytes = [], 0
+        for data, name in partitions:
+            n_bytes += data.nbytes
+            if collected is not None and n_bytes <= self.memory_limit():
+                collected.append((data, name))
+            else:
+                collected = None
+            yield data, name
+        if collected is not None:
+            self.put(key, collected, tables)
+
+    def invalidate(self, database, table_name=None):
+        '''Removes the cached results of queries on a table, or on any table of a database if table_name is None'''
+        def stale(tables):
+            return any(db == database and (table_name is None or table == table_name) for db, table in tables)
+        with self.lock:
+            for key in [key for key, entry in self.memory.items() if stale(entry[2])]:
+                del self.memory[key]
+            entries = self.disk_entries()
+            for key in [key for key, (_, tables) in entries.items() if stale(tables)]:
+                del entries[key]
+                os.remove(self.disk_path / f'{key}.parquet')
 
-    rows_r = {name: next(row_iterator, None) for name, row_iterator in row_iterator_r.items()}
-    rows_s = {name: next(row_iterator, None) for name, row_iterator in row_iterator_s.items()}
-
-    r_tuples, s_tuples = [], []
-
-    while any(chunks_r.values()) and any(chunks_s.values()):
-        min_value = min(min([val for val in rows_r.values() if val], key=lambda x: x[join_idx_r])[join_idx_r], min([val for val in rows_s.values() if val], key=lambda x: x[join_idx_s])[join_idx_s])
-        for name in rows_r.keys():
-            while rows_r[name] is not None and rows_r[name] and rows_r[name][join_idx_r] == min_value: 
-                r_tuples.append(rows_r[name])
-                rows_r[name] = next(row_iterator_r[name], None)
-                if not rows_r[name]:
-                    chunks_r[name] = next(chunk_iterators_r[name], False)
-                    if chunks_r[name] != False:
-                        row_iterator_r[name] = iter([tuple(t.values()) for t in chunks_r[name].to_pylist()])
-                        rows_r[name] = next(row_iterator_r[name], False)
-                    else:
-                        rows_r[name]
-                        break
-        for name in rows_s.keys():
-            while rows_s[name] is not None and rows_s[name][join_idx_s] == min_value:
-                s_tuples.append(rows_s[name])
-                rows_s[name] = next(row_iterator_s[name], None)
-                if not rows_s[name]:
-                    chunks_s[name] = next(chunk_iterators_s[name], False)
-                    if chunks_s[name] != False:
-                        row_iterator_s[name] = iter([tuple(t.values()) for t in chunks_s[name].to_pylist()])
-                        rows_s[name] = next(row_iterator_s[name], False)
-                    else:
-                        rows_s[name] = None
-                        break
-        yield [(r + s) for r in r_tuples for s in s_tuples]
-        r_tuples, s_tuples = [], []
+    def statistics(self):
+        '''Hit and miss counters and the number and size of the cached results in memory and on disk'''
+        with self.lock:
+            disk = self.disk_entries()
+            return {
+                'hits': self.memory_hits + self.disk_hits,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_results': len(self.memory),
+                'memory_bytes': sum(entry[1] for entry in self.memory.values()),
+                'disk_results': len(disk),
+                'disk_bytes': sum(n_bytes for n_bytes, _ in disk.values())
+            }
+
+result_cache = ResultCache()
+
+# Materialized views
+
+VIEW_STATE_DIR = '_view' # directory of a view holding the aggregate states its result is computed from
+INCREMENTAL_VIEW_AGGREGATES = ['sum', 'count', 'min', 'max', 'average']
+
+def check_not_view(manifest, table_name):
+    '''Raises ValueError if a manifest is that of a view, whose rows only change with the tables it reads'''
+    if 'view' in manifest:
+        raise ValueError(f'{table_name} is a view, change the tables it reads instead')
+
+def view_mode(query):
+    '''How a view on query is refreshed on insert: aggregate, append or recompute'''
+    if query['join_table_name'] or query['distinct']:
+        return 'recompute'
+    if len(query['aggs']):
+        return 'aggregate' if all(func in INCREMENTAL_VIEW_AGGREGATES for func, _ in query['aggs']) else 'recompute'
+    if query['sort_col'] or query['limit'] is not None or query['offset']:
+        return 'recompute'
+    return 'append'
+
+def view_state_path(path, start):
+    '''The aggregate states of a view written with the result from partition start'''
+    return Path(path) / VIEW_STATE_DIR / f'state_{start}.parquet'
+
+def manifest_view_state_path(path, manifest):
+    '''Path of the aggregate states of the view under path that go with the partitions of its manifest'''
+    return view_state_path(path, dataset_sort_key(manifest['partitions'][0]['file']))
+
+def write_view(path, view_name, partitions, state=None, start=0):
+    '''Writes the result partitions of a view under path from partition start, and its aggregate states'''
+    partitions = iter(partitions)
+    first, _ = next(partitions) # execute_plan always yields a partition
+    batches = (conform_to_schema(data, first.schema) for data, _ in itertools.chain([(first, None)], partitions))
+    write_partitions(batches, path, view_name, first.schema, start=start)
+    if state is not None:
+        Path.mkdir(Path(path) / VIEW_STATE_DIR, exist_ok=True)
+        state.write_parquet(view_state_path(path, start))
+
+def aggregated_view(state, plan, query_path):
+    '''Result partitions of an 'aggregate' view from its aggregate states per group'''
+    group_cols, aggs = plan[1]['group_cols'], plan[1]['aggs']
+    data = state.select(group_cols + final_aggregates(aggs))
+    data = data.sort(group_cols) if len(group_cols) else data
+    return execute_plan(plan[2:], query_path, partitions=[(data.to_arrow(), f'{plan[1]["table"]}_0')])
+
+def materialize_view(database, view_name, view, path, query_path, start=0):
+    '''Runs the query of a view and writes its result under path from partition start'''
+    plan = plan_query(database, **ast.literal_eval(view['query']))
+    if view['mode'] != 'aggregate':
+        write_view(path, view_name, execute_plan(plan, query_path), start=start)
+        return
+    group_cols, aggs = plan[1]['group_cols'], plan[1]['aggs']
+    grouped = bool(len(group_cols))
+    states = aggregate_states(
+        (pl.from_arrow(data) for data, _ in execute_plan(plan[:1], query_path)), group_cols,
+        partial_aggregates(aggs, grouped), combine_aggregates(aggs, grouped), query_path / 'aggregate',
+        MemoryManager().reserve('aggregate')
+    )
+    state = pl.concat(list(states)) # spilled partitions hold different groups
+    write_view(path, view_name, aggregated_view(state, plan, query_path), state, start)
+
+def create_view(database, view_name, query, query_path):
+    '''Creates a materialized view of query as the table view_name. Returns how it is refreshed on insert'''
+    sources = [query['table_name']] + ([query['join_table_name']] if query['join_table_name'] else [])
+    view = {'query': repr(query), 'mode': view_mode(query), 'sources': sources}
+    table_path = DATA_PATH / database / view_name
+    with contextlib.ExitStack() as stack:
+        # the tables read can not change until the view is listed in their manifests
+        for source in sorted(set(sources)):
+            stack.enter_context(table_lock(database, source))
+        Path.mkdir(table_path)
+        try:
+            materialize_view(database, view_name, view, table_path, query_path)
+            register_table(database, view_name, view=view)
+        except Exception:
+            shutil.rmtree(table_path, ignore_errors=True)
+            raise
+        for source in set(sources):
+            manifest = read_manifest(database, source)
+            manifest['views'] = manifest.get('views', []) + [view_name]
+            write_manifest(DATA_PATH / database / source, manifest)
+    return view['mode']
+
+def refresh_views(database, table_name, manifest, inserted=None):
+    '''Brings the views that read a table up to date after a write to it, with the inserted rows if it was an insert'''
+    for view_name in manifest.get('views', []):
+        if not (DATA_PATH / database / view_name / MANIFEST_NAME).exists(): # the view was dropped
+            continue
+        query_path = TEMP_DB_PATH / f'view_{view_name}_{time.time_ns()}'
+        view_path = DATA_PATH / database / view_name
+        try:
+            with table_lock(database, view_name):
+                view_manifest = read_manifest(database, view_name)
+                view = view_manifest['view']
+                mode = view['mode'] if inserted is not None else 'recompute'
+                if mode == 'recompute':
+                    swap_table_files(
+                        database, view_name, view_manifest,
+                        lambda start: materialize_view(database, view_name, view, view_path, query_path, start)
+                    )
+                    refresh_views(database, view_name, read_manifest(database, view_name))
+                    continue
+
+                plan = plan_query(database, **ast.literal_eval(view['query']))
+                rows = inserted.filter(pq.filters_to_expression(plan[0]['filters'])) if plan[0]['filters'] else inserted
+                if not rows.num_rows: # none of the inserted rows is in the view
+                    continue
+                if mode == 'append':
+                    partitions = execute_plan(plan[1:], query_path, partitions=[(rows, f'{table_name}_insert')])
+                    data = pa.concat_tables(data for data, _ in partitions)
+                    append_rows(database, view_name, conform_to_schema(data, manifest_schema(view_manifest)))
+                    continue
+
+                group_cols, aggs = plan[1]['group_cols'], plan[1]['aggs']
+                grouped = bool(len(group_cols))
+                state = pl.concat([
+                    pl.read_parquet(manifest_view_state_path(view_path, view_manifest)),
+                    aggregate_frame(pl.from_arrow(rows), group_cols, partial_aggregates(aggs, grouped))
+                ], how='vertical_relaxed')
+                state = aggregate_frame(state, group_cols, combine_aggregates(aggs, grouped))
+                swap_table_files(
+                    database, view_name, view_manifest,
+                    lambda start: write_view(view_path, view_name, aggregated_view(state, plan, query_path), state, start)
+                )
+                refresh_views(database, view_name, read_manifest(database, view_name))
+        finally:
+            shutil.rmtree(query_path, ignore_errors=True)
 
 # Update
 
@@ -543,38 +2594,201 @@ def modify(database, table_name, filters, update_col, update_val):
     update_val = data to update with
     currently supports 'and' condition
     if you would like to update an or condition, just call the function for each condiition
+
+    Only the partitions with a matching row are rewritten, to new files swapped in by a single manifest update
     '''
+    operator_mapping = {
+        '>': lambda x, y: x > y,
+        '<': lambda x, y: x < y,
+        '>=': lambda x, y: x >= y,
+        '<=': lambda x, y: x <= y,
+        '=': lambda x, y: x == y,
+        '!=': lambda x, y: x != y,
+        'in': lambda x, y: x.is_in(list(y)),
+        'not in': lambda x, y: x.is_in(list(y)).not_()
+    }
+    if isinstance(update_val, str):
+        update_val = update_val.strip('"').strip("'")
+    with table_lock(database, table_name):
+        # pending inserts are folded into the base partitions first, which are rewritten below
+        check_not_view(read_manifest(database, table_name), table_name)
+        merge_deltas(database=database, table_name=table_name)
+        table_path = DATA_PATH / database / table_name
+        manifest = read_manifest(database, table_name)
+        def may_match(entry):
+            if not statistics_may_match(entry['stats'], filters):
+                return False
+            positions = index_positions(table_path, manifest, entry, filters)
+            return positions is None or len(positions) > 0
 
-    for partition, name in read_table(database=database, table_name=table_name):
-        target_schema = partition.schema
-        partition = pl.DataFrame._from_arrow(partition)
-        operator_mapping = {
-            '>': lambda x, y: x > y,
-            '<': lambda x, y: x < y,
-            '>=': lambda x, y: x >= y,
-            '<=': lambda x, y: x <= y,
-            '=': lambda x, y: x == y,
-            '!=': lambda x, y: x != y,
-            'in': lambda x, y: x in y,
-            'not in': lambda x, y: x not in y
-        }
-        # example filter: [('age', '>', 30), ('name', '=', 'Alice'), ('age', '<=', 50)]
-        # iterate through list of filter tuples and generate boolean mask
-        mask = operator_mapping[filters[0][1]](partition[filters[0][0]], filters[0][2])
-        for i in range(1, len(filters)):
-            mask = mask & (operator_mapping[filters[i][1]](partition[filters[i][0]], filters[i][2]))
-
-        partition = partition.with_columns(
-            pl.when(mask).then(update_val).otherwise(pl.col(update_col)).alias(update_col)
-        )
-        if isinstance(update_val, str):
-            partition = partition.with_columns(partition[update_col].apply(lambda x: x.strip('"').strip("'")))
+        # every candidate partition gets a new file number up front, so they can be rewritten in parallel
+        candidates = [
+            (i, path, entry, table_path / f'{table_name}_{manifest["next_partition"] + n}.parquet')
+            for n, (i, path, entry) in enumerate(
+                (i, path, entry)
+                for i, (path, entry) in enumerate(zip(table_partitions(database, table_name, manifest), manifest['partitions']))
+                if may_match(entry)
+            )
+        ]
+        manifest['next_partition'] += len(candidates)
+
+        def modify_partition(candidate):
+            '''Writes the updated partition to its new file, returns its manifest entry or None if no row matches'''
+            _, path, entry, new_path = candidate
+            partition = pq.read_table(path)
+            target_schema = partition.schema
+            partition = pl.from_arrow(partition)
+            # example filter: [('age', '>', 30), ('name', '=', 'Alice'), ('age', '<=', 50)]
+            # iterate through list of filter tuples and generate boolean mask
+            mask = operator_mapping[filters[0][1]](partition[filters[0][0]], filters[0][2])
+            for j in range(1, len(filters)):
+                mask = mask & (operator_mapping[filters[j][1]](partition[filters[j][0]], filters[j][2]))
+            if not mask.any():
+                return None
+
+            partition = partition.with_columns(
+                pl.when(mask).then(pl.lit(update_val)).otherwise(pl.col(update_col)).alias(update_col)
+            )
+            partition = partition.to_arrow()
+            partition = partition.cast(target_schema=target_schema)
+            pq.write_table(table=partition, where=new_path)
+            if entry['deleted']:
+                shutil.copyfile(deletion_vector_path(path), deletion_vector_path(new_path))
+            return file_entry(new_path, entry['deleted'])
+
+        replaced = []
+        for (i, path, _, _), new_entry in zip(candidates, parallel_map(modify_partition, candidates)):
+            if new_entry is not None:
+                manifest['partitions'][i] = new_entry
+                replaced.append(path)
+        if not len(replaced):
+            return
+        write_manifest(table_path, manifest)
+        for path in replaced:
+            os.remove(path)
+            remove_deletion_vector(path)
+        refresh_views(database, table_name, manifest)
 
-        partition = partition.to_arrow()
-        partition = partition.cast(target_schema=target_schema)
-        pq.write_table(table=partition, where=(DATA_PATH / database / table_name / name).with_suffix('.parquet'))
-        
 # Delete
 def drop_rows(database, table_name, filters):
-    for partition, name in filter_rows(prev_step_path=(DATA_PATH / database / table_name), filters=filters):
-        pq.write_table(table=partition, where=(DATA_PATH / database / table_name / name).with_suffix('.parquet'))
+    '''Removes the rows that satisfy filters by recording them in deletion vectors. Returns the number of rows removed'''
+    columns = filter_columns(filters)
+    n_removed = 0
+    with table_lock(database, table_name):
+        check_not_view(read_manifest(database, table_name), table_name)
+        merge_deltas(database=database, table_name=table_name)
+        table_path = DATA_PATH / database / table_name
+        manifest = read_manifest(database, table_name)
+        _, index_filters = index_predicates(manifest, filters)
+        for path, entry in zip(table_partitions(database, table_name, manifest), manifest['partitions']):
+            if not statistics_may_match(entry['stats'], filters):
+                continue
+            positions = index_positions(table_path, manifest, entry, filters)
+            if positions is None:
+                positions = matching_positions(pq.read_table(path, columns=list(columns)), filters)
+            elif len(positions) and len(index_filters) < len(filters):
+                # check the filters the index does not answer on the rows it points to
+                candidates = read_partition(path, columns=list(columns), positions=positions)
+                positions = positions.take(matching_positions(candidates, filters))
+            if not len(positions):
+                continue
+            deleted = read_deletion_vector(path) if entry['deleted'] else None
+            if deleted is not None:
+                positions = pa.chunked_array([deleted, positions.cast(pa.uint32())])
+            positions = pc.unique(positions).sort()
+            n_removed += len(positions) - entry['deleted']
+            entry['deleted'] = len(positions)
+            write_deletion_vector(path, positions)
+        if n_removed:
+            write_manifest(table_path, manifest)
+            refresh_views(database, table_name, manifest)
+    return n_removed
+
+# Compaction
+
+def needs_compaction(database, table_name):
+    '''Whether a table spreads over at least COMPACT_MIN_FILES more files than its live rows require'''
+    manifest = read_manifest(database, table_name)
+    files = manifest['partitions'] + manifest['deltas']
+    total_size = 0
+    for entry in files:
+        live_fraction = 1 - entry['deleted'] / entry['rows'] if entry['rows'] else 1
+        total_size += entry['bytes'] * live_fraction
+    return len(files) - max(1, math.ceil(total_size / MAX_PARTITION_SIZE)) >= COMPACT_MIN_FILES
+
+def compact_table(database, table_name):
+    '''Rewrites the files of a table into as few full size partitions as possible. Returns (files before, partitions after)'''
+    with table_lock(database, table_name):
+        manifest = read_manifest(database, table_name)
+        n_files = len(manifest['partitions']) + len(manifest['deltas'])
+        schema = manifest_schema(manifest)
+
+        def write(start):
+            batches = (conform_to_schema(data, schema) for data, _ in read_table(database=database, table_name=table_name))
+            n_partitions, _ = write_partitions(batches, DATA_PATH / database / table_name, table_name, schema, start=start)
+            return n_partitions
+
+        return n_files, swap_table_files(database, table_name, manifest, write)
+
+def swap_table_files(database, table_name, manifest, write):
+    '''Replaces the files of a table by the partitions write(start) writes, committed by replacing the manifest'''
+    with table_lock(database, table_name):
+        table_path = DATA_PATH / database / table_name
+        remove_unlisted_files(table_path, manifest)
+        start = manifest['next_partition']
+        result = write(start)
+        partitions = sorted(
+            (path for path in table_path.glob('*.parquet') if dataset_sort_key(path) >= start), key=dataset_sort_key
+        )
+        swapped = dict(
+            manifest,
+            schema=pq.read_schema(partitions[0]).serialize().to_pybytes().hex(),
+            partitions=[file_entry(path) for path in partitions],
+            deltas=[],
+            next_partition=dataset_sort_key(partitions[-1]) + 1
+        )
+        if 'view' in manifest:
+            state_path = manifest_view_state_path(table_path, manifest)
+            if state_path.exists() and not manifest_view_state_path(table_path, swapped).exists():
+                shutil.copyfile(state_path, manifest_view_state_path(table_path, swapped))
+        write_manifest(table_path, swapped)
+        remove_unlisted_files(table_path, swapped)
+        return result
+
+def remove_unlisted_files(table_path, manifest):
+    '''Removes the partition, delta and deletion vector files and view states of a table its manifest does not list'''
+    table_path = Path(table_path)
+    partitions = {entry['file'] for entry in manifest['partitions']}
+    deltas = {entry['file'] for entry in manifest['deltas']}
+    for path in itertools.chain(table_path.glob('*.parquet'), (table_path / '_deleted').glob('*.parquet')):
+        if path.name not in partitions:
+            os.remove(path)
+    for path in (table_path / '_delta').glob('*.parquet'):
+        if path.name not in deltas:
+            os.remove(path)
+    if 'view' in manifest:
+        state_path = manifest_view_state_path(table_path, manifest)
+        for path in (table_path / VIEW_STATE_DIR).glob('*.parquet'):
+            if path != state_path:
+                os.remove(path)
+
+def compact_databases():
+    '''Compacts every table of every database that needs compaction'''
+    for database in list_databases():
+        for table_name in list_tables(database):
+            if needs_compaction(database, table_name):
+                compact_table(database, table_name)
+
+def start_background_compactor(interval=COMPACT_INTERVAL):
+    '''Starts a daemon thread running compact_databases every interval seconds. Returns the threading.Event that stops it'''
+    stop_event = threading.Event()
+
+    def run():
+        while not stop_event.wait(interval):
+            try:
+                compact_databases()
+            except Exception:
+                pass # a failed pass is retried on the next interval
+
+    threading.Thread(target=run, name='miggydb-compactor', daemon=True).start()
+    return stop_event
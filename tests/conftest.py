@@ -0,0 +1,63 @@
+import os
+import tempfile
+
+# databases live under ~/miggydb, which src.config resolves from HOME when it is imported
+os.environ['HOME'] = tempfile.mkdtemp(prefix='miggydb_tests_')
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import polars as pl
+import pytest
+
+from src import utils
+
+
+@pytest.fixture(autouse=True)
+def no_result_cache(monkeypatch):
+    '''Queries are planned and run every time instead of being answered from the result cache'''
+    monkeypatch.setattr(utils, 'RESULT_CACHE', False)
+
+
+@pytest.fixture
+def database():
+    '''A new empty database, removed after the test'''
+    utils.DATA_PATH.mkdir(parents=True, exist_ok=True)
+    name = f'test_{os.urandom(4).hex()}'
+    utils.create_database(name)
+    yield name
+    utils.drop_database(name)
+
+
+@pytest.fixture
+def small_partitions(monkeypatch):
+    '''Ingests read blocks of about 1 kB, each written to its own partition'''
+    monkeypatch.setattr(utils, 'INGEST_BLOCK_SIZE', 1024)
+    monkeypatch.setattr(utils, 'MAX_PARTITION_SIZE', 1)
+
+
+@pytest.fixture
+def create_table(database, tmp_path):
+    '''Function creating the table table_name from a dict of columns (or a pyarrow table), through a csv file'''
+    def create(table_name, columns):
+        path = tmp_path / f'{table_name}.csv'
+        pa_csv.write_csv(pa.table(columns) if isinstance(columns, dict) else columns, path)
+        utils.create_table_from_csv(path=path, database=database, table_name=table_name)
+    return create
+
+
+
+@pytest.fixture
+def run_query(database, tmp_path):
+    '''Function running a query (the keyword arguments of utils.plan_query) to a polars DataFrame, with its MemoryManager if memory_budget is given'''
+    def run(memory_budget=None, **query):
+        memory = utils.MemoryManager(memory_budget, memory_budget)
+        plan = utils.plan_query(database, memory_budget=memory_budget, **query)
+        partitions = utils.execute_plan(plan, tmp_path / f'query_{os.urandom(4).hex()}', memory=memory)
+        data = pl.from_arrow(pa.concat_tables(data for data, _ in partitions))
+        return (data, memory) if memory_budget is not None else data
+    return run
+
+@pytest.fixture
+def read_all(database):
+    '''Function reading all the rows of a table as a polars DataFrame'''
+    return lambda table_name: pl.from_arrow(pa.concat_tables(data for data, _ in utils.read_table(database, table_name)))
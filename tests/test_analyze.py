@@ -0,0 +1,38 @@
+import json
+
+import numpy as np
+
+from src import utils
+
+
+def test_analyze_nested_columns(database, tmp_path):
+    records = [
+        {'id': i, 'point': {'x': i % 7, 'y': 'a'}, 'tags': [i % 5, i % 3], 'note': None if i % 4 else f'n{i}'}
+        for i in range(300)
+    ] + [{'id': 300, 'point': None, 'tags': None, 'note': None}]
+    path = tmp_path / 'nested.json'
+    path.write_text('\n'.join(json.dumps(record) for record in records))
+    utils.create_table_from_json(path, database, 'nested')
+
+    statistics = utils.analyze_table(database, 'nested')
+    columns = statistics['columns']
+    assert statistics['rows'] == 301
+    assert columns['id']['min'] == 0 and columns['id']['max'] == 300
+    for name, n_distinct in [('point', 7), ('tags', 15)]:
+        assert columns[name]['min'] is None and columns[name]['max'] is None
+        assert columns[name]['distinct'] == n_distinct
+        assert columns[name]['null_fraction'] == 1 / 301
+    assert utils.read_manifest(database, 'nested')['statistics'] == statistics
+
+    # the statistics are used to plan queries on the table
+    plan = utils.plan_query(database, table_name='nested', filters=[('id', '<', 150)])
+    assert 100 <= plan[0]['rows'] <= 200
+
+
+def test_join_estimate_bounded_by_manifest_statistics(database, create_table):
+    create_table('orders', {'orderkey': np.arange(1000)})
+    create_table('lineitem', {'orderkey': np.arange(3000) % 1000, 'quantity': np.arange(3000) % 50})
+
+    plan = utils.plan_query(database, table_name='orders', join_table_name='lineitem', join_col='orderkey')
+    assert 'statistics' not in utils.read_manifest(database, 'orders')
+    assert 1500 <= plan[0]['rows'] <= 6000
@@ -0,0 +1,110 @@
+import contextlib
+import io
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from src import utils
+from src.cli import DatabaseCLI
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    '''An empty result cache under tmp_path, used by queries instead of the one under DATA_PATH'''
+    cache = utils.ResultCache(path=tmp_path / 'cache')
+    monkeypatch.setattr(utils, 'RESULT_CACHE', True)
+    monkeypatch.setattr(utils, 'result_cache', cache)
+    return cache
+
+
+@pytest.fixture
+def numbers(database, create_table):
+    create_table('numbers', {'id': np.arange(100), 'value': np.arange(100) % 7})
+    create_table('others', {'id': np.arange(10)})
+
+
+def query(database, tmp_path, **kwargs):
+    '''Runs a query through utils.execute_query to the end, returns its rows as a pyarrow table'''
+    partitions = utils.execute_query(database, query_path=tmp_path / 'query', **kwargs)
+    return pa.concat_tables(data for data, _ in partitions)
+
+
+def test_repeated_query_is_a_hit(database, numbers, cache, tmp_path, monkeypatch):
+    first = query(database, tmp_path, table_name='numbers', filters=[('id', '<', 50), ('value', '=', 3)])
+    assert cache.statistics()['misses'] == 1 and cache.statistics()['hits'] == 0
+
+    # the cached result is returned without planning the query, whatever the order of its filters
+    monkeypatch.setattr(utils, 'plan_query', None)
+    second = query(database, tmp_path, table_name='numbers', filters=[('value', '=', 3), ('id', '<', 50)])
+    assert second.equals(first)
+    assert cache.statistics()['memory_hits'] == 1 and cache.statistics()['misses'] == 1
+
+
+@pytest.mark.parametrize('write', ['insert_into', 'modify', 'drop_rows', 'drop_table'])
+def test_writes_invalidate_cached_results(database, numbers, cache, tmp_path, write):
+    before = query(database, tmp_path, table_name='numbers', aggs=[('count', 'id')])
+    if write == 'insert_into':
+        utils.insert_into(database, 'numbers', [[100], [0]])
+    elif write == 'modify':
+        utils.modify(database, 'numbers', [('id', '=', 0)], 'id', 1000)
+    elif write == 'drop_rows':
+        utils.drop_rows(database, 'numbers', [('id', '<', 10)])
+    else:
+        utils.drop_table(database, 'numbers')
+        assert cache.statistics()['memory_results'] == 0
+        utils.create_table_from_cli(database, 'numbers', [('id', utils.infer_datatypes('int'))])
+
+    after = query(database, tmp_path, table_name='numbers', aggs=[('count', 'id')])
+    assert cache.statistics()['hits'] == 0 and cache.statistics()['misses'] == 2
+    expected = {'insert_into': 101, 'modify': 100, 'drop_rows': 90, 'drop_table': 0}[write]
+    assert before.column('count(id)').to_pylist() == [100]
+    assert after.column('count(id)').to_pylist() == [expected]
+
+
+def test_lru_eviction_from_memory_to_disk_and_out_of_disk(database, numbers, cache, tmp_path):
+    filters = [[('id', '>=', n), ('id', '<', n + 10)] for n in [0, 10, 20, 30]]
+    cache.memory_size = query(database, tmp_path, table_name='numbers', filters=filters[0]).nbytes
+    cache.memory.clear()
+    results = [query(database, tmp_path, table_name='numbers', filters=f) for f in filters[:3]]
+    stats = cache.statistics()
+    assert stats['memory_results'] == 1 and stats['disk_results'] == 2
+
+    # a result on disk is read back into memory, moving the least recently used one to disk
+    assert query(database, tmp_path, table_name='numbers', filters=filters[1]).equals(results[1])
+    assert cache.statistics()['disk_hits'] == 1
+    assert cache.statistics()['memory_results'] == 1 and cache.statistics()['disk_results'] == 2
+
+    # results past disk_size are removed, least recently used first
+    cache.disk_size = 1.5 * max(path.stat().st_size for path in (tmp_path / 'cache').glob('*.parquet')) # about one result
+    query(database, tmp_path, table_name='numbers', filters=filters[3])
+    stats = cache.statistics()
+    assert stats['memory_results'] == 1 and stats['disk_results'] == 1
+    assert len(list((tmp_path / 'cache').glob('*.parquet'))) == 1
+    assert query(database, tmp_path, table_name='numbers', filters=filters[1]).equals(results[1])
+    assert query(database, tmp_path, table_name='numbers', filters=filters[0]).equals(results[0])
+    assert cache.statistics()['misses'] == stats['misses'] + 1
+
+
+def test_results_not_read_to_the_end_are_not_cached(database, numbers, cache, tmp_path):
+    next(utils.execute_query(database, 'numbers', tmp_path / 'query'))
+    query(database, tmp_path, table_name='numbers')
+    assert cache.statistics()['misses'] == 2
+
+
+def test_cache_reads_its_configuration_when_used(database, numbers, cache, tmp_path, monkeypatch):
+    cache.memory_size = None
+    monkeypatch.setattr(utils, 'RESULT_CACHE_MEMORY_SIZE', 0)
+    query(database, tmp_path, table_name='numbers')
+    assert cache.statistics()['memory_results'] == 0
+
+
+def test_show_cache_prints_the_counters(database, numbers, cache, tmp_path):
+    query(database, tmp_path, table_name='numbers')
+    query(database, tmp_path, table_name='numbers')
+    query(database, tmp_path, table_name='others')
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        DatabaseCLI().do_show('cache')
+    assert 'Result cache: 1 hits (1 from memory, 0 from disk), 2 misses' in output.getvalue()
+    assert '2 results in memory' in output.getvalue()
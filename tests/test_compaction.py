@@ -0,0 +1,83 @@
+import threading
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from src import utils
+
+
+@pytest.fixture
+def fragmented(database, create_table, small_partitions, monkeypatch):
+    '''
+    Table fragmented, spread over many small partitions and 3 delta files, with deleted rows.
+    Partitions are full size again once it is created. Returns its manifest
+    '''
+    create_table('fragmented', {'id': np.arange(1000), 'value': np.arange(1000) * 2})
+    utils.drop_rows(database, 'fragmented', [('id', 'in', [1, 500])])
+    for start in range(1000, 1030, 10):
+        utils.insert_into(database, 'fragmented', [list(range(start, start + 10)), [0] * 10])
+    monkeypatch.setattr(utils, 'MAX_PARTITION_SIZE', 100 * 1024 * 1024)
+    return utils.read_manifest(database, 'fragmented')
+
+
+def table_files(table_path):
+    return sorted(path.relative_to(table_path).as_posix() for path in table_path.rglob('*.parquet'))
+
+
+def test_compaction_rewrites_into_one_partition(database, fragmented, read_all):
+    before = read_all('fragmented').sort('id')
+    assert utils.needs_compaction(database, 'fragmented')
+
+    n_files, n_partitions = utils.compact_table(database, 'fragmented')
+    assert n_files == len(fragmented['partitions']) + 3
+    assert n_partitions == 1
+
+    manifest = utils.read_manifest(database, 'fragmented')
+    assert manifest['version'] > fragmented['version']
+    assert manifest['deltas'] == []
+    assert [entry['deleted'] for entry in manifest['partitions']] == [0]
+    assert read_all('fragmented').sort('id').frame_equal(before)
+    assert not utils.needs_compaction(database, 'fragmented')
+    assert table_files(utils.DATA_PATH / database / 'fragmented') == [manifest['partitions'][0]['file']]
+
+
+def test_swap_cut_short_leaves_the_table_unchanged(database, fragmented, read_all, monkeypatch):
+    before = read_all('fragmented').sort('id')
+    table_path = utils.DATA_PATH / database / 'fragmented'
+
+    def crash(batches, table_path, table_name, schema, start=0):
+        pq.write_table(pa.table({'id': [-1], 'value': [-1]}), table_path / f'fragmented_{start}.parquet')
+        raise OSError('disk full')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(utils, 'write_partitions', crash)
+        with pytest.raises(OSError):
+            utils.compact_table(database, 'fragmented')
+    assert utils.read_manifest(database, 'fragmented')['version'] == fragmented['version']
+    assert read_all('fragmented').sort('id').frame_equal(before)
+
+    # the next compaction removes the partition the crashed one left behind
+    utils.compact_table(database, 'fragmented')
+    assert read_all('fragmented').sort('id').frame_equal(before)
+    assert len(list(table_path.glob('*.parquet'))) == 1
+
+
+def test_open_reader_does_not_block_writers(database, fragmented, read_all):
+    before = read_all('fragmented').sort('id')
+    partitions = utils.read_table(database, 'fragmented')
+    first, _ = next(partitions)
+
+    compaction = threading.Thread(target=utils.compact_table, args=(database, 'fragmented'))
+    compaction.start()
+    compaction.join(timeout=60)
+    assert not compaction.is_alive()
+    utils.drop_rows(database, 'fragmented', [('id', '<', 100)])
+
+    # the reader goes on from the files of the table when it started
+    rest = [data for data, _ in partitions]
+    assert pl.from_arrow(pa.concat_tables([first] + rest)).sort('id').frame_equal(before)
+    assert read_all('fragmented').height == before.height - 99
+    assert not list(utils.TEMP_DB_PATH.glob('snapshot_*'))
@@ -0,0 +1,79 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+from src import utils
+from src.cli import DatabaseCLI
+
+QUERY = dict(table_name='orders', filters=[('id', '<', 500)], group_cols=['status'], aggs=[('count', 'id')])
+
+
+@pytest.fixture
+def orders(database, create_table, small_partitions):
+    '''Table orders of 2000 rows in id order over many partitions, and customers'''
+    create_table('orders', {'id': np.arange(2000), 'custkey': np.arange(2000) % 10, 'status': np.arange(2000) % 3})
+    create_table('customers', {'custkey': np.arange(10), 'name': [f'customer {i}' for i in range(10)]})
+
+
+def run_profiled(plan, tmp_path):
+    '''Runs a plan with a QueryProfile, returns the profile and the number of rows of the result'''
+    profile = utils.QueryProfile(plan)
+    n_rows = sum(data.num_rows for data, _ in utils.execute_plan(plan, tmp_path / 'query', profile=profile))
+    return profile, n_rows
+
+
+def test_explain_prints_the_operator_tree_with_its_estimates(database, orders):
+    utils.analyze_table(database, 'orders')
+    plan = utils.plan_query(database, **QUERY)
+    assert [node['operator'] for node in plan] == ['scan', 'aggregate']
+    assert 400 <= plan[0]['rows'] <= 600
+    assert plan[1]['rows'] == 3
+
+    lines = utils.format_plan(plan).splitlines()
+    assert lines[0].startswith('aggregate count(id) group status  (rows=3 ')
+    assert lines[1].startswith(f"  scan orders columns ['status', 'id'] filter [('id', '<', 500)]  (rows={plan[0]['rows']:,} ")
+    assert lines[2].startswith('Estimated memory: ')
+
+
+def test_explain_lists_both_sides_of_a_join_under_it(database, orders):
+    plan = utils.plan_query(database, table_name='orders', join_table_name='customers', join_col='custkey')
+    lines = utils.format_plan(plan).splitlines()
+    assert lines[0].startswith('hash join on custkey (build customers)')
+    assert lines[1].startswith('  scan orders') and lines[2].startswith('  scan customers')
+
+
+def test_profile_measures_the_actual_rows_and_files_of_each_operator(database, orders, tmp_path):
+    plan = utils.plan_query(database, **QUERY)
+    profile, n_rows = run_profiled(plan, tmp_path)
+    assert n_rows == 3
+
+    scan, aggregate = profile.actuals(0), profile.actuals(1)
+    n_files = len(utils.read_manifest(database, 'orders')['partitions'])
+    assert scan['files'] == n_files and 0 < scan['files_read'] < n_files / 2
+    assert scan['rows'] == 500 and 500 <= scan['rows_in'] < 1000
+    assert aggregate['rows_in'] == 500 and aggregate['rows'] == 3
+    assert aggregate['files'] == aggregate['files_read'] == 0
+    for actuals in [scan, aggregate]:
+        assert actuals['wall'] >= 0 and actuals['cpu'] >= 0 and actuals['bytes'] > 0
+
+    lines = utils.format_plan(plan, profile).splitlines()
+    assert '[actual time=' in lines[0] and 'rows=500->3 ' in lines[0] and 'pruned=' not in lines[0]
+    assert f'pruned={n_files - scan["files_read"]}/{n_files} files]' in lines[1]
+    assert lines[-2].startswith('Peak memory: ') and lines[-1].startswith('Total time: ')
+
+
+def test_explain_analyze_command(database, orders):
+    cli = DatabaseCLI()
+    cli.do_use(f'db {database}')
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        cli.do_explain('query from orders + customers by custkey filter (id lt 500)')
+        cli.do_explain('analyze query from orders + customers by custkey filter (id lt 500)')
+    text = output.getvalue()
+    assert 'An error occurred' not in text
+    assert text.count('hash join on custkey (build customers)') == 2
+    assert '500 rows' in text
+    assert text.count('[actual ') == 1 and '->500 ' in text
+    assert 'Total time: ' in text
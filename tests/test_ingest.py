@@ -0,0 +1,122 @@
+import json
+
+import polars as pl
+import pyarrow as pa
+import pytest
+
+from src import utils
+
+
+def write_lines(path, lines):
+    path.write_text('\n'.join(lines) + '\n')
+    return path
+
+
+def test_csv_int_column_widened_to_float_in_later_block(database, tmp_path, small_partitions, read_all):
+    rows = [f'{i},{i}' for i in range(500)] + ['500,1.5']
+    utils.create_table_from_csv(write_lines(tmp_path / 'drift.csv', ['id,value'] + rows), database, 'drift')
+
+    data = read_all('drift').sort('id')
+    assert data.schema['id'] == pl.Int64
+    assert data.schema['value'] == pl.Float64
+    assert data.height == 501
+    assert data['value'].to_list() == [float(i) for i in range(500)] + [1.5]
+    assert len(utils.read_manifest(database, 'drift')['partitions']) > 1
+
+
+def test_csv_column_widened_to_str_in_later_block(database, tmp_path, small_partitions, read_all):
+    rows = [f'{i},{i}' for i in range(500)] + ['500,abc']
+    utils.create_table_from_csv(write_lines(tmp_path / 'drift.csv', ['id,value'] + rows), database, 'drift')
+
+    data = read_all('drift').sort('id')
+    assert data.schema['value'] == pl.Utf8
+    assert data['value'].to_list() == [str(i) for i in range(500)] + ['abc']
+
+
+def test_csv_column_without_values_in_first_block(database, tmp_path, small_partitions, read_all):
+    rows = [f'{i},' for i in range(500)] + ['500,7']
+    utils.create_table_from_csv(write_lines(tmp_path / 'empty.csv', ['id,value'] + rows), database, 'empty')
+
+    data = read_all('empty').sort('id')
+    assert data.schema['value'] == pl.Utf8
+    assert data.height == 501
+    assert data['value'][-1] == '7'
+
+
+def test_csv_explicit_schema_is_kept(database, tmp_path):
+    path = write_lines(tmp_path / 'typed.csv', ['id,value', '1,1', '2,2'])
+    utils.create_table_from_csv(path, database, 'typed', schema={'value': pa.float32()})
+
+    assert utils.manifest_schema(utils.read_manifest(database, 'typed')).field('value').type == pa.float32()
+
+
+def test_csv_failed_ingest_leaves_nothing_behind(database, tmp_path):
+    path = write_lines(tmp_path / 'typed.csv', ['id,value', '1,1', '2,abc'])
+    with pytest.raises(pa.ArrowInvalid):
+        utils.create_table_from_csv(path, database, 'typed', schema={'value': pa.int64()})
+    assert not (utils.DATA_PATH / database / 'typed').exists()
+    assert 'typed' not in utils.list_tables(database)
+
+    utils.create_table_from_csv(path, database, 'typed')
+    with pytest.raises(ValueError):
+        utils.create_table_from_csv(path, database, 'typed')
+
+
+
+def test_files_with_drifting_types_are_merged(database, tmp_path, read_all):
+    ints = write_lines(tmp_path / 'ints.csv', ['id,value', '1,1', '2,2'])
+    floats = write_lines(tmp_path / 'floats.csv', ['id,value', '3,3.5'])
+    utils.create_table_from_files([ints, floats], database, 'merged', workers=1)
+
+    data = read_all('merged').sort('id')
+    assert data.schema['value'] == pl.Float64
+    assert data['value'].to_list() == [1.0, 2.0, 3.5]
+
+
+def test_shards_ingested_by_several_workers_are_unified_and_renumbered(database, tmp_path, small_partitions, read_all):
+    shards = {
+        'a_ints.csv': ['id,value'] + [f'{i},{i}' for i in range(300)],
+        'b_floats.csv': ['id,value'] + [f'{i},{i}.5' for i in range(300, 600)],
+        'c_tags.csv': ['id,value,tag'] + [f'{i},{i},t{i}' for i in range(600, 900)],
+    }
+    paths = [write_lines(tmp_path / name, lines) for name, lines in shards.items()]
+    utils.create_table_from_files(paths, database, 'sharded', workers=3)
+
+    data = read_all('sharded').sort('id')
+    assert data.schema['value'] == pl.Float64 and data.schema['tag'] == pl.Utf8
+    assert data['id'].to_list() == list(range(900))
+    assert data['value'][299:301].to_list() == [299.0, 300.5]
+    assert data['tag'].null_count() == 600 and data['tag'][-1] == 't899'
+
+    manifest = utils.read_manifest(database, 'sharded')
+    files = [entry['file'] for entry in manifest['partitions']]
+    assert len(files) > 3 and files == [f'sharded_{n}.parquet' for n in range(len(files))]
+
+
+def test_failed_shard_leaves_nothing_behind(database, tmp_path):
+    good = write_lines(tmp_path / 'a_good.csv', ['id,value', '1,1'])
+    broken = write_lines(tmp_path / 'b_broken.csv', ['id,value', '1,1,1'])
+    with pytest.raises(pa.ArrowInvalid):
+        utils.create_table_from_files([good, broken], database, 'sharded', workers=2)
+    assert not (utils.DATA_PATH / database / 'sharded').exists()
+    assert 'sharded' not in utils.list_tables(database)
+
+
+def test_json_schema_widened_by_later_records(database, tmp_path, small_partitions, read_all):
+    records = [{'id': i, 'value': i} for i in range(100)] + [{'id': 100, 'value': 0.5, 'tag': 'late'}]
+    utils.create_table_from_json(write_lines(tmp_path / 'drift.json', [json.dumps(record) for record in records]),
+                                 database, 'drift')
+
+    data = read_all('drift').sort('id')
+    assert data.schema['value'] == pl.Float64
+    assert data['tag'].null_count() == 100
+    assert data['tag'][-1] == 'late'
+    assert data['value'][-1] == 0.5
+
+
+def test_json_failed_ingest_leaves_nothing_behind(database, tmp_path, small_partitions):
+    lines = [json.dumps({'id': i}) for i in range(100)] + ['{"id": ']
+    with pytest.raises(pa.ArrowInvalid):
+        utils.create_table_from_json(write_lines(tmp_path / 'broken.json', lines), database, 'broken')
+    assert not (utils.DATA_PATH / database / 'broken').exists()
+    assert 'broken' not in utils.list_tables(database)
@@ -0,0 +1,171 @@
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pytest
+
+from src import utils
+
+TINY_BUDGET = 4096 # bytes, far below the size of the tables, so that operators spill
+
+
+@pytest.fixture
+def orders(database, create_table, small_partitions):
+    '''Tables orders (3000 rows over several partitions, some without a custkey) and customers. Returns both'''
+    rng = np.random.default_rng(7)
+    orders = pl.DataFrame({
+        'id': rng.permutation(3000),
+        'custkey': pl.Series(rng.integers(0, 120, 3000)).set_at_idx(list(range(0, 3000, 50)), None),
+        'price': np.round(rng.uniform(0, 1000, 3000), 2),
+        'status': rng.choice(['F', 'O', 'P'], 3000),
+    })
+    customers = pl.DataFrame({
+        'custkey': pl.Series(list(range(100)) + [None]),
+        'name': [f'customer {i}' for i in range(101)],
+    })
+    create_table('orders', orders.to_arrow())
+    create_table('customers', customers.to_arrow())
+    return orders, customers
+
+
+def test_filtered_projection_streams_without_temporary_files(database, orders, tmp_path, monkeypatch):
+    orders, _ = orders
+    n_reads = []
+    read_partition = utils.read_partition
+    monkeypatch.setattr(utils, 'read_partition', lambda *args, **kwargs: n_reads.append(1) or read_partition(*args, **kwargs))
+    temp_files = set(utils.TEMP_DB_PATH.rglob('*')) if utils.TEMP_DB_PATH.exists() else set()
+
+    partitions = utils.execute_query(database, 'orders', tmp_path / 'query', filters=[('status', '=', 'F')],
+                                     columns=[['id', 'price'], []])
+    first, _ = next(partitions)
+    # the first partition is yielded before the others are read
+    assert 0 < len(n_reads) < len(utils.read_manifest(database, 'orders')['partitions'])
+    result = pl.from_arrow(pa.concat_tables([first] + [data for data, _ in partitions]))
+    assert result.sort('id').frame_equal(orders.filter(pl.col('status') == 'F').select('id', 'price').sort('id'))
+    assert not (tmp_path / 'query').exists()
+    assert set(utils.TEMP_DB_PATH.rglob('*')) == temp_files
+
+
+def test_external_sort(orders, run_query):
+    orders, _ = orders
+    result, memory = run_query(memory_budget=TINY_BUDGET, table_name='orders', sort_col='price', reverse=True)
+    assert memory.spilled > 0
+    assert result['price'].to_list() == orders.sort('price', descending=True)['price'].to_list()
+    assert result.sort('id').frame_equal(orders.sort('id'))
+
+    # null keys are kept, last or first
+    result = run_query(table_name='orders', sort_col='custkey')
+    assert result['custkey'].to_list() == orders.sort('custkey', nulls_last=True)['custkey'].to_list()
+    result = run_query(table_name='orders', sort_col='custkey', nulls_first=True)
+    assert result['custkey'][:60].null_count() == 60
+    assert result['custkey'][60:].to_list() == orders['custkey'].drop_nulls().sort().to_list()
+
+
+def test_workers_return_the_rows_in_order(orders, run_query, monkeypatch):
+    results = []
+    for workers in [1, 4]:
+        monkeypatch.setattr(utils, 'QUERY_WORKERS', workers)
+        monkeypatch.setattr(utils, 'MEMORY_BUDGET', TINY_BUDGET) # sorted runs are generated in parallel
+        results.append((run_query(table_name='orders', filters=[('status', '!=', 'P')]),
+                        run_query(table_name='orders', sort_col='price')))
+    assert results[0][0].frame_equal(results[1][0])
+    assert results[0][1]['price'].to_list() == results[1][1]['price'].to_list()
+
+
+@pytest.mark.parametrize('memory_budget', [TINY_BUDGET, None])
+def test_top_n(orders, run_query, memory_budget):
+    orders, _ = orders
+    # the top rows outgrow TINY_BUDGET, falling back to a sort
+    result = run_query(memory_budget=memory_budget, table_name='orders', sort_col='price', limit=10, offset=5)
+    result = result[0] if memory_budget is not None else result
+    assert result['id'].to_list() == orders.sort('price')['id'][5:15].to_list()
+
+
+def test_aggregation_spills(orders, run_query):
+    orders, _ = orders
+    result, memory = run_query(memory_budget=TINY_BUDGET, table_name='orders', group_cols=['custkey'],
+                               aggs=[('sum', 'price'), ('count', 'id')], sort_col='custkey')
+    expected = orders.group_by('custkey').agg(pl.sum('price').alias('sum(price)'), pl.count('id').alias('count(id)'))
+    assert memory.spilled > 0
+    assert result.height == expected.height == 121
+    result, expected = result.sort('custkey'), expected.sort('custkey')
+    assert result['count(id)'].to_list() == expected['count(id)'].to_list()
+    assert np.allclose(result['sum(price)'].to_numpy(), expected['sum(price)'].to_numpy())
+
+
+def test_grace_hash_join(orders, run_query):
+    orders, _ = orders
+    # below the size of customers, the build side
+    result, memory = run_query(memory_budget=1024, table_name='orders', join_table_name='customers', join_col='custkey')
+    expected = orders.filter(pl.col('custkey') < 100) # customers 0 to 99, polars would also match the null keys
+    assert memory.spilled > 0
+    assert result.height == expected.height
+    assert result['custkey_x'].null_count() == 0
+    assert sorted(result['id'].to_list()) == sorted(expected['id'].to_list())
+
+
+def test_grace_hash_join_of_buckets_with_a_row_from_each_partition(tmp_path):
+    # most spill files of a bucket are empty or hold a single row, concatenated out of order
+    keys = np.arange(4000) * 7919 % 1000
+    left = [pl.DataFrame({'id': np.arange(i, i + 50), 'key_x': keys[i:i + 50]}) for i in range(0, 4000, 50)]
+    right = [pl.DataFrame({'key_y': [100, 200, 300], 'label': ['a', 'b', 'c']})]
+    memory = utils.MemoryManager(operator_budget=2048).reserve('hash_join')
+    result = pl.concat(utils.grace_hash_join(iter(left), iter(right), 'key_x', 'key_y', tmp_path / 'join', memory=memory))
+    assert sorted(result['id'].to_list()) == [i for i in range(4000) if keys[i] in (100, 200, 300)]
+
+
+@pytest.mark.parametrize('algorithm', ['hash', 'sort_merge', 'index'])
+def test_null_join_keys_never_match(database, orders, tmp_path, algorithm):
+    orders, _ = orders
+    utils.create_index(database, 'customers', 'custkey')
+    partitions = utils.join_tables(database, 'orders', 'customers', 'custkey', tmp_path / 'join', algorithm=algorithm)
+    result = pl.from_arrow(pa.concat_tables(data for data, _ in partitions))
+    expected = orders.filter(pl.col('custkey') < 100)
+    assert result.height == expected.height
+    assert result['custkey_x'].null_count() == result['custkey_y'].null_count() == 0
+    assert sorted(result['id'].to_list()) == sorted(expected['id'].to_list())
+
+
+def test_count_distinct_on_several_columns(orders, run_query):
+    orders, _ = orders
+    aggs = [('count_distinct', 'custkey'), ('count_distinct', 'status'), ('sum', 'price')]
+    for memory_budget in [TINY_BUDGET, None]:
+        result = run_query(memory_budget=memory_budget, table_name='orders', group_cols=['status'], aggs=aggs,
+                           sort_col='status')
+        result = result[0] if memory_budget is not None else result
+        expected = orders.group_by('status').agg(
+            pl.col('custkey').drop_nulls().n_unique(), pl.col('status').n_unique().alias('distinct_status'), pl.sum('price')
+        ).sort('status')
+        assert result['count_distinct(custkey)'].to_list() == expected['custkey'].to_list()
+        assert result['count_distinct(status)'].to_list() == [1, 1, 1]
+        assert np.allclose(result['sum(price)'].to_numpy(), expected['price'].to_numpy())
+
+
+def test_approx_count_distinct_from_stored_sketches(database, orders, run_query):
+    orders, _ = orders
+    query = dict(table_name='orders', aggs=[('approx_count_distinct', 'id'), ('approx_count_distinct', 'custkey')])
+    plan = utils.plan_query(database, **query)
+    assert plan[1]['sketches']
+
+    result = run_query(**query)
+    assert abs(result['approx_count_distinct(id)'][0] - 3000) < 3000 * 0.05
+    assert abs(result['approx_count_distinct(custkey)'][0] - 120) <= 5
+    assert any((utils.DATA_PATH / database / 'orders' / utils.SKETCH_DIR).rglob('*.parquet'))
+
+    # sketches of partitions with deleted rows are rebuilt
+    utils.drop_rows(database, 'orders', [('id', '>=', 1000)])
+    assert abs(run_query(**query)['approx_count_distinct(id)'][0] - 1000) < 1000 * 0.05
+
+
+def test_hyperloglog_precision_below_12_is_rejected(monkeypatch):
+    monkeypatch.setattr(utils, 'HYPERLOGLOG_PRECISION', 8)
+    with pytest.raises(ValueError):
+        utils.hyperloglog_registers(np.arange(10, dtype=np.uint64))
+
+
+def test_distinct_rows(orders, run_query):
+    orders, _ = orders
+    result, memory = run_query(memory_budget=TINY_BUDGET, table_name='orders', columns=[['custkey', 'status'], []],
+                               distinct=True)
+    expected = orders.select('custkey', 'status').unique()
+    assert memory.spilled > 0
+    assert result.sort(['custkey', 'status']).frame_equal(expected.sort(['custkey', 'status']))
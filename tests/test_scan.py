@@ -0,0 +1,140 @@
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pytest
+
+from src import utils
+
+
+@pytest.fixture
+def events(database, create_table, small_partitions):
+    '''Table events of 4000 rows over many partitions in id order, with values of key spread over all of them. Returns its rows'''
+    events = pl.DataFrame({
+        'id': np.arange(4000), 'key': np.arange(4000) * 7919 % 1000, 'payload': [f'event {i}' for i in range(4000)],
+    })
+    create_table('events', events.to_arrow())
+    assert len(utils.read_manifest(database, 'events')['partitions']) >= 10
+    return events
+
+
+def scan(database, table_name, **kwargs):
+    '''Rows read by utils.read_table as a polars DataFrame, and its stats'''
+    stats = {}
+    data = pa.concat_tables(data for data, _ in utils.read_table(database, table_name, stats=stats, **kwargs))
+    return pl.from_arrow(data), stats
+
+
+def profile_query(database, tmp_path, **query):
+    '''Runs a query with a QueryProfile. Returns its rows as a polars DataFrame, and the profile'''
+    plan = utils.plan_query(database, **query)
+    profile = utils.QueryProfile(plan)
+    partitions = utils.execute_plan(plan, tmp_path / 'query', profile=profile)
+    return pl.from_arrow(pa.concat_tables(data for data, _ in partitions)), profile
+
+
+def test_filters_skip_partitions_by_statistics(database, events):
+    result, stats = scan(database, 'events', filters=[('id', '>=', 1000), ('id', '<', 1100)])
+    assert result.frame_equal(events.filter((pl.col('id') >= 1000) & (pl.col('id') < 1100)))
+    assert stats['files'] == len(utils.read_manifest(database, 'events')['partitions'])
+    assert 2 <= stats['files_read'] <= 3 # about 50 rows per partition
+    assert stats['rows_read'] < 200
+
+    result, stats = scan(database, 'events', filters=[[('id', '<', 50)], [('id', '>', 3950)]])
+    assert result['id'].to_list() == list(range(50)) + list(range(3951, 4000))
+    assert stats['files_read'] <= 3 and stats['rows_read'] < 200
+
+
+def test_only_referenced_columns_are_read(database, events, tmp_path, monkeypatch):
+    read_columns = []
+    read_partition = utils.read_partition
+    def spy(partition, columns=None, **kwargs):
+        read_columns.append(columns)
+        return read_partition(partition, columns=columns, **kwargs)
+    monkeypatch.setattr(utils, 'read_partition', spy)
+
+    result, _ = profile_query(database, tmp_path, table_name='events', columns=[['id'], []], filters=[('key', '=', 7)])
+    assert result['id'].to_list() == events.filter(pl.col('key') == 7)['id'].to_list()
+    assert len(read_columns) and all(columns is not None and 'payload' not in columns for columns in read_columns)
+
+
+@pytest.mark.parametrize('offset', [None, 2000])
+def test_trunc_without_sort_stops_after_the_rows_it_needs(database, events, tmp_path, offset):
+    result, profile = profile_query(database, tmp_path, table_name='events', limit=20, offset=offset)
+    assert result.frame_equal(events.slice(offset or 0, 20))
+    assert profile.plan[0]['limit'] == 20
+    assert profile.stats[0]['files'] >= 10
+    assert profile.stats[0]['files_read'] <= 2
+
+
+def test_index_lookups_read_only_the_matching_partitions(database, events):
+    _, stats = scan(database, 'events', filters=[('key', '=', 5)])
+    assert stats['files_read'] > 10 # most partitions span the whole range of key
+
+    utils.create_index(database, 'events', 'key')
+    matches = events.filter(pl.col('key') == 5)
+    result, stats = scan(database, 'events', filters=[('key', '=', 5)])
+    assert result.frame_equal(matches)
+    assert stats['files_read'] <= matches.height
+    assert stats['rows_read'] < 5 * 60
+
+
+def test_bloom_filters_skip_partitions_without_the_values(database, events):
+    utils.create_bloom_filter(database, 'events', 'key')
+    manifest = utils.read_manifest(database, 'events')
+    table_path = utils.DATA_PATH / database / 'events'
+    schema = utils.manifest_schema(manifest)
+    first = manifest['partitions'][0]
+    first_keys = set(events['key'][:first['rows']].to_list())
+    absent = min(set(range(1000)) - first_keys)
+    assert utils.bloom_may_match(table_path, manifest, schema, first, [('key', '=', next(iter(first_keys)))])
+    assert not utils.bloom_may_match(table_path, manifest, schema, first, [('key', 'in', [absent, 5000])])
+
+    result, stats = scan(database, 'events', filters=[('key', 'in', [5, 6])])
+    assert result.frame_equal(events.filter(pl.col('key').is_in([5, 6])))
+    assert stats['files_read'] < stats['files'] / 2
+
+
+@pytest.fixture
+def picked(database, create_table, events):
+    '''Table picked of 3 ids and keys of events, and the bloom filter of events on key'''
+    create_table('picked', {'id': [100, 200, 300], 'key': [100, 200, 300], 'label': ['a', 'b', 'c']})
+    utils.create_bloom_filter(database, 'events', 'key')
+
+
+@pytest.mark.parametrize('join_col', ['id', 'key'])
+def test_runtime_join_filters_prune_the_probe_side(database, events, picked, tmp_path, monkeypatch, join_col):
+    query = dict(table_name='picked', join_table_name='events', join_col=join_col)
+    with_filters, profile = profile_query(database, tmp_path, **query)
+    monkeypatch.setattr(utils, 'RUNTIME_JOIN_FILTERS', False)
+    without_filters, profile_without = profile_query(database, tmp_path, **query)
+
+    assert with_filters.sort('id_y').frame_equal(without_filters.sort('id_y'))
+    assert with_filters.height == (3 if join_col == 'id' else 12)
+    # id is clustered, pruned by the min/max of the keys, key by the bloom filters of the partitions
+    assert profile.stats[0]['files_read'] < profile_without.stats[0]['files_read'] / 2
+
+
+def test_runtime_join_filter_falls_back_to_a_bloom_filter():
+    collector = utils.KeyCollector('key', pa.int64(), utils.MemoryManager(2048, 2048).reserve('join_keys'))
+    keys = pa.table({'key': pa.array(range(0, 1000, 2), pa.int64())})
+    assert sum(data.num_rows for data, _ in collector.collect([(keys, 'keys_0')])) == 500
+    assert collector.ready and collector.hashes is None and collector.bits is not None
+
+    probe = pa.table({'key': pa.array(list(range(1000)) + [None], pa.int64())})
+    kept = collector.filter(probe).column('key').to_pylist()
+    assert set(range(0, 1000, 2)) <= set(kept) and None not in kept
+    assert len(kept) < 600
+    assert collector.filters(None) == [('key', '>=', 0), ('key', '<=', 998)]
+
+
+def test_join_with_overflowing_runtime_filter_matches_join_without(database, events, picked, tmp_path, monkeypatch):
+    def join(memory):
+        partitions = utils.join_tables(database, 'events', 'picked', 'key', tmp_path / 'join', memory=memory)
+        return pl.from_arrow(pa.concat_tables(data for data, _ in partitions)).sort('id')
+
+    # the 1000 keys of events do not fit in 2 kB: the probe side is filtered by a bloom filter of them
+    memory = utils.MemoryManager(operator_budget=2048)
+    with_filters = join(memory)
+    monkeypatch.setattr(utils, 'RUNTIME_JOIN_FILTERS', False)
+    assert with_filters.frame_equal(join(utils.MemoryManager()))
+    assert with_filters.height == 12
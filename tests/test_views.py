@@ -0,0 +1,81 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from src import utils
+
+
+def view_query(**query):
+    '''All the keyword arguments of utils.plan_query a view is defined by, query with the defaults of the others'''
+    return dict(dict(
+        table_name=None, join_table_name=None, join_col=None, filters=[], group_cols=[], aggs=[], group_filter=[],
+        columns=[], distinct=False, sort_col=None, reverse=False, nulls_first=False, limit=None, offset=None
+    ), **query)
+
+
+VIEWS = {
+    'by_region': ('aggregate', view_query(table_name='sales', group_cols=['region'],
+                                          aggs=[('sum', 'amount'), ('count', 'id'), ('max', 'amount')],
+                                          filters=[('amount', '>', 10)])),
+    'large_sales': ('append', view_query(table_name='sales', filters=[('amount', '>', 50)], columns=[['id', 'amount'], []])),
+    'top_sales': ('recompute', view_query(table_name='sales', sort_col='amount', reverse=True, limit=5)),
+    'regions': ('recompute', view_query(table_name='sales', columns=[['region'], []], distinct=True)),
+}
+
+
+@pytest.fixture
+def sales(database, create_table, tmp_path):
+    '''Table sales and the views of VIEWS on it'''
+    rng = np.random.default_rng(3)
+    create_table('sales', {
+        'id': np.arange(200), 'region': rng.choice(['north', 'south', 'east'], 200), 'amount': rng.integers(0, 100, 200),
+    })
+    for view_name, (mode, query) in VIEWS.items():
+        assert utils.create_view(database, view_name, query, tmp_path / view_name) == mode
+
+
+def sort_all(data):
+    return data.sort(data.columns)
+
+
+def check_views(read_all, run_query):
+    '''Every view holds the result of running its query'''
+    for view_name, (_, query) in VIEWS.items():
+        assert sort_all(read_all(view_name)).frame_equal(sort_all(run_query(**query))), view_name
+
+
+def test_views_refreshed_incrementally_match_their_queries(database, sales, read_all, run_query):
+    check_views(read_all, run_query)
+
+    utils.insert_into(database, 'sales', [[200, 201, 202], ['north', 'west', 'east'], [99, 60, 5]])
+    check_views(read_all, run_query)
+    assert read_all('by_region').filter(pl.col('region') == 'west')['count(id)'].to_list() == [1]
+    assert read_all('large_sales').filter(pl.col('id') == 200).height == 1
+
+    # no inserted row passes the filters of the aggregate and append views
+    versions = {view_name: utils.read_manifest(database, view_name)['version'] for view_name in VIEWS}
+    utils.insert_into(database, 'sales', [[203], ['south'], [1]])
+    check_views(read_all, run_query)
+    assert utils.read_manifest(database, 'by_region')['version'] == versions['by_region']
+    assert utils.read_manifest(database, 'large_sales')['version'] == versions['large_sales']
+
+
+def test_views_recomputed_after_modify_and_drop_rows(database, sales, read_all, run_query):
+    utils.modify(database, 'sales', [('region', '=', 'north')], 'amount', 100)
+    check_views(read_all, run_query)
+    utils.drop_rows(database, 'sales', [('amount', '>', 90)])
+    check_views(read_all, run_query)
+    assert read_all('by_region').filter(pl.col('region') == 'north').height == 0
+
+
+def test_aggregate_view_keeps_its_state_through_compaction(database, sales, read_all, run_query):
+    for i in range(5):
+        utils.insert_into(database, 'sales', [[300 + i], ['south'], [20 + i]])
+    utils.compact_table(database, 'by_region')
+    utils.insert_into(database, 'sales', [[400], ['south'], [30]])
+    check_views(read_all, run_query)
+
+
+def test_views_can_not_be_written(database, sales):
+    with pytest.raises(Exception):
+        utils.insert_into(database, 'by_region', [['north'], [1], [1], [1]])
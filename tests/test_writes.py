@@ -0,0 +1,97 @@
+import json
+
+import numpy as np
+import polars as pl
+import pytest
+
+from src import utils
+
+
+@pytest.fixture
+def items(database, create_table, small_partitions):
+    '''Table items of ids 0 to 999 over several partitions, with 10 more rows in delta files. Returns its rows'''
+    create_table('items', {'id': np.arange(1000), 'value': np.arange(1000) % 10})
+    for start in [1000, 1005]:
+        utils.insert_into(database, 'items', [list(range(start, start + 5)), [-1] * 5])
+    return pl.DataFrame({'id': range(1010), 'value': [i % 10 for i in range(1000)] + [-1] * 10})
+
+
+@pytest.fixture(params=[False, True], ids=['scan', 'index'])
+def indexed(request, database, items):
+    '''Runs the test without and with an index on items(id)'''
+    if request.param:
+        utils.create_index(database, 'items', 'id')
+    return request.param
+
+
+def test_inserts_are_delta_files(database, items, read_all):
+    manifest = utils.read_manifest(database, 'items')
+    assert len(manifest['partitions']) > 1
+    assert len(manifest['deltas']) == 2
+    assert read_all('items').sort('id').frame_equal(items)
+
+
+def test_drop_and_modify_partitions_and_deltas(database, items, indexed, read_all, run_query):
+    assert utils.drop_rows(database, 'items', [('id', '<', 5)]) == 5
+    assert utils.drop_rows(database, 'items', [[('id', '>=', 1008)], [('id', '=', 500)]]) == 3
+    utils.modify(database, 'items', [('id', '=', 600)], 'value', 99)
+    utils.modify(database, 'items', [('id', 'in', [7, 1002])], 'value', 42)
+
+    expected = items.filter(~((pl.col('id') < 5) | (pl.col('id') >= 1008) | (pl.col('id') == 500))).with_columns(
+        pl.when(pl.col('id') == 600).then(99).when(pl.col('id').is_in([7, 1002])).then(42)
+        .otherwise(pl.col('value')).alias('value')
+    )
+    assert read_all('items').sort('id').frame_equal(expected)
+
+    result = run_query(table_name='items', filters=[('id', 'in', [3, 7, 500, 600, 1002, 1009])], sort_col='id')
+    assert result['id'].to_list() == [7, 600, 1002]
+    assert result['value'].to_list() == [42, 99, 42]
+    result = run_query(table_name='items', filters=[('id', '<', 10)], sort_col='id')
+    assert result['id'].to_list() == list(range(5, 10))
+
+    manifest = utils.read_manifest(database, 'items')
+    assert sum(entry['deleted'] for entry in manifest['partitions'] + manifest['deltas']) > 0
+    if indexed:
+        assert all(entry['indexed']['id'] == entry['deleted'] for entry in manifest['partitions'])
+        assert all(utils.index_path(utils.DATA_PATH / database / 'items', 'id', entry['file']).exists()
+                   for entry in manifest['partitions'])
+
+
+def test_index_kept_up_to_date_by_merged_deltas(database, items, monkeypatch, run_query):
+    utils.create_index(database, 'items', 'id')
+    monkeypatch.setattr(utils, 'DELTA_MERGE_THRESHOLD', 3)
+    utils.insert_into(database, 'items', [[2000], [7]])
+
+    manifest = utils.read_manifest(database, 'items')
+    assert manifest['deltas'] == []
+    assert all(entry['indexed'] == {'id': entry['deleted']} for entry in manifest['partitions'])
+    assert run_query(table_name='items', filters=[('id', '=', 2000)])['value'].to_list() == [7]
+    assert run_query(table_name='items', filters=[('id', '>=', 1004)]).height == 7
+
+
+def test_float_values_on_indexed_int_column(database, items, run_query):
+    utils.create_index(database, 'items', 'id')
+    assert run_query(table_name='items', filters=[('id', '=', 500.0)])['id'].to_list() == [500]
+    assert run_query(table_name='items', filters=[('id', '=', 500.5)]).height == 0
+    assert run_query(table_name='items', filters=[('id', '<', 2.5)], sort_col='id')['id'].to_list() == [0, 1, 2]
+    assert run_query(table_name='items', filters=[('id', 'in', [1.0, 1.5, 3])], sort_col='id')['id'].to_list() == [1, 3]
+    assert run_query(table_name='items', filters=[('id', 'in', [])]).height == 0
+
+
+def test_delta_log_records_inserts(database, items, read_all):
+    table_path = utils.DATA_PATH / database / 'items'
+    with open(table_path / utils.MANIFEST_NAME) as file:
+        assert json.load(file)['deltas'] == []
+    assert len((table_path / utils.DELTA_LOG_NAME).read_text().splitlines()) == 2
+
+    # a line cut short by a crash is skipped, and does not swallow the next insert
+    with open(table_path / utils.DELTA_LOG_NAME, 'a') as file:
+        file.write('{"version": ')
+    utils.insert_into(database, 'items', [[1010], [-1]])
+    assert len(utils.read_manifest(database, 'items')['deltas']) == 3
+    assert read_all('items').height == 1011
+
+    utils.merge_deltas(database, 'items')
+    assert not (table_path / utils.DELTA_LOG_NAME).exists()
+    assert utils.read_manifest(database, 'items')['deltas'] == []
+    assert read_all('items').height == 1011